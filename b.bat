@@ -0,0 +1,2 @@
+@echo off
+python bench.py --output bench_output.json
@@ -0,0 +1,167 @@
+# coding: utf-8
+'''
+counte の各段階の所要時間を測る。
+
+  python bench.py --actions 200 --years 3 --events 20 --output bench_output.json
+
+データは seed から決定的に作るので、結果の JSON を並べれば回ごとに比べられる。
+--actions と --years を2倍にしたデータでも測り、2倍を大きく超えて遅くなった段階(二乗的な退行)があれば
+終了コード 1 で知らせる。workspace は action 1つにつき1行なので、--actions を2倍にすると
+parse・detect の段階の入力(workspace の行数)も2倍になる。
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import counte
+
+STAGES = [
+    'FileWorkspaceReader.parse',
+    'PostendDetector.postended_actions',
+    'ActionStorage.from_jsonstring',
+    'ActionStorage.to_actionstore',
+    'Report',
+    'FileReport',
+    'ActionStorage.from_actionstore',
+    'ActionStorage.to_jsonstring_pretty',
+]
+
+END_DATESTR = '2023/12/31'
+
+def generate_action_names(actions):
+    return [f'action{i:04d}' for i in range(actions)]
+
+def generate_workspace_lines(action_names, seed):
+    ''' だいたい1割の行に x/y を付ける '''
+    rnd = random.Random(seed)
+    lines = []
+    for name in action_names:
+        mark = ''
+        if rnd.random()<0.1:
+            mark = rnd.choice(['x', 'xx', 'y', 'xy'])
+        lines.append(f'{mark} {name}')
+    return lines
+
+def generate_datadict(action_names, years, events_per_day, seed):
+    ''' END_DATESTR までの years 年分、毎日 events_per_day 回ずつどれかの action をやった v2 データ '''
+    rnd = random.Random(seed)
+    end_ordinal = counte.datestr2ordinal(END_DATESTR)
+    days = 365*years
+    d = {}
+    for ordinal in range(end_ordinal-days+1, end_ordinal+1):
+        datestr = counte.ordinal2datestr(ordinal)
+        for _ in range(events_per_day):
+            name = rnd.choice(action_names)
+            daycounts = d.setdefault(name, {})
+            daycounts[datestr] = daycounts.get(datestr, 0) + 1
+    return d
+
+def _best_of(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed<best:
+            best = elapsed
+    return best, result
+
+def run_stages(actions, years, events_per_day, seed=0, repeat=3):
+    ''' @return {stage: 秒(repeat 回のうち最速)} '''
+    action_names = generate_action_names(actions)
+    workspace_lines = generate_workspace_lines(action_names, seed)
+    datadict = generate_datadict(action_names, years, events_per_day, seed)
+    jsonstr = counte.dict2str(datadict)
+
+    timings = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        workspace = os.path.join(tempdir, 'workspace.scb')
+        counte.list2file(workspace, workspace_lines)
+
+        def parse():
+            # parse は遅延なので、行を読み切るところまでを測る
+            reader = counte.FileWorkspaceReader()
+            reader.parse(workspace)
+            for _ in reader.lines:
+                pass
+            return reader
+        timings[STAGES[0]], reader = _best_of(parse, repeat)
+
+        def detect():
+            writer = counte.WorkspaceWriter()
+            return counte.PostendDetector(reader, writer).postended_actions()
+        timings[STAGES[1]], _ = _best_of(detect, repeat)
+
+    timings[STAGES[2]], actionstorage = _best_of(lambda: counte.ActionStorage.from_jsonstring(jsonstr), repeat)
+    timings[STAGES[3]], actionstore = _best_of(actionstorage.to_actionstore, repeat)
+    timings[STAGES[4]], report = _best_of(lambda: counte.Report(actionstore), repeat)
+    timings[STAGES[5]], _ = _best_of(lambda: counte.FileReport(report), repeat)
+    timings[STAGES[6]], out_actionstorage = _best_of(lambda: counte.ActionStorage.from_actionstore(actionstore), repeat)
+    timings[STAGES[7]], _ = _best_of(lambda: out_actionstorage.to_jsonstring_pretty(indent=2), repeat)
+    return timings
+
+def check_scaling(small, large, factor, threshold):
+    '''
+    入力を factor 倍にしたとき threshold 倍を超えて遅くなった段階を返す。
+    線形なら factor 倍前後、二乗なら factor**2 倍になる。
+    ごく短い段階は誤差が大きいので見ない。
+    '''
+    NOISE_FLOOR_SECONDS = 0.001
+    regressions = []
+    for stage in small:
+        if large[stage]<NOISE_FLOOR_SECONDS:
+            continue
+        ratio = large[stage] / max(small[stage], NOISE_FLOOR_SECONDS/factor)
+        if ratio>threshold:
+            regressions.append({'stage': stage, 'ratio': ratio})
+    return regressions
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--actions', default=200, type=int)
+    parser.add_argument('--years', default=2, type=int)
+    parser.add_argument('--events', default=20, type=int, help='1日あたりの回数')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--scaling-threshold', default=3.0, type=float,
+        help='--actions と --years を2倍にしたとき、これを超える倍率で遅くなったら退行とみなす')
+    parser.add_argument('--output', default='bench_output.json')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    FACTOR = 2
+    small = run_stages(args.actions, args.years, args.events, args.seed, args.repeat)
+    # years だけだと workspace(parse, detect)は大きくならないので、actions も増やす
+    large = run_stages(args.actions*FACTOR, args.years*FACTOR, args.events, args.seed, args.repeat)
+    regressions = check_scaling(small, large, FACTOR, args.scaling_threshold)
+
+    result = {
+        'config': {
+            'actions': args.actions,
+            'years': args.years,
+            'events': args.events,
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'python': sys.version.split()[0],
+        'timings': small,
+        'timings_scaled': large,
+        'scaling_factor': FACTOR,
+        'regressions': regressions,
+    }
+    counte.str2file(args.output, counte.dict2str(result, indent=2))
+
+    for stage in STAGES:
+        print(f'{small[stage]*1000:9.2f}ms {large[stage]*1000:9.2f}ms  {stage}')
+    for regression in regressions:
+        print(f'Regression! {regression["stage"]} x{regression["ratio"]:.2f}')
+    sys.exit(1 if regressions else 0)
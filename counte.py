@@ -1,17 +1,87 @@
-import datetime
-import json
+import bisect
 import os
+from array import array
 import sys
+import time
+
+'''
+起動を速くするため、重めのモジュール(json, datetime など)は使うところで import する。
+test.py の TestStartup で import 時間を見張っている。
+'''
 
 LINEBREAK = '\n'
+def _replace_file(filepath, mode, write, **kwargs):
+    '''
+    一時ファイルに書いてから os.replace で差し替える。
+    読む側から書きかけのファイルが見えることはない。
+    '''
+    temppath = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        with open(temppath, mode=mode, **kwargs) as f:
+            write(f)
+        os.replace(temppath, filepath)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
 def file2list(filepath):
     ret = []
     with open(filepath, encoding='utf8', mode='r') as f:
         ret = [line.rstrip('\n') for line in f.readlines()]
     return ret
 def list2file(filepath, ls):
-    with open(filepath, encoding='utf8', mode='w') as f:
-        f.writelines(['{:}\n'.format(line) for line in ls] )
+    write = lambda f: f.writelines(['{:}\n'.format(line) for line in ls] )
+    _replace_file(filepath, 'w', write, encoding='utf8')
+
+def file2iter(filepath):
+    ''' file2list の1行ずつ版。読み切ったところでファイルを閉じる '''
+    with open(filepath, encoding='utf8', mode='r') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+def _file_digest(filepath):
+    import hashlib
+    h = hashlib.sha1()
+    with open(filepath, mode='rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.digest()
+
+def iter2file_if_changed(filepath, lines):
+    '''
+    lines(ジェネレータでよい)を1行ずつ一時ファイルに流し込み、
+    既存のファイルと中身のハッシュが違うときだけ os.replace で差し替える。
+    同じなら既存のファイルには触らない(更新日時も変わらない)。
+
+    @return 差し替えたら True
+    '''
+    import hashlib
+    temppath = f'{filepath}.{os.getpid()}.tmp'
+    h = hashlib.sha1()
+    try:
+        # テキストモードの list2file と同じバイト列になるよう、改行は os.linesep にする
+        with open(temppath, mode='wb') as f:
+            for line in lines:
+                b = f'{line}{os.linesep}'.encode('utf8')
+                h.update(b)
+                f.write(b)
+        is_unchanged = os.path.exists(filepath) and _file_digest(filepath)==h.digest()
+        if is_unchanged:
+            os.remove(temppath)
+            return False
+        os.replace(temppath, filepath)
+        return True
+    except BaseException:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+def file2bytes(filepath):
+    with open(filepath, mode='rb') as f:
+        return f.read()
+def bytes2file(filepath, b):
+    _replace_file(filepath, 'wb', lambda f: f.write(b))
 
 def file2str(filepath):
     ret = ''
@@ -19,22 +89,101 @@ def file2str(filepath):
         ret = f.read()
     return ret
 def str2file(filepath, s):
-    with open(filepath, encoding='utf8', mode='w') as f:
-        f.write(s)
+    _replace_file(filepath, 'w', lambda f: f.write(s), encoding='utf8')
+def file2signature(filepath):
+    ''' (mtime, size)。変わっていたら誰かが書いたということ '''
+    st = os.stat(filepath)
+    return (st.st_mtime_ns, st.st_size)
 def str2dict(s):
+    import json
     return json.loads(s)
 def dict2str(d, **kwargs):
+    import json
     return json.dumps(d, **kwargs)
 
+'''
+内部では日付を day ordinal(datetime.date.toordinal() の int)で扱う。
+'yyyy/mm/dd' との変換は入出力のところだけで行い、結果はメモしておく。
+
+month は year*12 + (month-1) の int で扱う。
+'''
+_datestr2ordinal_memo = {}
+def datestr2ordinal(datestr):
+    notfound = datestr not in _datestr2ordinal_memo
+    if notfound:
+        import datetime
+        year, month, day = [int(elm) for elm in datestr.split('/')]
+        _datestr2ordinal_memo[datestr] = datetime.date(year, month, day).toordinal()
+    return _datestr2ordinal_memo[datestr]
+
+_ordinal2datestr_memo = {}
+def ordinal2datestr(ordinal):
+    notfound = ordinal not in _ordinal2datestr_memo
+    if notfound:
+        import datetime
+        _ordinal2datestr_memo[ordinal] = datetime.date.fromordinal(ordinal).strftime('%Y/%m/%d')
+    return _ordinal2datestr_memo[ordinal]
+
+_ordinal2month_memo = {}
+def ordinal2month(ordinal):
+    notfound = ordinal not in _ordinal2month_memo
+    if notfound:
+        import datetime
+        dt = datetime.date.fromordinal(ordinal)
+        _ordinal2month_memo[ordinal] = dt.year*12 + (dt.month-1)
+    return _ordinal2month_memo[ordinal]
+
+def month2datestr(month):
+    year, month_index = divmod(month, 12)
+    return f'{year:04d}/{month_index+1:02d}'
+
+def month2year(month):
+    return month // 12
+
+def year2datestr(year):
+    return f'{year:04d}'
+
+def datestr2month(datestr_without_day):
+    year, month = [int(elm) for elm in datestr_without_day.split('/')]
+    return year*12 + (month-1)
+
+def month2ordinal_range(month):
+    ''' @return (その月の1日, その月の末日) の ordinal '''
+    import datetime
+    year, month_index = divmod(month, 12)
+    ordinal_from = datetime.date(year, month_index+1, 1).toordinal()
+    year, month_index = divmod(month+1, 12)
+    ordinal_to = datetime.date(year, month_index+1, 1).toordinal() - 1
+    return (ordinal_from, ordinal_to)
+
+def ordinal2weekday(ordinal):
+    ''' datetime.weekday() と同じ(月曜日が0)。ordinal 1 は西暦1年1月1日(月曜日) '''
+    return (ordinal-1) % 7
+
+def ordinal2saturday(ordinal):
+    ''' ordinal が属する週(日曜始まり)の土曜日の ordinal '''
+    SAT = 5
+    days_until_saturday = (SAT - ordinal2weekday(ordinal)) % 7
+    return ordinal + days_until_saturday
+
 def datestr2dow_eng(datestr):
-    year, month, day = [int(elm) for elm in datestr.split('/')]
-    dt = datetime.datetime(year=year, month=month, day=day)
-    wd = dt.weekday()
+    wd = ordinal2weekday(datestr2ordinal(datestr))
     #dow_j = ['月',"火", "水", "木","金","土","日"][wd]
     dow_e = ['Mon',"Tue","Wed","Thu","Fri","Sat","Sun"][wd]
     return dow_e
 
-def parse_arguments():
+def positive_int(s):
+    ''' argparse の type。1 以上の int だけを通す '''
+    import argparse
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {s}')
+    if value<1:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {s}')
+    return value
+
+def parse_arguments(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(
@@ -44,8 +193,69 @@ def parse_arguments():
     parser.add_argument('--input-scb', default=None)
     parser.add_argument('--data-json', default=None)
     parser.add_argument('--report-directory', default=None)
+    parser.add_argument('--storage', default='json', choices=['json', 'log', 'binary', 'sqlite', 'sharded'],
+        help='log: postend を counte.json.log に追記するだけにする, binary: mmap で読めるバイナリで持つ, sqlite: sqlite3 のデータベースで持つ, sharded: 年ごとのファイルに分けて持つ')
+    parser.add_argument('--compact', default=False, action='store_true',
+        help='counte.json.log を counte.json に畳み込んで終わる(JSON のままの counte.json は --storage の形式に移し替える)')
+    parser.add_argument('--record-only', default=False, action='store_true',
+        help='記録だけしてレポートは作らない(--storage log なら過去データも読まない)')
+    parser.add_argument('--profile', default=False, action='store_true',
+        help='段階ごとの時間・回数・メモリのピークを report-directory の counte_profile.json に書く')
+    parser.add_argument('--profile-cprofile', default=False, action='store_true',
+        help='--profile に加えて、レポート作成の段階を cProfile で測って counte_report.prof に書く')
+    parser.add_argument('--watch', default=False, action='store_true',
+        help='終了せずに居座り、input-scb が保存されるたびに処理する')
+    parser.add_argument('--watch-interval', default=0.1, type=float,
+        help='--watch で input-scb の更新を確認する間隔(秒)')
+    parser.add_argument('--batch', default=None,
+        help='manifest(JSON) かディレクトリを与えて、複数の workspace をまとめて処理する')
+    parser.add_argument('--jobs', default=None, type=int,
+        help='--batch で使うプロセス数。省略時は CPU 数')
+    parser.add_argument('--daily-window', default=None, type=positive_int,
+        help='日次レポートを直近 N 日だけにする')
+    parser.add_argument('--weekly-window', default=None, type=positive_int,
+        help='週次レポートを直近 N 週だけにする')
+    parser.add_argument('--top', default=None, type=positive_int,
+        help='レポートの各セクションと leaderboard には回数の多い K 個の action だけを書く')
+
+    args = parser.parse_args(argv)
+    return args
+
+def parse_query_arguments(argv):
+    ''' python counte.py query <action> --from yyyy/mm/dd --to yyyy/mm/dd --by week '''
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='counte.py query',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument('action')
+    parser.add_argument('--from', dest='datestr_from', required=True, help='yyyy/mm/dd')
+    parser.add_argument('--to', dest='datestr_to', required=True, help='yyyy/mm/dd')
+    parser.add_argument('--by', default='total', choices=QUERY_PERIODS)
+    parser.add_argument('--data-json', required=True)
+    parser.add_argument('--storage', default='json', choices=['json', 'log', 'binary', 'sqlite', 'sharded'])
+
+    args = parser.parse_args(argv)
+    return args
+
+def parse_serve_arguments(argv):
+    ''' python counte.py serve --data-json counte.json --report-directory . --port 8765 '''
+    import argparse
 
-    args = parser.parse_args()
+    parser = argparse.ArgumentParser(
+        prog='counte.py serve',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument('--data-json', required=True)
+    parser.add_argument('--report-directory', required=True)
+    parser.add_argument('--storage', default='json', choices=['json', 'log', 'binary', 'sqlite', 'sharded'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+
+    args = parser.parse_args(argv)
     return args
 
 def abort(msg):
@@ -53,45 +263,56 @@ def abort(msg):
     sys.exit(1)
 
 class Timestamp:
+    __slots__ = ('_ordinal',)
+
     def __init__(self):
-        self._dtobj = None
+        self._ordinal = None
 
     def from_now(self):
-        self._dtobj = datetime.datetime.today()
+        self._ordinal = Timestamp.get_today_ordinal()
 
     def from_datestr(self, datestr):
-        year, month, day = [int(elm) for elm in datestr.split('/')]
-        dt = datetime.datetime(year=year, month=month, day=day)
-        self._dtobj = dt
+        self._ordinal = datestr2ordinal(datestr)
+
+    def from_ordinal(self, ordinal):
+        self._ordinal = ordinal
 
     def to_datestr(self):
-        if not self._dtobj:
+        if not self._ordinal:
             raise RuntimeError('Timestamp object is not from() yet.')
-        return self._dtobj.strftime('%Y/%m/%d')
+        return ordinal2datestr(self._ordinal)
+
+    def to_ordinal(self):
+        if not self._ordinal:
+            raise RuntimeError('Timestamp object is not from() yet.')
+        return self._ordinal
 
     def minus_day(self, day):
-        self._dtobj = self._dtobj - datetime.timedelta(days=day)
+        self._ordinal = self._ordinal - day
+
+    @staticmethod
+    def get_today_ordinal():
+        import datetime
+        return datetime.date.today().toordinal()
+
+    @staticmethod
+    def get_yesterday_ordinal():
+        return Timestamp.get_today_ordinal() - 1
 
     @staticmethod
     def get_today_datestr():
-        return datetime.datetime.today().strftime('%Y/%m/%d')
+        return ordinal2datestr(Timestamp.get_today_ordinal())
 
     @staticmethod
     def get_yesterday_datestr():
-        dt = datetime.datetime.today()
-        delta = datetime.timedelta(days=1)
-        dt = dt - delta
-        return dt.strftime('%Y/%m/%d')
+        return ordinal2datestr(Timestamp.get_yesterday_ordinal())
 
     @staticmethod
     def get_latest_7days_as_datestr(datestr):
-        timestamp = Timestamp()
-        timestamp.from_datestr(datestr)
+        ordinal = datestr2ordinal(datestr)
         datestrs = []
-        for _ in range(7):
-            datestrs.insert(0, timestamp.to_datestr())
-            一日ずつ減らしていく = 1
-            timestamp.minus_day(一日ずつ減らしていく)
+        for i in range(6, -1, -1):
+            datestrs.append(ordinal2datestr(ordinal-i))
         return datestrs
 
     @staticmethod
@@ -99,92 +320,184 @@ class Timestamp:
         l = len('yyyy/mm')
         return datestr[:l]
 
+class DateIndex:
+    '''
+    ある action の history を day ordinal の昇順 + 累積カウントで持つ索引。
+
+      ordinals   = [738663, 738664, 738665]
+      cumulative = [0, 1, 3, 4]
+    '''
+    __slots__ = ('_ordinals', '_cumulative')
+
+    def __init__(self, daycounts):
+        self._ordinals = sorted(daycounts)
+        self._cumulative = [0]
+        for ordinal in self._ordinals:
+            self._cumulative.append(self._cumulative[-1] + daycounts[ordinal])
+
+    def count_between(self, ordinal_from, ordinal_to):
+        ''' [ordinal_from, ordinal_to] の両端込みでカウントする '''
+        lo = bisect.bisect_left(self._ordinals, ordinal_from)
+        hi = bisect.bisect_right(self._ordinals, ordinal_to)
+        if hi<=lo:
+            return 0
+        return self._cumulative[hi] - self._cumulative[lo]
+
+    def items_between(self, ordinal_from, ordinal_to):
+        ''' [ordinal_from, ordinal_to] にある (ordinal, count) を、その範囲だけ見て返す '''
+        lo = bisect.bisect_left(self._ordinals, ordinal_from)
+        hi = bisect.bisect_right(self._ordinals, ordinal_to)
+        items = []
+        for i in range(lo, hi):
+            items.append((self._ordinals[i], self._cumulative[i+1] - self._cumulative[i]))
+        return items
+
+    @property
+    def ordinals(self):
+        return self._ordinals
+
 class ActionStore:
     '''
+    action ごとに日別カウント {day ordinal: count} で持つ。
     以下は3-history
-      action1 = ['2023/05/24', '2023/05/24', '2023/05/25']
-    
-    datestr
-      'yyyy/mm/dd'
+      action1 = {738664: 2, 738665: 1}  # 2023/05/24 x2, 2023/05/25 x1
+
+    datestr('yyyy/mm/dd')を取る/返すメソッドは入出力用で、中で ordinal に変換する。
+
+    区間カウントは DateIndex(必要になったときに作る)で引く。
     '''
     def __init__(self):
         self._dict = {}
+        self._counts = {}
+        self._indexes = {}
+        self._upper_ordinal = None
+
+    def add(self, action_name, datestr, count=1):
+        self.add_ordinal(action_name, datestr2ordinal(datestr), count)
 
-    def add(self, action_name, datestr):
+    def add_ordinal(self, action_name, ordinal, count=1):
         notfound = action_name not in self._dict
         if notfound:
-            self._dict[action_name] = []
-        history = self._dict[action_name]
-        history.append(datestr)
+            self._dict[action_name] = {}
+            self._counts[action_name] = 0
+        daycounts = self._dict[action_name]
+        daycounts[ordinal] = daycounts.get(ordinal, 0) + count
+        self._counts[action_name] += count
+        if self._upper_ordinal is None or ordinal>self._upper_ordinal:
+            self._upper_ordinal = ordinal
+        # 索引は次に引かれるときに作り直す
+        self._indexes.pop(action_name, None)
 
     def get_count(self, action_name):
         notfound = action_name not in self._dict
         if notfound:
             return 0
-        history = self._dict[action_name]
-        return len(history)
+        return self._counts[action_name]
+
+    @property
+    def count_total(self):
+        return sum(self._counts.values())
 
-    def _history_or_error(self, action_name):
+    def _daycounts_or_error(self, action_name):
         notfound = action_name not in self._dict
         if notfound:
             raise RuntimeError(f'action "{action_name}" not found.')
-        history = self._dict[action_name]
-        return history
+        daycounts = self._dict[action_name]
+        return daycounts
+
+    def get_daycounts(self, action_name):
+        ''' @return {datestr: count} '''
+        daycounts = self._daycounts_or_error(action_name)
+        return {ordinal2datestr(ordinal): daycounts[ordinal] for ordinal in daycounts}
+
+    def get_daycounts_by_ordinal(self, action_name):
+        ''' @return {day ordinal: count} '''
+        return self._daycounts_or_error(action_name)
+
+    def get_daycounts_between_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        ''' @return [ordinal_from, ordinal_to] だけの {day ordinal: count}。DateIndex で範囲だけ見る '''
+        index = self._index_or_error(action_name)
+        return dict(index.items_between(ordinal_from, ordinal_to))
+
+    @property
+    def upper_ordinal(self):
+        ''' 一番新しい日。空なら None '''
+        return self._upper_ordinal
+
+    def _index_or_error(self, action_name):
+        daycounts = self._daycounts_or_error(action_name)
+        notfound = action_name not in self._indexes
+        if notfound:
+            self._indexes[action_name] = DateIndex(daycounts)
+        return self._indexes[action_name]
 
     def get_daily_count(self, action_name, datestr_given):
-        history = self._history_or_error(action_name)
-        count = 0
-        for datestr_in_history in history:
-            if datestr_in_history==datestr_given:
-                count += 1
-        return count
+        daycounts = self._daycounts_or_error(action_name)
+        return daycounts.get(datestr2ordinal(datestr_given), 0)
 
-    def get_weekly_count(self, action_name, datestr_given):
-        history = self._history_or_error(action_name)
+    def get_range_count_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        index = self._index_or_error(action_name)
+        return index.count_between(ordinal_from, ordinal_to)
 
-        latest_7days_datestrs = Timestamp.get_latest_7days_as_datestr(datestr_given)
+    def get_range_count(self, action_name, datestr_from, datestr_to):
+        return self.get_range_count_by_ordinal(action_name,
+            datestr2ordinal(datestr_from), datestr2ordinal(datestr_to))
 
-        count = 0
-        for datestr_in_history in history:
-            for datestr_in_targetweek in  latest_7days_datestrs:
-                if datestr_in_history==datestr_in_targetweek:
-                    count += 1
-                    break
-        return count
+    def get_weekly_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self.get_range_count_by_ordinal(action_name, ordinal-6, ordinal)
 
     def get_monthly_count(self, action_name, datestr_without_day):
-        history = self._history_or_error(action_name)
+        ordinal_from, ordinal_to = month2ordinal_range(datestr2month(datestr_without_day))
+        return self.get_range_count_by_ordinal(action_name, ordinal_from, ordinal_to)
 
-        count = 0
-        for datestr_in_history in history:
-            datestr_without_day_in_history = Timestamp.remove_day_from_datestr(datestr_in_history)
-            a = datestr_without_day_in_history
-            b = datestr_without_day
-            if a==b:
-                count += 1
-        return count
+    @property
+    def action_names(self):
+        return list(self._dict)
 
     @property
     def actions(self):
+        ''' history は日付順に展開したものになる '''
         actions = []
         for k in self._dict:
             actionname = k
-            history = self._dict[k]
+            daycounts = self._dict[k]
             action = Action(actionname)
-            action.replace_history(history)
+            for ordinal in sorted(daycounts):
+                action.add_ordinal(ordinal, daycounts[ordinal])
             actions.append(action)
         return actions
 
 class Action:
+    '''
+    history は (day ordinal, count) の並びで持つ。x12 なら (今日, 12) の1つだけ。
+    1回ずつ展開した日付が欲しいときは history(datestr) か ordinals を使う。
+    (回数に比例して大きくなるので、表示したり返したりするのは datestr_counts にする)
+    '''
+    __slots__ = ('_name', '_ordinal_counts')
+
     def __init__(self, action_name):
         self._name = action_name
-        self._history = []
+        self._ordinal_counts = []
+
+    def add_datestr(self, datestr, count=1):
+        self.add_ordinal(datestr2ordinal(datestr), count)
 
-    def add_datestr(self, datestr):
-        self._history.append(datestr)
+    def add_ordinal(self, ordinal, count=1):
+        # 同じ日が続いたら(xx など)まとめる
+        is_same_day = len(self._ordinal_counts)>0 and self._ordinal_counts[-1][0]==ordinal
+        if is_same_day:
+            self._ordinal_counts[-1] = (ordinal, self._ordinal_counts[-1][1] + count)
+            return
+        self._ordinal_counts.append((ordinal, count))
 
     def replace_history(self, history):
-        self._history = history
+        self.replace_ordinals([datestr2ordinal(datestr) for datestr in history])
+
+    def replace_ordinals(self, ordinals):
+        self._ordinal_counts = []
+        for ordinal in ordinals:
+            self.add_ordinal(ordinal)
 
     @property
     def name(self):
@@ -192,12 +505,36 @@ class Action:
     
     @property
     def history(self):
-        return self._history
+        return [ordinal2datestr(ordinal) for ordinal in self.ordinals]
+
+    @property
+    def ordinals(self):
+        ordinals = []
+        for ordinal, count in self._ordinal_counts:
+            ordinals.extend([ordinal]*count)
+        return ordinals
+
+    @property
+    def ordinal_counts(self):
+        ''' @return [(day ordinal, count), ...] '''
+        return self._ordinal_counts
+
+    @property
+    def datestr_counts(self):
+        ''' @return [[datestr, count], ...] '''
+        return [[ordinal2datestr(ordinal), count] for ordinal, count in self._ordinal_counts]
+
+    @property
+    def count(self):
+        return sum(count for _, count in self._ordinal_counts)
 
 class PostendDetector:
     def __init__(self, workspace_reader, workspace_writer):
         self._reader = workspace_reader
         self._writer = workspace_writer
+        # 1回の実行の中では今日・昨日は変わらないものとして、最初に1回だけ求める
+        self._today = Timestamp.get_today_ordinal()
+        self._yesterday = self._today - 1
 
     def postended_actions(self):
         lines = self._reader.lines
@@ -222,6 +559,8 @@ class PostendDetector:
         x action(今日1回した)
         y action(昨日1回した)
         xx action(今日2回した)
+        x12 action(今日12回した)
+        x3y2 action(今日3回、昨日2回した)
 
         xxx action
         ^^^ ^^^^^^    1: mark
@@ -249,18 +588,240 @@ class PostendDetector:
         marks, action_name = line.split(' ', splitは最初の一回だけやる)
         action = Action(action_name)
 
-        todaystr = Timestamp.get_today_datestr()
-        yesterdaystr = Timestamp.get_yesterday_datestr()
-        for c in marks:
-            if c=='x':
-                action.add_datestr(todaystr)
-                continue
-            if c=='y':
-                action.add_datestr(yesterdaystr)
-                continue
+        ordinals = {'x': self._today, 'y': self._yesterday}
+        i = 0
+        while i<len(marks):
+            c = marks[i]
+            i += 1
+            # x/y の直後の数字は回数。無ければ1回
+            digits_begin = i
+            while i<len(marks) and marks[i].isdigit():
+                i += 1
+            count = 1
+            has_count = i>digits_begin
+            if has_count:
+                count = int(marks[digits_begin:i])
+            is_mark = c in ordinals and count>0
+            if is_mark:
+                action.add_ordinal(ordinals[c], count)
 
         return (POSTENDED, action)
 
+def _is_process_alive(pid):
+    ''' pid のプロセスがまだ動いているか(Windows では os.kill が止めてしまうので API で聞く) '''
+    if os.name=='nt':
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        ERROR_ACCESS_DENIED = 5
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return ctypes.get_last_error()==ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value==STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class FileLock:
+    '''
+    filepath + '.lock' を排他的に作れたらロックを取ったことにする(OS を問わず使える)。
+    取れなければ少し待って取り直し、timeout 秒で諦める。
+
+    ロックには「pid 取るたびに作る印」を書いておく。
+    stale_seconds より古く、かつ書いてある pid のプロセスがもういないロックだけを、
+    落ちたプロセスの残骸とみなして消す(長く持っているだけのロックは消さない)。
+    release() は自分の印が書いてあるときだけ消す。
+
+      with FileLock('counte.json'):
+          ...
+    '''
+    def __init__(self, filepath, timeout=30.0, stale_seconds=120.0, interval=0.01):
+        self._lockpath = f'{filepath}.lock'
+        self._timeout = timeout
+        self._stale_seconds = stale_seconds
+        self._interval = interval
+        self._owner = None
+
+    def _read_owner(self):
+        ''' @return ロックに書いてある印。無ければ None '''
+        try:
+            return file2str(self._lockpath)
+        except FileNotFoundError:
+            return None
+
+    def _remove_if_stale(self):
+        try:
+            age = time.time() - os.stat(self._lockpath).st_mtime
+            if age<=self._stale_seconds:
+                return
+            owner = self._read_owner()
+            if owner is None:
+                return
+            try:
+                pid = int(owner.split(' ')[0])
+            except ValueError:
+                # pid を書く前に落ちた
+                pid = None
+            if pid is not None and _is_process_alive(pid):
+                return
+            # 見ている間に他の実行が取り直していたら消さない
+            if self._read_owner()==owner:
+                os.remove(self._lockpath)
+        except OSError:
+            pass
+
+    def acquire(self):
+        deadline = time.perf_counter() + self._timeout
+        self._owner = f'{os.getpid()} {os.urandom(8).hex()}'
+        while True:
+            try:
+                fd = os.open(self._lockpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, self._owner.encode('utf8'))
+                os.close(fd)
+                return
+            except FileExistsError:
+                pass
+            self._remove_if_stale()
+            if time.perf_counter()>deadline:
+                raise RuntimeError(f'could not lock: {self._lockpath}')
+            time.sleep(self._interval)
+
+    def release(self):
+        if self._read_owner()!=self._owner:
+            return
+        os.remove(self._lockpath)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def postend_record_lines(actions):
+    '''
+    counte.json.log と counte.json.pending の行。action と日ごとに1行で、2回以上なら回数も書く。
+      ["2023/05/24", "action1"]
+      ["2023/05/24", "action1", 12]
+    '''
+    lines = []
+    for action in actions:
+        for ordinal, count in action.ordinal_counts:
+            record = [ordinal2datestr(ordinal), action.name]
+            if count!=1:
+                record.append(count)
+            lines.append(dict2str(record, ensure_ascii=False))
+    return lines
+
+def postend_record_from_line(line):
+    ''' @return (datestr, action_name, count) '''
+    record = str2dict(line)
+    datestr, action_name = record[:2]
+    count = 1
+    if len(record)>2:
+        count = record[2]
+    return (datestr, action_name, count)
+
+class PendingJournal:
+    '''
+    postend したけれどまだデータに畳み込んでいない分の置き場(counte.json.pending)。
+    書式は counte.json.log と同じ(postend_record_lines)。
+
+    workspace から消した postend はまずここに追記するので、
+    データへの書き込みを待っている間に落ちても失われない。
+    同時に動いている複数の実行の postend もここに溜まり、
+    データのロックを取った1つが read() してまとめて1回で書き、書けてから discard() する。
+    (書くのに失敗したら残しておき、次の実行が書く)
+    '''
+    def __init__(self, datajson_filename):
+        self._filepath = f'{datajson_filename}.pending'
+
+    def append(self, actions, commit=None):
+        '''
+        commit を与えると、追記してから commit() を呼ぶ。commit() が失敗したら追記を取り消す。
+        その間は journal をロックしたままなので、取り消すかもしれない分を他の実行が読むことはない。
+        '''
+        lines = postend_record_lines(actions)
+        if len(lines)==0:
+            if commit is not None:
+                commit()
+            return
+        with FileLock(self._filepath):
+            size_before = None
+            if os.path.exists(self._filepath):
+                size_before = os.path.getsize(self._filepath)
+            with open(self._filepath, encoding='utf8', mode='a') as f:
+                f.writelines(['{:}\n'.format(line) for line in lines])
+                f.flush()
+                os.fsync(f.fileno())
+            if commit is None:
+                return
+            try:
+                commit()
+            except BaseException:
+                self._truncate(size_before)
+                raise
+
+    def _truncate(self, size):
+        ''' size バイトに戻す。None なら(追記する前は無かったので)消す '''
+        if size is None:
+            os.remove(self._filepath)
+            return
+        with open(self._filepath, mode='r+b') as f:
+            f.truncate(size)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self):
+        '''
+        溜まっている分を Action にまとめて返す。ここでは消さない。
+        @return (actions, 読んだ行数) 行数は discard() に渡す
+        '''
+        with FileLock(self._filepath):
+            if not os.path.exists(self._filepath):
+                return [], 0
+            lines = file2list(self._filepath)
+        return self._lines_to_actions(lines), len(lines)
+
+    def discard(self, line_count):
+        ''' read() で読んだ先頭 line_count 行を消す。その後に他の実行が追記した分は残す '''
+        if line_count==0:
+            return
+        with FileLock(self._filepath):
+            rest = file2list(self._filepath)[line_count:]
+            if len(rest)==0:
+                os.remove(self._filepath)
+                return
+            list2file(self._filepath, rest)
+
+    @staticmethod
+    def _lines_to_actions(lines):
+        actions = {}
+        for line in lines:
+            is_empty_or_white = len(line.strip())==0
+            if is_empty_or_white:
+                continue
+            datestr, action_name, count = postend_record_from_line(line)
+            notfound = action_name not in actions
+            if notfound:
+                actions[action_name] = Action(action_name)
+            actions[action_name].add_datestr(datestr, count)
+        return list(actions.values())
+
+    @property
+    def filepath(self):
+        return self._filepath
+
 class WorkspaceReader:
     def __init__(self):
         self._lines = []
@@ -273,13 +834,20 @@ class WorkspaceReader:
         return self._lines
 
 class FileWorkspaceReader(WorkspaceReader):
+    '''
+    ファイル全体は読み込まない。lines を引くたびに頭から1行ずつ読むイテレータを返す。
+    '''
     def __init__(self):
         super().__init__()
+        self._filename = None
 
     def parse(self, obj):
         filename = obj
-        lines = file2list(filename)
-        self._lines = lines
+        self._filename = filename
+
+    @property
+    def lines(self):
+        return file2iter(self._filename)
 
 class WorkspaceWriter:
     def __init__(self):
@@ -290,7 +858,7 @@ class WorkspaceWriter:
 
     def add_from_actioname(self, action_name):
         line = f' {action_name}'
-        self._lines.append(line)
+        self.add_raw(line)
 
     def save(self, obj):
         raise NotImplementedError()
@@ -300,35 +868,94 @@ class WorkspaceWriter:
         return self._lines
 
 class FileWorkspaceWriter(WorkspaceWriter):
-    def __init__(self):
+    '''
+    filename を与えると行を溜めずに filename の隣の一時ファイルへそのまま書いていき、
+    save で os.replace して差し替える(読む側から書きかけは見えない)。
+    与えなければ行を溜めておき、save でまとめて書く。
+    '''
+    def __init__(self, filename=None):
         super().__init__()
+        self._temppath = None
+        self._tempfile = None
+        if filename is not None:
+            self._temppath = f'{filename}.{os.getpid()}.tmp'
+            self._tempfile = open(self._temppath, encoding='utf8', mode='w')
+
+    def add_raw(self, line):
+        is_buffered = self._tempfile is None
+        if is_buffered:
+            super().add_raw(line)
+            return
+        self._tempfile.write(f'{line}\n')
 
     def save(self, obj):
         filename = obj
-        list2file(filename, self._lines)
+        is_buffered = self._tempfile is None
+        if is_buffered:
+            list2file(filename, self._lines)
+            return
+        self._tempfile.close()
+        self._tempfile = None
+        try:
+            os.replace(self._temppath, filename)
+        except BaseException:
+            os.remove(self._temppath)
+            raise
+
+    def discard(self):
+        ''' save せずにやめる。書きかけの一時ファイルを消す '''
+        if self._tempfile is None:
+            return
+        self._tempfile.close()
+        self._tempfile = None
+        os.remove(self._temppath)
 
 class ActionStorage:
+    '''
+    counte.json の中身。
+
+    v2(今の形式): action ごとに日別カウント
+      {"action1": {"2023/05/24": 2, "2023/05/25": 1}}
+    v1(昔の形式): 1回ごとに datestr を並べる
+      {"action1": ["2023/05/24", "2023/05/24", "2023/05/25"]}
+
+    v1 も読めて、読んだ時点で v2 に変換する(次に書くときは v2 になる)。
+    '''
     def __init__(self, d):
         self._dict = d
 
+    @staticmethod
+    def _migrate_from_v1(d):
+        migrated = {}
+        for actionname in d:
+            history_or_daycounts = d[actionname]
+            is_v1 = isinstance(history_or_daycounts, list)
+            if not is_v1:
+                migrated[actionname] = history_or_daycounts
+                continue
+            daycounts = {}
+            for datestr in history_or_daycounts:
+                daycounts[datestr] = daycounts.get(datestr, 0) + 1
+            migrated[actionname] = daycounts
+        return migrated
+
     @staticmethod
     def from_jsonstring(jsonstr):
         is_empty_or_white = len(jsonstr.strip())==0
         if is_empty_or_white:
             d = {}
         else:
-            d = json.loads(jsonstr)
+            d = str2dict(jsonstr)
+        d = ActionStorage._migrate_from_v1(d)
         actionstorage = ActionStorage(d)
         return actionstorage
 
     @staticmethod
     def from_actionstore(actionstore):
-        actions = actionstore.actions
         d = {}
-        for action in actions:
-            name = action.name
-            history = action.history
-            d[name] = history
+        for name in actionstore.action_names:
+            daycounts = actionstore.get_daycounts(name)
+            d[name] = dict(daycounts)
         actionstorage = ActionStorage(d)
         return actionstorage
 
@@ -336,227 +963,2674 @@ class ActionStorage:
         actionstore = ActionStore()
         for k in self._dict:
             actionname = k
-            history = self._dict[k]
-            for datestr in history:
-                actionstore.add(actionname, datestr)
+            daycounts = self._dict[k]
+            for datestr in daycounts:
+                actionstore.add(actionname, datestr, daycounts[datestr])
         return actionstore
 
     def to_jsonstring_pretty(self, indent):
-        s = json.dumps(self._dict, indent=indent, sort_keys=True, ensure_ascii=False)
+        s = dict2str(self._dict, indent=indent, sort_keys=True, ensure_ascii=False)
         return s
 
-class Report:
-    def __init__(self, actionstore):
-        self._actionstore = actionstore
-        self._parse()
+    def to_binarybytes(self):
+        ''' BinaryHistory の形式にする '''
+        def ordinal_count_pairs_of(name):
+            daycounts = self._dict[name]
+            return sorted((datestr2ordinal(datestr), daycounts[datestr]) for datestr in daycounts)
+        return BinaryHistory.to_binarybytes(list(self._dict), ordinal_count_pairs_of)
 
-    def _parse(self):
-        acst = self._actionstore
+    @staticmethod
+    def open_binary(filepath):
+        return BinaryHistory.open(filepath)
 
-        datestrs = []
-        for action in acst.actions:
-            for datestr in action.history:
-                datestrs.append(datestr)
-        datestrs.sort()
-        self._lower_datestr = datestrs[0]
-        self._upper_datestr = datestrs[-1]
-        self._count_total = len(datestrs)
+class BinaryHistory:
+    '''
+    ActionStorage.to_binarybytes() で作ったバイナリを、コピーせずにそのまま読む。
+    ActionStore と同じ get_xxxx_count 系で引ける(書き換えはできない)。
 
-        datestrs_without_duplicate = sorted(list(set(datestrs)))
+    header      magic, byteorder mark, action数, record数
+    offsets     u32 x (action数+1)  action i の record は [offsets[i], offsets[i+1])
+    days        u32 x record数      day ordinal(action 内で昇順)
+    cumulative  u64 x record数      action 内での累積カウント
+    names       action名の JSON 配列(utf8)
+
+    day ordinal は datetime.date.toordinal() の値。
+    前の形式(magic が CNTE、cumulative が u32)も読める。
+    '''
+    MAGIC = b'CNT2'
+    MAGIC_U32_CUMULATIVE = b'CNTE'
+    BYTEORDER_MARK = 0x01020304
+    HEADER_FORMAT = '=4sIII'
+
+    def __init__(self, buffer):
+        self._mmap = None
+        self._names = []
+        self._name2id = {}
+        self._offsets = []
+        self._days = []
+        self._cumulative = []
+        self._views = []
+        if len(buffer)==0:
+            return
+
+        import array
+        import struct
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        magic, byteorder_mark, action_count, record_count = struct.unpack_from(self.HEADER_FORMAT, buffer)
+        if magic not in (self.MAGIC, self.MAGIC_U32_CUMULATIVE):
+            raise RuntimeError('not a counte binary.')
+        if byteorder_mark!=self.BYTEORDER_MARK:
+            raise RuntimeError('counte binary was written with another byte order.')
+
+        view = memoryview(buffer)
+        itemsize = array.array('I').itemsize
+        pos = header_size
+        offsets = view[pos:pos+(action_count+1)*itemsize].cast('I')
+        pos += (action_count+1)*itemsize
+        days = view[pos:pos+record_count*itemsize].cast('I')
+        pos += record_count*itemsize
+        cumulative_format = 'Q' if magic==self.MAGIC else 'I'
+        cumulative_itemsize = array.array(cumulative_format).itemsize
+        cumulative = view[pos:pos+record_count*cumulative_itemsize].cast(cumulative_format)
+        pos += record_count*cumulative_itemsize
+        names = str2dict(bytes(view[pos:]).decode('utf8'))
+
+        self._views = [view, offsets, days, cumulative]
+        self._offsets = offsets
+        self._days = days
+        self._cumulative = cumulative
+        self._names = names
+        self._name2id = {name: i for i, name in enumerate(names)}
 
+    @staticmethod
+    def to_binarybytes(names, ordinal_count_pairs_of):
         '''
-        2023/02/11
-         [action1, 2],
-         [action2, 1],
-         [action3, 4],
+        @param ordinal_count_pairs_of name -> [(day ordinal, count), ...] 昇順
+        action を1つずつ引くので、全部を ActionStore に読み込まなくても作れる
         '''
-        datestr_actionname_dict = {}
+        import array
+        import struct
 
-        for datestr in datestrs_without_duplicate:
-            for action in acst.actions:
-                count = 0
-                for datestr_of_action in action.history:
-                    if datestr==datestr_of_action:
-                        count += 1
-                if count==0:
-                    continue
-                k = datestr
-                notfound = not k in datestr_actionname_dict
-                if notfound:
-                    datestr_actionname_dict[k] = []
-                v = [action.name, count]
-                datestr_actionname_dict[k].append(v)
-        self._dailycounts = datestr_actionname_dict
+        offsets = array.array('I', [0])
+        days = array.array('I')
+        cumulative = array.array('Q')
+        for name in names:
+            total = 0
+            for ordinal, count in ordinal_count_pairs_of(name):
+                total += count
+                days.append(ordinal)
+                cumulative.append(total)
+            offsets.append(len(days))
+
+        header = struct.pack(BinaryHistory.HEADER_FORMAT,
+            BinaryHistory.MAGIC, BinaryHistory.BYTEORDER_MARK, len(names), len(days))
+        names_bytes = dict2str(names, ensure_ascii=False).encode('utf8')
+        return b''.join([
+            header,
+            offsets.tobytes(),
+            days.tobytes(),
+            cumulative.tobytes(),
+            names_bytes,
+        ])
 
-        '''
-        weekは土曜日基点にする。
-        日曜日に週次レビューを行う場合、見たいのは先週日曜日から今週土曜日まで。
-        '''
-        weekly_target_datestrs = []
-        for datestr in datestrs_without_duplicate:
-            year, month, day = [int(x) for x in datestr.split('/')]
-            dt = datetime.datetime(year=year, month=month, day=day)
-            wd = dt.weekday()
-            #SUN = 6
-            SAT = 5
-            if wd!=SAT:
-                continue
-            weekly_target_datestrs.append(datestr)
-        datestr_actionname_dict = {}
-        for sunday_datestr in weekly_target_datestrs:
-            for action in acst.actions:
-                count = acst.get_weekly_count(action.name, sunday_datestr)
-                if count==0:    
-                    continue
-                k = sunday_datestr
-                notfound = not k in datestr_actionname_dict
-                if notfound:
-                    datestr_actionname_dict[k] = []
-                v = [action.name, count]
-                datestr_actionname_dict[k].append(v)
-        self._weeklycounts = datestr_actionname_dict
-
-        monthly_datestrs = []
-        for datestr in datestrs_without_duplicate:
-            l = len('yyyy/mm')
-            monthpart = datestr[:l]
-            monthly_datestrs.append(monthpart)
-        monthly_datestrs_without_duplicate = sorted(list(set(monthly_datestrs)))
-        datestr_actionname_dict = {}
-        for monthly_datestr in monthly_datestrs_without_duplicate:
-            for action in acst.actions:
-                count = acst.get_monthly_count(action.name, monthly_datestr)
-                if count==0:
-                    continue
-                k = monthly_datestr
-                notfound = not k in datestr_actionname_dict
-                if notfound:
-                    datestr_actionname_dict[k] = []
-                v = [action.name, count]
-                datestr_actionname_dict[k].append(v)
-        self._monthlycounts = datestr_actionname_dict
+    @staticmethod
+    def open(filepath):
+        with open(filepath, mode='rb') as f:
+            is_empty = os.fstat(f.fileno()).st_size==0
+            if is_empty:
+                return BinaryHistory(b'')
+            import mmap
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        history = BinaryHistory(mm)
+        history._mmap = mm
+        return history
 
-    @property
-    def dailycounts(self):
-        return self._dailycounts
-    @property
-    def weeklycounts(self):
-        return self._weeklycounts
-    @property
-    def monthlycounts(self):
-        return self._monthlycounts
+    def close(self):
+        # mmap を閉じる前に memoryview を全部手放す必要がある
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
 
-    @property
-    def lower_datestr(self):
-        return self._lower_datestr
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _range_or_error(self, action_name):
+        notfound = action_name not in self._name2id
+        if notfound:
+            raise RuntimeError(f'action "{action_name}" not found.')
+        action_id = self._name2id[action_name]
+        return (self._offsets[action_id], self._offsets[action_id+1])
+
+    def _cumulative_before(self, lo, i):
+        if i<=lo:
+            return 0
+        return self._cumulative[i-1]
+
+    def _count_between_ordinals(self, action_name, ordinal_from, ordinal_to):
+        lo, hi = self._range_or_error(action_name)
+        left = bisect.bisect_left(self._days, ordinal_from, lo, hi)
+        right = bisect.bisect_right(self._days, ordinal_to, lo, hi)
+        if right<=left:
+            return 0
+        return self._cumulative_before(lo, right) - self._cumulative_before(lo, left)
 
     @property
-    def upper_datestr(self):
-        return self._upper_datestr
+    def action_names(self):
+        return list(self._names)
+
+    def get_count(self, action_name):
+        notfound = action_name not in self._name2id
+        if notfound:
+            return 0
+        lo, hi = self._range_or_error(action_name)
+        return self._cumulative_before(lo, hi)
 
     @property
     def count_total(self):
-        return self._count_total
+        return sum(self.get_count(name) for name in self._names)
+
+    def get_daycounts_by_ordinal(self, action_name):
+        lo, hi = self._range_or_error(action_name)
+        daycounts = {}
+        for i in range(lo, hi):
+            count = self._cumulative[i] - self._cumulative_before(lo, i)
+            daycounts[self._days[i]] = count
+        return daycounts
+
+    def get_daycounts_between_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        lo, hi = self._range_or_error(action_name)
+        left = bisect.bisect_left(self._days, ordinal_from, lo, hi)
+        right = bisect.bisect_right(self._days, ordinal_to, lo, hi)
+        daycounts = {}
+        for i in range(left, right):
+            daycounts[self._days[i]] = self._cumulative[i] - self._cumulative_before(lo, i)
+        return daycounts
 
-class FileReport:
-    def __init__(self, report):
-        self._report = report
-        self._parse()
+    @property
+    def upper_ordinal(self):
+        upper = None
+        for action_id in range(len(self._names)):
+            lo, hi = self._offsets[action_id], self._offsets[action_id+1]
+            if hi<=lo:
+                continue
+            if upper is None or self._days[hi-1]>upper:
+                upper = self._days[hi-1]
+        return upper
 
-    def _parse(self):
-        self._daily()
-        self._weekly()
+    def get_daycounts(self, action_name):
+        daycounts = self.get_daycounts_by_ordinal(action_name)
+        return {ordinal2datestr(ordinal): daycounts[ordinal] for ordinal in daycounts}
+
+    def get_daily_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self._count_between_ordinals(action_name, ordinal, ordinal)
+
+    def get_range_count_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        return self._count_between_ordinals(action_name, ordinal_from, ordinal_to)
+
+    def get_range_count(self, action_name, datestr_from, datestr_to):
+        return self._count_between_ordinals(action_name,
+            datestr2ordinal(datestr_from), datestr2ordinal(datestr_to))
+
+    def get_weekly_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self._count_between_ordinals(action_name, ordinal-6, ordinal)
+
+    def get_monthly_count(self, action_name, datestr_without_day):
+        ordinal_from, ordinal_to = month2ordinal_range(datestr2month(datestr_without_day))
+        return self._count_between_ordinals(action_name, ordinal_from, ordinal_to)
+
+    def to_actionstore(self):
+        actionstore = ActionStore()
+        for name in self._names:
+            daycounts = self.get_daycounts_by_ordinal(name)
+            for ordinal in daycounts:
+                actionstore.add_ordinal(name, ordinal, daycounts[ordinal])
+        return actionstore
+
+class SqliteHistory:
+    '''
+    SqliteStorageBackend のデータベースを、読み込まずにそのまま引く。
+    ActionStore と同じ get_xxxx_count 系で引ける(書き換えはできない)。
+
+    どの問い合わせも events の索引 (action_id, day) か (day) を使う SUM / GROUP BY になる。
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+        rows = connection.execute('SELECT id, name FROM actions ORDER BY id').fetchall()
+        self._names = [name for _, name in rows]
+        self._name2id = {name: action_id for action_id, name in rows}
 
     @staticmethod
-    def sort_to_most_counted(action_count_pairs):
-        out = sorted(action_count_pairs, key=lambda elm:elm[1])
-        out.reverse()
-        return out
+    def open(filepath):
+        return SqliteHistory(SqliteStorageBackend.connect(filepath))
 
-    def _lines_by_DescOrder_and_MostCounted(self, xxxxcounts):
-        outlines = []
+    def close(self):
+        self._connection.close()
 
-        datestrs = []
-        for datestr in xxxxcounts:
-            datestrs.append(datestr)
-        datestrs.sort()
-        # 最新日を上に書きたいので降順にする
-        datestrs.reverse()
+    def __enter__(self):
+        return self
 
-        for datestr in datestrs:
-            dow = datestr2dow_eng(datestr)
-            action_count_pairs = xxxxcounts[datestr]
-            total = 0
-            for pair in action_count_pairs:
-                _, count = pair
-                total += count
-            out = f'{datestr} {dow} {total}'
-            outlines.append(out)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-            INDENT = ' '
-            BLANK_LINE = ''
-            pairs = self.sort_to_most_counted(action_count_pairs)
-            for pair in pairs:
-                name, count = pair
-                out = f'{INDENT}{count} {name}'
-                outlines.append(out)
-            outlines.append(BLANK_LINE)
+    def _id_or_error(self, action_name):
+        notfound = action_name not in self._name2id
+        if notfound:
+            raise RuntimeError(f'action "{action_name}" not found.')
+        return self._name2id[action_name]
 
-        return outlines
+    def _count_between_ordinals(self, action_name, ordinal_from, ordinal_to):
+        action_id = self._id_or_error(action_name)
+        row = self._connection.execute(
+            'SELECT SUM(count) FROM events WHERE action_id=? AND day BETWEEN ? AND ?',
+            (action_id, ordinal_from, ordinal_to)).fetchone()
+        return row[0] or 0
 
-    def _daily(self):
-        outlines = self._lines_by_DescOrder_and_MostCounted(self._report.dailycounts)
-        self._dailycounts_by_lines = outlines
+    @property
+    def action_names(self):
+        return list(self._names)
 
-    def _weekly(self):
-        outlines = self._lines_by_DescOrder_and_MostCounted(self._report.weeklycounts)
-        self._weeklycounts_by_lines = outlines
+    def get_count(self, action_name):
+        notfound = action_name not in self._name2id
+        if notfound:
+            return 0
+        row = self._connection.execute(
+            'SELECT SUM(count) FROM events WHERE action_id=?', (self._name2id[action_name],)).fetchone()
+        return row[0] or 0
 
     @property
-    def dailycounts_by_lines(self):
-        return self._dailycounts_by_lines
+    def count_total(self):
+        row = self._connection.execute('SELECT SUM(count) FROM events').fetchone()
+        return row[0] or 0
+
+    def get_daycounts_by_ordinal(self, action_name):
+        action_id = self._id_or_error(action_name)
+        rows = self._connection.execute(
+            'SELECT day, SUM(count) FROM events WHERE action_id=? GROUP BY day ORDER BY day',
+            (action_id,))
+        return dict(rows)
+
+    def get_daycounts_between_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        action_id = self._id_or_error(action_name)
+        rows = self._connection.execute(
+            'SELECT day, SUM(count) FROM events WHERE action_id=? AND day BETWEEN ? AND ? GROUP BY day ORDER BY day',
+            (action_id, ordinal_from, ordinal_to))
+        return dict(rows)
 
     @property
-    def weeklycounts_by_lines(self):
-        return self._weeklycounts_by_lines
+    def upper_ordinal(self):
+        row = self._connection.execute('SELECT MAX(day) FROM events').fetchone()
+        return row[0]
 
-if __name__ == "__main__":
-    args = parse_arguments()
+    def get_daycounts(self, action_name):
+        daycounts = self.get_daycounts_by_ordinal(action_name)
+        return {ordinal2datestr(ordinal): daycounts[ordinal] for ordinal in daycounts}
 
-    input_filename = args.input_scb
-    datajson_filename = args.data_json
-    report_directory = args.report_directory
+    def get_daily_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self._count_between_ordinals(action_name, ordinal, ordinal)
 
-    if not os.path.exists(input_filename):
-        abort(f'input-scb invalid: {input_filename}')
-    if not os.path.exists(report_directory):
-        abort(f'report-directory invalid: {report_directory}')
-    if not os.path.exists(datajson_filename):
-        emptyfile = []
-        list2file(datajson_filename, emptyfile)
+    def get_range_count_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        return self._count_between_ordinals(action_name, ordinal_from, ordinal_to)
+
+    def get_range_count(self, action_name, datestr_from, datestr_to):
+        return self._count_between_ordinals(action_name,
+            datestr2ordinal(datestr_from), datestr2ordinal(datestr_to))
+
+    def get_weekly_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self._count_between_ordinals(action_name, ordinal-6, ordinal)
+
+    def get_monthly_count(self, action_name, datestr_without_day):
+        ordinal_from, ordinal_to = month2ordinal_range(datestr2month(datestr_without_day))
+        return self._count_between_ordinals(action_name, ordinal_from, ordinal_to)
+
+    def to_actionstore(self):
+        actionstore = ActionStore()
+        rows = self._connection.execute(
+            'SELECT action_id, day, SUM(count) FROM events GROUP BY action_id, day ORDER BY action_id, day')
+        # action の順は id の順(初めて postend した順)になる
+        id2name = {action_id: name for name, action_id in self._name2id.items()}
+        for action_id, ordinal, count in rows:
+            actionstore.add_ordinal(id2name[action_id], ordinal, count)
+        return actionstore
+
+class StorageBackend:
+    '''
+    ActionStore をどこに永続化するか。
+    load() で読み、record() で postend 分を書き込む。
+
+    RECORD_NEEDS_ACTIONSTORE が False なら record() は postended_actions しか見ないので、
+    記録だけしたいときは load() しなくてよい。
+
+    HAS_QUERYABLE_HISTORY が True なら、open_history() で読み込まずに引ける history を開ける。
+    集計はそちらから引くので、load() は一度もしない。
+
+    JSON 以外の形式で持つ backend は、filepath がまだ counte.json(JSON)なら is_json_data() が True になり、
+    import_json_data()(--compact)でその中身を自分の形式に移し替えられる。
+    '''
+    RECORD_NEEDS_ACTIONSTORE = True
+    HAS_QUERYABLE_HISTORY = False
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+
+    def load(self):
+        raise NotImplementedError()
 
-    ws_reader = FileWorkspaceReader()
-    ws_writer = FileWorkspaceWriter()
-    ws_reader.parse(input_filename)
-    detector = PostendDetector(ws_reader, ws_writer)
-    postended_actions = detector.postended_actions()
+    def record(self, actionstore, postended_actions):
+        ''' actionstore は postended_actions を反映済みのもの '''
+        raise NotImplementedError()
+
+    def open_history(self):
+        raise NotImplementedError()
+
+    def compact(self):
+        pass
+
+    def is_json_data(self):
+        return False
+
+    def _starts_like_json(self):
+        ''' バイナリや sqlite3 のファイルは '{' では始まらない '''
+        if not os.path.exists(self._filepath):
+            return False
+        with open(self._filepath, mode='rb') as f:
+            head = f.read(64).lstrip()
+        return head.startswith(b'{')
+
+    def import_json_data(self):
+        '''
+        filepath がまだ counte.json の形式なら、中身をこの backend の形式に移し替える。
+        元のファイルは filepath.json.bak に残す。途中で失敗したら元に戻す。
+        @return 移し替えたか
+        '''
+        if not self.is_json_data():
+            return False
+        actionstore = JsonStorageBackend(self._filepath).load()
+        backuppath = f'{self._filepath}.json.bak'
+        os.replace(self._filepath, backuppath)
+        try:
+            self.record(None, actionstore.actions)
+        except BaseException:
+            self._remove_partial_import(actionstore)
+            os.replace(backuppath, self._filepath)
+            raise
+        return True
+
+    def _remove_partial_import(self, actionstore):
+        if os.path.exists(self._filepath):
+            os.remove(self._filepath)
+
+    def _filepaths(self):
+        return [self._filepath]
+
+    def signature(self):
+        ''' 持っているファイルの (mtime, size)。変わっていたら誰かが書いたということ '''
+        signature = []
+        for filepath in self._filepaths():
+            if not os.path.exists(filepath):
+                signature.append(None)
+                continue
+            st = os.stat(filepath)
+            signature.append((st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+class JsonStorageBackend(StorageBackend):
+    ''' 毎回 counte.json を丸ごと書き直す '''
+    def __init__(self, filepath):
+        super().__init__(filepath)
+
+    def load(self):
+        if not os.path.exists(self._filepath):
+            return ActionStore()
+        jsonstr = file2str(self._filepath)
+        actionstorage = ActionStorage.from_jsonstring(jsonstr)
+        return actionstorage.to_actionstore()
+
+    def record(self, actionstore, postended_actions):
+        actionstorage = ActionStorage.from_actionstore(actionstore)
+        jsonstr = actionstorage.to_jsonstring_pretty(indent=2)
+        str2file(self._filepath, jsonstr)
+
+class LogStorageBackend(StorageBackend):
+    '''
+    counte.json(スナップショット) + counte.json.log(追記のみ) で持つ。
+
+    log は postend した action/date 1件につき1行(postend_record_lines)。
+      ["2023/05/24", "action1"]
+      ["2023/05/24", "action1", 12]
+
+    毎回の書き込みは log への追記だけ。
+    compact() で log をスナップショットに畳み込んで log を空にする。
+
+    compact() の途中で落ちても二重計上も数え落としもしないよう、
+      1: log を counte.json.log.compacting に移す
+      2: スナップショット + compacting を counte.json.next に書く
+      3: compacting を消す
+      4: next でスナップショットを差し替える
+    とする。next があれば compacting はもう next に入っているので、load() はそちらを見る。
+    '''
+    RECORD_NEEDS_ACTIONSTORE = False
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self._logpath = f'{filepath}.log'
+        self._compactingpath = f'{filepath}.log.compacting'
+        self._nextpath = f'{filepath}.next'
+        self._snapshot = JsonStorageBackend(filepath)
+
+    def load(self):
+        if os.path.exists(self._nextpath):
+            actionstore = JsonStorageBackend(self._nextpath).load()
+        else:
+            actionstore = self._snapshot.load()
+            self._add_log(actionstore, self._compactingpath)
+        self._add_log(actionstore, self._logpath)
+        return actionstore
+
+    @staticmethod
+    def _add_log(actionstore, logpath):
+        if not os.path.exists(logpath):
+            return
+        with open(logpath, encoding='utf8', mode='r') as f:
+            for line in f:
+                is_empty_or_white = len(line.strip())==0
+                if is_empty_or_white:
+                    continue
+                datestr, action_name, count = postend_record_from_line(line)
+                actionstore.add(action_name, datestr, count)
+
+    def record(self, actionstore, postended_actions):
+        lines = postend_record_lines(postended_actions)
+        with open(self._logpath, encoding='utf8', mode='a') as f:
+            f.writelines(['{:}\n'.format(line) for line in lines])
+
+    def compact(self):
+        # 前の compact() が途中で落ちていたら、その続きから
+        self._replace_snapshot_with_next()
+        if os.path.exists(self._compactingpath):
+            self._compact_aside()
+
+        if not os.path.exists(self._logpath):
+            return
+        os.replace(self._logpath, self._compactingpath)
+        emptyfile = []
+        list2file(self._logpath, emptyfile)
+        self._compact_aside()
+
+    def _compact_aside(self):
+        actionstore = self._snapshot.load()
+        self._add_log(actionstore, self._compactingpath)
+        JsonStorageBackend(self._nextpath).record(actionstore, [])
+        os.remove(self._compactingpath)
+        self._replace_snapshot_with_next()
+
+    def _replace_snapshot_with_next(self):
+        if not os.path.exists(self._nextpath):
+            return
+        # next に入っているので、compacting が残っていれば捨てる
+        if os.path.exists(self._compactingpath):
+            os.remove(self._compactingpath)
+        os.replace(self._nextpath, self._filepath)
+
+    def _filepaths(self):
+        return [self._filepath, self._logpath, self._compactingpath, self._nextpath]
+
+    @property
+    def logpath(self):
+        return self._logpath
+
+class BinaryStorageBackend(StorageBackend):
+    '''
+    BinaryHistory の形式で持つ。
+    集計は open_history() で mmap した BinaryHistory からそのまま引く(ActionStore に読み込まない)。
+    record() は今のファイルを mmap したまま action ごとに postend 分を足し、新しいファイルを書いて差し替える。
+    '''
+    RECORD_NEEDS_ACTIONSTORE = False
+    HAS_QUERYABLE_HISTORY = True
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+
+    def open_history(self):
+        if not os.path.exists(self._filepath):
+            return BinaryHistory(b'')
+        return BinaryHistory.open(self._filepath)
+
+    def is_json_data(self):
+        return self._starts_like_json()
+
+    def load(self):
+        with self.open_history() as history:
+            return history.to_actionstore()
+
+    def record(self, actionstore, postended_actions):
+        pending = {}
+        for action in postended_actions:
+            daycounts = pending.setdefault(action.name, {})
+            for ordinal, count in action.ordinal_counts:
+                daycounts[ordinal] = daycounts.get(ordinal, 0) + count
+
+        with self.open_history() as history:
+            names = history.action_names
+            known = set(names)
+            names.extend(name for name in pending if name not in known)
+
+            def ordinal_count_pairs_of(name):
+                daycounts = history.get_daycounts_by_ordinal(name) if name in known else {}
+                added = pending.get(name, {})
+                for ordinal in added:
+                    daycounts[ordinal] = daycounts.get(ordinal, 0) + added[ordinal]
+                return sorted(daycounts.items())
+            binarybytes = BinaryHistory.to_binarybytes(names, ordinal_count_pairs_of)
+        # mmap を閉じてから差し替える(Windows では開いたままだと置き換えられない)
+        bytes2file(self._filepath, binarybytes)
+
+class SqliteStorageBackend(StorageBackend):
+    '''
+    sqlite3 のデータベースに、postend を action と日ごとに events の1行として持つ(x12 なら count=12 の1行)。
+
+      actions(id, name)
+      events(action_id, day, count)    day は day ordinal。(action_id, day) と (day) に索引
+
+    書き込みは postend 分(action と日ごとに1行)を1つのトランザクションで INSERT するだけなので、load() しなくてよい。
+    集計は open_history() で開いた SqliteHistory から索引で引く(全部を読み込まない)。
+    compact() は同じ (action_id, day) の行を1行に畳んで VACUUM する。
+    '''
+    RECORD_NEEDS_ACTIONSTORE = False
+    HAS_QUERYABLE_HISTORY = True
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS actions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS events (action_id INTEGER NOT NULL, day INTEGER NOT NULL, count INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS events_action_day ON events (action_id, day)',
+        'CREATE INDEX IF NOT EXISTS events_day ON events (day)',
+    ]
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+
+    @staticmethod
+    def connect(filepath):
+        import sqlite3
+        connection = sqlite3.connect(filepath)
+        try:
+            with connection:
+                for sql in SqliteStorageBackend.SCHEMA:
+                    connection.execute(sql)
+        except sqlite3.DatabaseError as e:
+            connection.close()
+            raise RuntimeError(f'not a sqlite3 database: {filepath} ({e})')
+        return connection
+
+    def is_json_data(self):
+        return self._starts_like_json()
+
+    def open_history(self):
+        return SqliteHistory.open(self._filepath)
+
+    def load(self):
+        with self.open_history() as history:
+            return history.to_actionstore()
+
+    def record(self, actionstore, postended_actions):
+        connection = self.connect(self._filepath)
+        try:
+            with connection:
+                for action in postended_actions:
+                    connection.execute('INSERT OR IGNORE INTO actions (name) VALUES (?)', (action.name,))
+                    action_id, = connection.execute('SELECT id FROM actions WHERE name=?', (action.name,)).fetchone()
+                    rows = [(action_id, ordinal, count) for ordinal, count in action.ordinal_counts]
+                    connection.executemany('INSERT INTO events (action_id, day, count) VALUES (?, ?, ?)', rows)
+        finally:
+            connection.close()
+
+    def compact(self):
+        connection = self.connect(self._filepath)
+        try:
+            with connection:
+                connection.execute('CREATE TEMP TABLE folded AS '
+                    'SELECT action_id, day, SUM(count) AS count FROM events GROUP BY action_id, day')
+                connection.execute('DELETE FROM events')
+                connection.execute('INSERT INTO events (action_id, day, count) '
+                    'SELECT action_id, day, count FROM folded ORDER BY action_id, day')
+                connection.execute('DROP TABLE folded')
+            connection.execute('VACUUM')
+        finally:
+            connection.close()
+
+class ShardedHistory:
+    '''
+    ShardedStorageBackend のデータを、要る年の shard だけ読み込みながら引く。
+    ActionStore と同じ get_xxxx_count 系で引ける(書き換えはできない)。
+
+    action 名、回数、一番新しい日は manifest だけで答える。
+    日ごとのカウントが要るときに、その期間にかかる年の shard を初めて読む。
+    '''
+    def __init__(self, backend, manifest):
+        self._backend = backend
+        self._names = manifest['actions']
+        self._entries = {int(yearstr): manifest['shards'][yearstr] for yearstr in manifest['shards']}
+        self._shards = {}
+
+    def close(self):
+        self._shards = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _shard(self, year):
+        notfound = year not in self._shards
+        if notfound:
+            self._shards[year] = self._backend.load_shard(year)
+        return self._shards[year]
+
+    def _years_between(self, ordinal_from, ordinal_to):
+        year_from = month2year(ordinal2month(ordinal_from))
+        year_to = month2year(ordinal2month(ordinal_to))
+        return [year for year in sorted(self._entries) if year_from<=year<=year_to]
+
+    def _shards_having(self, action_name, ordinal_from, ordinal_to):
+        notfound = action_name not in self._names
+        if notfound:
+            raise RuntimeError(f'action "{action_name}" not found.')
+        shards = []
+        for year in self._years_between(ordinal_from, ordinal_to):
+            has_action = action_name in self._entries[year]['counts']
+            if has_action:
+                shards.append(self._shard(year))
+        return shards
+
+    @property
+    def action_names(self):
+        return list(self._names)
+
+    def get_count(self, action_name):
+        return sum(entry['counts'].get(action_name, 0) for entry in self._entries.values())
+
+    @property
+    def count_total(self):
+        return sum(sum(entry['counts'].values()) for entry in self._entries.values())
+
+    @property
+    def upper_ordinal(self):
+        if len(self._entries)==0:
+            return None
+        return max(datestr2ordinal(entry['upper_datestr']) for entry in self._entries.values())
+
+    @property
+    def loaded_years(self):
+        ''' ここまでに読み込んだ shard の年 '''
+        return sorted(self._shards)
+
+    def get_daycounts_between_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        daycounts = {}
+        for shard in self._shards_having(action_name, ordinal_from, ordinal_to):
+            daycounts.update(shard.get_daycounts_between_by_ordinal(action_name, ordinal_from, ordinal_to))
+        return daycounts
+
+    def get_daycounts_by_ordinal(self, action_name):
+        daycounts = {}
+        for year in sorted(self._entries):
+            first, _ = month2ordinal_range(year*12)
+            _, last = month2ordinal_range(year*12+11)
+            daycounts.update(self.get_daycounts_between_by_ordinal(action_name, first, last))
+        return daycounts
+
+    def get_daycounts(self, action_name):
+        daycounts = self.get_daycounts_by_ordinal(action_name)
+        return {ordinal2datestr(ordinal): daycounts[ordinal] for ordinal in daycounts}
+
+    def get_range_count_by_ordinal(self, action_name, ordinal_from, ordinal_to):
+        shards = self._shards_having(action_name, ordinal_from, ordinal_to)
+        return sum(shard.get_range_count_by_ordinal(action_name, ordinal_from, ordinal_to) for shard in shards)
+
+    def get_daily_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self.get_range_count_by_ordinal(action_name, ordinal, ordinal)
+
+    def get_range_count(self, action_name, datestr_from, datestr_to):
+        return self.get_range_count_by_ordinal(action_name,
+            datestr2ordinal(datestr_from), datestr2ordinal(datestr_to))
+
+    def get_weekly_count(self, action_name, datestr_given):
+        ordinal = datestr2ordinal(datestr_given)
+        return self.get_range_count_by_ordinal(action_name, ordinal-6, ordinal)
+
+    def get_monthly_count(self, action_name, datestr_without_day):
+        ordinal_from, ordinal_to = month2ordinal_range(datestr2month(datestr_without_day))
+        return self.get_range_count_by_ordinal(action_name, ordinal_from, ordinal_to)
+
+    def to_actionstore(self):
+        actionstore = ActionStore()
+        for name in self._names:
+            daycounts = self.get_daycounts_by_ordinal(name)
+            for ordinal in sorted(daycounts):
+                actionstore.add_ordinal(name, ordinal, daycounts[ordinal])
+        return actionstore
+
+class QueryIndex:
+    '''
+    query に答えるための、action ごとの日付索引(counte.json.index)。
+    中身は BinaryHistory の形式(action ごとに昇順の day + 累積カウント)なので、
+    開くときは mmap するだけで、どの期間の回数も二分探索2回で引ける。
+
+    作ったときのデータの signature を counte.json.index.signature に書いておき、
+    データが変わっていたら次に開くときに作り直す。
+    '''
+    def __init__(self, backend):
+        self._backend = backend
+        self._filepath = f'{backend.filepath}.index'
+        self._signaturepath = f'{self._filepath}.signature'
+
+    def _signature_string(self):
+        return dict2str(self._backend.signature())
+
+    def is_stale(self):
+        if not os.path.exists(self._filepath):
+            return True
+        if not os.path.exists(self._signaturepath):
+            return True
+        return file2str(self._signaturepath)!=self._signature_string()
+
+    def rebuild(self):
+        with FileLock(self._backend.filepath):
+            signature = self._signature_string()
+            actionstore = self._backend.load()
+            bytes2file(self._filepath, ActionStorage.from_actionstore(actionstore).to_binarybytes())
+            str2file(self._signaturepath, signature)
+
+    def open(self):
+        ''' @return BinaryHistory(使い終わったら close する) '''
+        if self.is_stale():
+            self.rebuild()
+        return BinaryHistory.open(self._filepath)
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+class ShardedStorageBackend(StorageBackend):
+    '''
+    history を年ごとの shard(counte.json.2023 など。中身は counte.json と同じ v2 形式)に分け、
+    counte.json 自体は小さな manifest にする。
+
+      {
+        "version": 1,
+        "actions": ["action1", "action2"],     初めて postend した順
+        "shards": {
+          "2023": {"upper_datestr": "2023/06/03", "counts": {"action1": 3, "action2": 1}}
+        }
+      }
+
+    record() は postend した日の年の shard(ふつうは今年の1つ)だけを読み書きする。
+    集計は open_history() で開く ShardedHistory から引くので、古い年の shard は要るときにしか読まない。
+    '''
+    RECORD_NEEDS_ACTIONSTORE = False
+    HAS_QUERYABLE_HISTORY = True
+    MANIFEST_VERSION = 1
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+
+    def shard_filepath(self, year):
+        return f'{self._filepath}.{year2datestr(year)}'
+
+    def load_manifest(self):
+        is_empty = not os.path.exists(self._filepath) or os.path.getsize(self._filepath)==0
+        if is_empty:
+            return {'version': self.MANIFEST_VERSION, 'actions': [], 'shards': {}}
+        manifest = str2dict(file2str(self._filepath))
+        is_manifest = isinstance(manifest, dict) and manifest.get('version')==self.MANIFEST_VERSION
+        if not is_manifest:
+            raise RuntimeError(f'not a sharded manifest: {self._filepath}')
+        return manifest
+
+    def is_json_data(self):
+        ''' manifest も JSON なので、中を見て manifest でなければ counte.json とみなす '''
+        if not self._starts_like_json():
+            return False
+        try:
+            self.load_manifest()
+        except RuntimeError:
+            return True
+        return False
+
+    def _remove_partial_import(self, actionstore):
+        super()._remove_partial_import(actionstore)
+        years = set()
+        for action in actionstore.actions:
+            for ordinal, _ in action.ordinal_counts:
+                years.add(month2year(ordinal2month(ordinal)))
+        for year in years:
+            filepath = self.shard_filepath(year)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def load_shard(self, year):
+        filepath = self.shard_filepath(year)
+        if not os.path.exists(filepath):
+            return ActionStore()
+        return ActionStorage.from_jsonstring(file2str(filepath)).to_actionstore()
+
+    def open_history(self):
+        return ShardedHistory(self, self.load_manifest())
+
+    def load(self):
+        with self.open_history() as history:
+            return history.to_actionstore()
+
+    def record(self, actionstore, postended_actions):
+        manifest = self.load_manifest()
+        postends_by_year = {}
+        for action in postended_actions:
+            notfound = action.name not in manifest['actions']
+            if notfound:
+                manifest['actions'].append(action.name)
+            for ordinal, count in action.ordinal_counts:
+                year = month2year(ordinal2month(ordinal))
+                postends_by_year.setdefault(year, []).append((action.name, ordinal, count))
+
+        for year in sorted(postends_by_year):
+            shard = self.load_shard(year)
+            for action_name, ordinal, count in postends_by_year[year]:
+                shard.add_ordinal(action_name, ordinal, count)
+            jsonstr = ActionStorage.from_actionstore(shard).to_jsonstring_pretty(indent=2)
+            str2file(self.shard_filepath(year), jsonstr)
+            manifest['shards'][year2datestr(year)] = {
+                'upper_datestr': ordinal2datestr(shard.upper_ordinal),
+                'counts': {name: shard.get_count(name) for name in shard.action_names},
+            }
+
+        # shard を書き終えてから manifest を差し替える
+        str2file(self._filepath, dict2str(manifest, ensure_ascii=False, indent=2))
+
+def storage_backend_from_name(name, filepath):
+    backends = {
+        'json': JsonStorageBackend,
+        'log': LogStorageBackend,
+        'binary': BinaryStorageBackend,
+        'sqlite': SqliteStorageBackend,
+        'sharded': ShardedStorageBackend,
+    }
+    notfound = name not in backends
+    if notfound:
+        raise RuntimeError(f'storage "{name}" not found.')
+    return backends[name](filepath)
+
+class ActionNameTable:
+    '''
+    action 名 <-> id(int) の対応表。id は初めて出てきた順に 0, 1, 2, ... と振る。
+    集計の中では名前の代わりに id を持ち、外に出すときだけ名前に戻す。
+    '''
+    __slots__ = ('_ids', '_names')
+
+    def __init__(self, names=()):
+        self._ids = {}
+        self._names = []
+        for name in names:
+            self.intern(name)
+
+    def intern(self, action_name):
+        action_id = self._ids.get(action_name)
+        notfound = action_id is None
+        if notfound:
+            action_id = len(self._names)
+            self._ids[action_name] = action_id
+            self._names.append(action_name)
+        return action_id
+
+    def name_of(self, action_id):
+        return self._names[action_id]
+
+    @property
+    def names(self):
+        return self._names
+
+    def __len__(self):
+        return len(self._names)
+
+class Aggregate:
+    '''
+    history を一回なめるだけで daily/weekly/monthly のカウントを作るための入れ物。
+
+    bucket は {key: (array('I'), array('Q'))} で持つ。
+    action_id の array と count の array を並べたもので、action_id の昇順に並べる。
+    action_id は ActionNameTable で振った int。
+    (bucket ごとに dict を持つより、ずっと小さい。count は 64 ビットまで数えられる)
+      daily   key: day ordinal
+      weekly  key: day ordinal(土曜日)
+      monthly key: month(year*12 + (month-1))
+      yearly  key: year
+    外に出すとき(xxxxcounts, JSON)は 'yyyy/mm/dd' や 'yyyy/mm', 'yyyy' にする。
+
+    history からは daily だけを作り、weekly/monthly は daily から、yearly は monthly から畳み上げる。
+
+    action_name の並びは初めて add() した順(= ActionStore.actions の順 = id の順)になる。
+
+    JSON にして保存しておけば、次回以降は新しく add() した分だけ足せばよい。
+    JSON でも bucket は [action_id, count, action_id, count, ...] で持ち、名前は 'actions' に1回だけ書く。
+    add() で触った key は touched_xxxxkeys で取れる。
+    '''
+    def __init__(self):
+        self._daily = {}
+        self._weekly = {}
+        self._monthly = {}
+        self._yearly = {}
+        self._totals = {}
+        self._table = ActionNameTable()
+        self._lower_ordinal = None
+        self._upper_ordinal = None
+        self._count_total = 0
+        self.clear_touched()
+
+    @staticmethod
+    def from_actionstore(actionstore, ordinal_from=None, ordinal_to=None):
+        '''
+        ordinal_from, ordinal_to を与えると、その範囲の history だけを(索引で切り出して)集計する。
+        '''
+        is_windowed = ordinal_from is not None
+        aggregate = Aggregate()
+        for name in actionstore.action_names:
+            action_id = aggregate._table.intern(name)
+            if is_windowed:
+                daycounts = actionstore.get_daycounts_between_by_ordinal(name, ordinal_from, ordinal_to)
+            else:
+                daycounts = actionstore.get_daycounts_by_ordinal(name)
+            for ordinal in daycounts:
+                count = daycounts[ordinal]
+                aggregate._increment(aggregate._daily, ordinal, action_id, count)
+                aggregate._count_total += count
+            if len(daycounts)>0:
+                aggregate._totals[action_id] = sum(daycounts.values())
+
+        aggregate._weekly = Aggregate._rollup(aggregate._daily, ordinal2saturday)
+        aggregate._monthly = Aggregate._rollup(aggregate._daily, ordinal2month)
+        aggregate._yearly = Aggregate._rollup(aggregate._monthly, month2year)
+        if len(aggregate._daily)>0:
+            aggregate._lower_ordinal = min(aggregate._daily)
+            aggregate._upper_ordinal = max(aggregate._daily)
+        return aggregate
+
+    @staticmethod
+    def _rollup(buckets, key2parentkey):
+        ''' 下の階層の buckets を足し合わせて上の階層の buckets を作る '''
+        parent_buckets = {}
+        for key in buckets:
+            parentkey = key2parentkey(key)
+            notfound = parentkey not in parent_buckets
+            if notfound:
+                parent_buckets[parentkey] = {}
+            parent_bucket = parent_buckets[parentkey]
+            for action_id, count in Aggregate._unpack(buckets[key]):
+                parent_bucket[action_id] = parent_bucket.get(action_id, 0) + count
+        # 足し合わせるあいだだけ dict で持ち、最後に詰める
+        return {parentkey: Aggregate._pack(parent_buckets[parentkey]) for parentkey in parent_buckets}
+
+    # JSON の書式を変えたら上げる。合わないキャッシュは読まずに作り直させる
+    JSON_VERSION = 2
+
+    @staticmethod
+    def _buckets_from_dict(d, str2key):
+        buckets = {}
+        for k in d:
+            flat = d[k]
+            buckets[str2key(k)] = (array('I', flat[0::2]), array('Q', flat[1::2]))
+        return buckets
+
+    @staticmethod
+    def _buckets_to_dict(buckets, key2str):
+        d = {}
+        for k in buckets:
+            action_ids, counts = buckets[k]
+            flat = [0] * (2*len(action_ids))
+            flat[0::2] = action_ids
+            flat[1::2] = counts
+            d[key2str(k)] = flat
+        return d
+
+    @staticmethod
+    def from_jsonstring(jsonstr):
+        d = str2dict(jsonstr)
+        if d['version']!=Aggregate.JSON_VERSION:
+            raise ValueError(f'Aggregate version mismatch: {d["version"]}')
+        aggregate = Aggregate()
+        aggregate._table = ActionNameTable(d['actions'])
+        aggregate._daily = Aggregate._buckets_from_dict(d['daily'], datestr2ordinal)
+        aggregate._weekly = Aggregate._buckets_from_dict(d['weekly'], datestr2ordinal)
+        aggregate._monthly = Aggregate._buckets_from_dict(d['monthly'], datestr2month)
+        aggregate._yearly = Aggregate._buckets_from_dict(d['yearly'], int)
+        # 全期間の合計は yearly を足せば出るので JSON には持たない
+        totals = aggregate._totals
+        for year in aggregate._yearly:
+            for action_id, count in Aggregate._unpack(aggregate._yearly[year]):
+                totals[action_id] = totals.get(action_id, 0) + count
+        if d['count_total']>0:
+            aggregate._lower_ordinal = datestr2ordinal(d['lower_datestr'])
+            aggregate._upper_ordinal = datestr2ordinal(d['upper_datestr'])
+        aggregate._count_total = d['count_total']
+        return aggregate
+
+    def to_jsonstring(self):
+        d = {
+            'version': Aggregate.JSON_VERSION,
+            'actions': self._table.names,
+            'daily': self._buckets_to_dict(self._daily, ordinal2datestr),
+            'weekly': self._buckets_to_dict(self._weekly, ordinal2datestr),
+            'monthly': self._buckets_to_dict(self._monthly, month2datestr),
+            'yearly': self._buckets_to_dict(self._yearly, year2datestr),
+            'lower_datestr': self.lower_datestr,
+            'upper_datestr': self.upper_datestr,
+            'count_total': self._count_total,
+        }
+        return dict2str(d, ensure_ascii=False)
+
+    @staticmethod
+    def _increment(buckets, key, action_id, count):
+        notfound = key not in buckets
+        if notfound:
+            buckets[key] = (array('I'), array('Q'))
+        action_ids, counts = buckets[key]
+        # from_actionstore は action_id の昇順に足すので、たいていは末尾に付け足すだけで済む
+        is_last = len(action_ids)==0 or action_ids[-1]<action_id
+        if is_last:
+            action_ids.append(action_id)
+            counts.append(count)
+            return
+        i = bisect.bisect_left(action_ids, action_id)
+        found = i<len(action_ids) and action_ids[i]==action_id
+        if found:
+            counts[i] += count
+            return
+        action_ids.insert(i, action_id)
+        counts.insert(i, count)
+
+    @staticmethod
+    def _pack(counts):
+        ''' {action_id: count} -> bucket '''
+        action_ids = sorted(counts)
+        return (array('I', action_ids), array('Q', [counts[action_id] for action_id in action_ids]))
+
+    @staticmethod
+    def _unpack(bucket):
+        ''' @return [(action_id, count), ...] action_id の昇順 '''
+        return zip(*bucket)
+
+    def add(self, action_name, datestr, count=1):
+        self.add_ordinal(action_name, datestr2ordinal(datestr), count)
+
+    def add_ordinal(self, action_name, ordinal, count=1):
+        action_id = self._table.intern(action_name)
+
+        saturday = ordinal2saturday(ordinal)
+        month = ordinal2month(ordinal)
+        year = month2year(month)
+        self._increment(self._daily, ordinal, action_id, count)
+        self._increment(self._weekly, saturday, action_id, count)
+        self._increment(self._monthly, month, action_id, count)
+        self._increment(self._yearly, year, action_id, count)
+        self._touched_dailykeys.add(ordinal)
+        self._touched_weeklykeys.add(saturday)
+        self._touched_monthlykeys.add(month)
+        self._touched_yearlykeys.add(year)
+        self._totals[action_id] = self._totals.get(action_id, 0) + count
+
+        if self._lower_ordinal is None or ordinal<self._lower_ordinal:
+            self._lower_ordinal = ordinal
+        if self._upper_ordinal is None or ordinal>self._upper_ordinal:
+            self._upper_ordinal = ordinal
+        self._count_total += count
+
+    def clear_touched(self):
+        self._touched_dailykeys = set()
+        self._touched_weeklykeys = set()
+        self._touched_monthlykeys = set()
+        self._touched_yearlykeys = set()
+
+    def _to_counts(self, buckets, keys, key2str):
+        '''
+        2023/02/11
+         [action1, 2],
+         [action2, 1],
+         [action3, 4],
+        '''
+        name_of = self._table.name_of
+        counts = {}
+        for key in sorted(keys):
+            # bucket は id の昇順 = action の順になっている。名前に戻すのはここだけ
+            counts[key2str(key)] = [[name_of(action_id), count] for action_id, count in zip(*buckets[key])]
+        return counts
+
+    def _dailycounts_of(self, ordinals):
+        ordinals = [k for k in ordinals if k in self._daily]
+        return self._to_counts(self._daily, ordinals, ordinal2datestr)
+
+    def _weeklycounts_of(self, saturdays):
+        '''
+        weekは土曜日基点にする。
+        日曜日に週次レビューを行う場合、見たいのは先週日曜日から今週土曜日まで。
+
+        基点の土曜日は history に実在する日付だけ。
+        (その土曜日に何もしていない週は出さない)
+        '''
+        saturdays = [k for k in saturdays if k in self._weekly and k in self._daily]
+        return self._to_counts(self._weekly, saturdays, ordinal2datestr)
+
+    def _monthlycounts_of(self, months):
+        months = [k for k in months if k in self._monthly]
+        return self._to_counts(self._monthly, months, month2datestr)
+
+    def _yearlycounts_of(self, years):
+        years = [k for k in years if k in self._yearly]
+        return self._to_counts(self._yearly, years, year2datestr)
+
+    def dailycounts_of(self, datestrs):
+        return self._dailycounts_of([datestr2ordinal(k) for k in datestrs])
+
+    def weeklycounts_of(self, datestrs):
+        return self._weeklycounts_of([datestr2ordinal(k) for k in datestrs])
+
+    def monthlycounts_of(self, datestrs_without_day):
+        return self._monthlycounts_of([datestr2month(k) for k in datestrs_without_day])
+
+    def yearlycounts_of(self, yearstrs):
+        return self._yearlycounts_of([int(k) for k in yearstrs])
+
+    @property
+    def dailycounts(self):
+        return self._dailycounts_of(self._daily.keys())
+
+    @property
+    def weeklycounts(self):
+        return self._weeklycounts_of(self._weekly.keys())
+
+    @property
+    def monthlycounts(self):
+        return self._monthlycounts_of(self._monthly.keys())
+
+    @property
+    def yearlycounts(self):
+        return self._yearlycounts_of(self._yearly.keys())
+
+    @property
+    def totalcounts(self):
+        ''' 全期間の [[action_name, count], ...]。action の順。add() のたびに足してあるので数えなおさない '''
+        name_of = self._table.name_of
+        return [[name_of(action_id), self._totals[action_id]] for action_id in sorted(self._totals)]
+
+    def rollingcounts(self, days):
+        ''' 一番新しい日から遡って days 日間の [[action_name, count], ...]。action の順 '''
+        if self._upper_ordinal is None:
+            return []
+        counts = {}
+        for ordinal in range(self._upper_ordinal-days+1, self._upper_ordinal+1):
+            if ordinal not in self._daily:
+                continue
+            for action_id, count in Aggregate._unpack(self._daily[ordinal]):
+                counts[action_id] = counts.get(action_id, 0) + count
+        name_of = self._table.name_of
+        return [[name_of(action_id), counts[action_id]] for action_id in sorted(counts)]
+
+    def xxxxcounts_by_period(self, period):
+        ''' period は daily, weekly, monthly, yearly のどれか(REPORT_FILENAMES のキー) '''
+        getters = {
+            'daily': lambda: self.dailycounts,
+            'weekly': lambda: self.weeklycounts,
+            'monthly': lambda: self.monthlycounts,
+            'yearly': lambda: self.yearlycounts,
+        }
+        return getters[period]()
+
+    def xxxxcounts_of_by_period(self, period, keys):
+        getters = {
+            'daily': self.dailycounts_of,
+            'weekly': self.weeklycounts_of,
+            'monthly': self.monthlycounts_of,
+            'yearly': self.yearlycounts_of,
+        }
+        return getters[period](keys)
+
+    def touched_keys_by_period(self, period):
+        getters = {
+            'daily': lambda: self.touched_dailykeys,
+            'weekly': lambda: self.touched_weeklykeys,
+            'monthly': lambda: self.touched_monthlykeys,
+            'yearly': lambda: self.touched_yearlykeys,
+        }
+        return getters[period]()
+
+    @property
+    def touched_dailykeys(self):
+        return {ordinal2datestr(k) for k in self._touched_dailykeys}
+
+    @property
+    def touched_weeklykeys(self):
+        return {ordinal2datestr(k) for k in self._touched_weeklykeys}
+
+    @property
+    def touched_monthlykeys(self):
+        return {month2datestr(k) for k in self._touched_monthlykeys}
+
+    @property
+    def touched_yearlykeys(self):
+        return {year2datestr(k) for k in self._touched_yearlykeys}
+
+    @property
+    def lower_datestr(self):
+        if self._lower_ordinal is None:
+            return None
+        return ordinal2datestr(self._lower_ordinal)
+
+    @property
+    def upper_datestr(self):
+        if self._upper_ordinal is None:
+            return None
+        return ordinal2datestr(self._upper_ordinal)
+
+    @property
+    def upper_ordinal(self):
+        return self._upper_ordinal
+
+    @property
+    def count_total(self):
+        return self._count_total
+
+class Report:
+    def __init__(self, actionstore):
+        self._actionstore = actionstore
+        self._parse()
+
+    def _parse(self):
+        aggregate = Aggregate.from_actionstore(self._actionstore)
+        self._aggregate = aggregate
+
+        self._lower_datestr = aggregate.lower_datestr
+        self._upper_datestr = aggregate.upper_datestr
+        self._count_total = aggregate.count_total
+        self._dailycounts = aggregate.dailycounts
+        self._weeklycounts = aggregate.weeklycounts
+        self._monthlycounts = aggregate.monthlycounts
+        self._yearlycounts = aggregate.yearlycounts
+
+    @property
+    def aggregate(self):
+        return self._aggregate
+
+    @property
+    def dailycounts(self):
+        return self._dailycounts
+    @property
+    def weeklycounts(self):
+        return self._weeklycounts
+    @property
+    def monthlycounts(self):
+        return self._monthlycounts
+    @property
+    def yearlycounts(self):
+        return self._yearlycounts
+
+    @property
+    def lower_datestr(self):
+        return self._lower_datestr
+
+    @property
+    def upper_datestr(self):
+        return self._upper_datestr
+
+    @property
+    def count_total(self):
+        return self._count_total
+
+def _import_numpy():
+    ''' numpy は任意。無ければ None '''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+class MatrixReport:
+    '''
+    ActionStore を actions x days の回数行列にして集計する、Report の代わり。
+    Report と同じ xxxxcounts を持つので FileReport にそのまま渡せる。
+
+              day0 day1 day2 ...   (lower_datestr から upper_datestr まで毎日)
+      action1    2    0    1
+      action2    0    1    0
+
+    numpy があれば行列演算で、無い(か use_numpy=False)なら同じことを素の Python でやる。
+    Report に無いものとして、直近 N 日の移動合計(rolling_counts)と連続日数(streaks)も出せる。
+    '''
+    def __init__(self, actionstore, use_numpy=True):
+        self._np = None
+        if use_numpy:
+            self._np = _import_numpy()
+        self._names = actionstore.action_names
+
+        daycounts_list = [actionstore.get_daycounts_by_ordinal(name) for name in self._names]
+        ordinals = set()
+        for daycounts in daycounts_list:
+            ordinals.update(daycounts)
+        self._first_ordinal = 0
+        self._day_count = 0
+        if len(ordinals)>0:
+            self._first_ordinal = min(ordinals)
+            self._day_count = max(ordinals) - self._first_ordinal + 1
+
+        self._matrix = self._build_matrix(daycounts_list)
+        self._parse()
+
+    def _build_matrix(self, daycounts_list):
+        np = self._np
+        first = self._first_ordinal
+        if np is None:
+            rows = []
+            for daycounts in daycounts_list:
+                row = [0]*self._day_count
+                for ordinal in daycounts:
+                    row[ordinal-first] = daycounts[ordinal]
+                rows.append(row)
+            return rows
+
+        matrix = np.zeros((len(daycounts_list), self._day_count), dtype=np.int64)
+        for i, daycounts in enumerate(daycounts_list):
+            columns = np.fromiter(daycounts.keys(), dtype=np.int64, count=len(daycounts)) - first
+            values = np.fromiter(daycounts.values(), dtype=np.int64, count=len(daycounts))
+            matrix[i, columns] = values
+        return matrix
+
+    def _ordinals(self):
+        first = self._first_ordinal
+        return range(first, first+self._day_count)
+
+    def _grouped(self, ordinal2key):
+        '''
+        日の列を ordinal2key で束ねて足し合わせる。日は昇順なので同じ key の列は隣り合っている。
+        @return (keys, 束ねた行列)
+        '''
+        keys = []
+        starts = []
+        for column, ordinal in enumerate(self._ordinals()):
+            key = ordinal2key(ordinal)
+            is_new_key = len(keys)==0 or keys[-1]!=key
+            if is_new_key:
+                keys.append(key)
+                starts.append(column)
+
+        np = self._np
+        if len(keys)==0:
+            return (keys, self._matrix)
+        if np is None:
+            ends = starts[1:] + [self._day_count]
+            spans = list(zip(starts, ends))
+            grouped = [[sum(row[s:e]) for s, e in spans] for row in self._matrix]
+            return (keys, grouped)
+        grouped = np.add.reduceat(self._matrix, starts, axis=1)
+        return (keys, grouped)
+
+    def _to_counts(self, keys, matrix, key2str, keys_to_keep=None):
+        ''' 行列を {key: [[action_name, count], ...]} にする。全部0の列は出さない '''
+        np = self._np
+        counts = {}
+        for column, key in enumerate(keys):
+            if keys_to_keep is not None and key not in keys_to_keep:
+                continue
+            if np is None:
+                pairs = [[name, row[column]] for name, row in zip(self._names, matrix) if row[column]!=0]
+            else:
+                values = matrix[:, column]
+                pairs = [[self._names[i], int(values[i])] for i in np.flatnonzero(values)]
+            if len(pairs)==0:
+                continue
+            counts[key2str(key)] = pairs
+        return counts
+
+    def _parse(self):
+        keys = list(self._ordinals())
+        self._dailycounts = self._to_counts(keys, self._matrix, ordinal2datestr)
+
+        '''
+        weekは土曜日基点にする。基点の土曜日は history に実在する日付だけ。
+        '''
+        days_with_count = {datestr2ordinal(datestr) for datestr in self._dailycounts}
+        keys, matrix = self._grouped(ordinal2saturday)
+        self._weeklycounts = self._to_counts(keys, matrix, ordinal2datestr, days_with_count)
+
+        keys, matrix = self._grouped(ordinal2month)
+        self._monthlycounts = self._to_counts(keys, matrix, month2datestr)
+
+        keys, matrix = self._grouped(lambda ordinal: month2year(ordinal2month(ordinal)))
+        self._yearlycounts = self._to_counts(keys, matrix, year2datestr)
+
+        self._lower_datestr = None
+        self._upper_datestr = None
+        if self._day_count>0:
+            self._lower_datestr = ordinal2datestr(self._first_ordinal)
+            self._upper_datestr = ordinal2datestr(self._first_ordinal+self._day_count-1)
+        if self._np is None:
+            self._count_total = sum(sum(row) for row in self._matrix)
+        else:
+            self._count_total = int(self._matrix.sum())
+
+    def rolling_counts(self, window):
+        ''' 日ごとに、その日までの直近 window 日の合計。{datestr: [[action_name, count], ...]} '''
+        np = self._np
+        keys = list(self._ordinals())
+        if np is None:
+            rolling = []
+            for row in self._matrix:
+                out = []
+                total = 0
+                for column, count in enumerate(row):
+                    total += count
+                    if column>=window:
+                        total -= row[column-window]
+                    out.append(total)
+                rolling.append(out)
+            return self._to_counts(keys, rolling, ordinal2datestr)
+
+        cumulative = np.zeros((len(self._names), self._day_count+1), dtype=np.int64)
+        np.cumsum(self._matrix, axis=1, out=cumulative[:, 1:])
+        upper = np.arange(1, self._day_count+1)
+        lower = np.maximum(upper-window, 0)
+        rolling = cumulative[:, upper] - cumulative[:, lower]
+        return self._to_counts(keys, rolling, ordinal2datestr)
+
+    @property
+    def streaks(self):
+        '''
+        action ごとの連続日数。{action_name: [最長, 今(upper_datestr で終わるもの)]}
+        '''
+        np = self._np
+        streaks = {}
+        if np is None:
+            for name, row in zip(self._names, self._matrix):
+                longest = 0
+                current = 0
+                for count in row:
+                    current = current+1 if count>0 else 0
+                    longest = max(longest, current)
+                streaks[name] = [longest, current]
+            return streaks
+
+        if self._day_count==0:
+            return {name: [0, 0] for name in self._names}
+        done = self._matrix>0
+        cumulative = np.cumsum(done, axis=1)
+        # やらなかった日の時点の cumulative を右に引き伸ばしておき、そこからの増分が連続日数
+        reset = np.maximum.accumulate(np.where(done, 0, cumulative), axis=1)
+        run = cumulative - reset
+        longests = run.max(axis=1)
+        currents = run[:, -1]
+        for i, name in enumerate(self._names):
+            streaks[name] = [int(longests[i]), int(currents[i])]
+        return streaks
+
+    @property
+    def uses_numpy(self):
+        return self._np is not None
+
+    @property
+    def dailycounts(self):
+        return self._dailycounts
+    @property
+    def weeklycounts(self):
+        return self._weeklycounts
+    @property
+    def monthlycounts(self):
+        return self._monthlycounts
+    @property
+    def yearlycounts(self):
+        return self._yearlycounts
+
+    @property
+    def lower_datestr(self):
+        return self._lower_datestr
+
+    @property
+    def upper_datestr(self):
+        return self._upper_datestr
+
+    @property
+    def count_total(self):
+        return self._count_total
+
+class FileReport:
+    def __init__(self, report):
+        self._report = report
+        self._parse()
+
+    def _parse(self):
+        self._daily()
+        self._weekly()
+        self._monthly()
+        self._yearly()
+
+    @staticmethod
+    def sort_to_most_counted(action_count_pairs):
+        '''
+        同じ回数どうしは名前の降順。並びを集計の action の順に任せると、
+        キャッシュから足したときと作り直したときとで変わってしまう。
+        '''
+        # 名前で並べてから回数で並べる(安定ソート)。タプルをキーにするより速い
+        out = sorted(action_count_pairs, key=lambda elm:elm[0])
+        out.sort(key=lambda elm:elm[1])
+        out.reverse()
+        return out
+
+    @staticmethod
+    def top_most_counted(action_count_pairs, top):
+        '''
+        sort_to_most_counted(action_count_pairs)[:top] と同じものを、全部は並べずにヒープで選ぶ。
+        '''
+        import heapq
+        return heapq.nlargest(top, action_count_pairs, key=lambda elm:(elm[1], elm[0]))
+
+    @staticmethod
+    def section_lines(datestr, action_count_pairs, top=None):
+        '''
+        top を与えると、回数の多い top 個の action だけを書く(見出しの合計は全 action ぶん)。
+        '''
+        outlines = []
+
+        total = 0
+        for pair in action_count_pairs:
+            _, count = pair
+            total += count
+        # 曜日を出すのは daily/weekly('yyyy/mm/dd')だけ。monthly/yearly は日付の次がすぐ合計
+        has_day = len(datestr)==len('yyyy/mm/dd')
+        if has_day:
+            dow = datestr2dow_eng(datestr)
+            out = f'{datestr} {dow} {total}'
+        else:
+            out = f'{datestr} {total}'
+        outlines.append(out)
+
+        INDENT = ' '
+        BLANK_LINE = ''
+        if top is None:
+            pairs = FileReport.sort_to_most_counted(action_count_pairs)
+        else:
+            pairs = FileReport.top_most_counted(action_count_pairs, top)
+        for pair in pairs:
+            name, count = pair
+            out = f'{INDENT}{count} {name}'
+            outlines.append(out)
+        outlines.append(BLANK_LINE)
+
+        return outlines
+
+    @staticmethod
+    def lines_by_DescOrder_and_MostCounted(xxxxcounts, top=None):
+        return list(FileReport.iter_lines_by_DescOrder_and_MostCounted(xxxxcounts, top))
+
+    @staticmethod
+    def iter_lines_by_DescOrder_and_MostCounted(xxxxcounts, top=None):
+        ''' 1セクションずつ描いて流す。全行をメモリに持たない '''
+        datestrs = []
+        for datestr in xxxxcounts:
+            datestrs.append(datestr)
+        datestrs.sort()
+        # 最新日を上に書きたいので降順にする
+        datestrs.reverse()
+
+        for datestr in datestrs:
+            action_count_pairs = xxxxcounts[datestr]
+            yield from FileReport.section_lines(datestr, action_count_pairs, top)
+
+    @staticmethod
+    def splice_sections(lines, xxxxcounts_touched, top=None):
+        return list(FileReport.iter_spliced_sections(lines, xxxxcounts_touched, top))
+
+    @staticmethod
+    def iter_spliced_sections(lines, xxxxcounts_touched, top=None):
+        '''
+        既存のレポート lines のうち、xxxxcounts_touched にある日付のセクションだけを
+        描き直して差し替える(無ければ日付順の位置に差し込む)。
+
+        2023/06/03 Sat 3    <- セクションの見出し(インデント無し)
+         2 action1
+         1 action2
+                            <- セクションの終わり
+
+        レポートはセクションが日付の降順に並んでいるので、lines を頭から1回なめながら
+        差し替えていけばよい(lines はジェネレータでよい)。
+        '''
+        touched_datestrs = sorted(xxxxcounts_touched, reverse=True)
+        i = 0
+        datestr = None
+        is_replaced = False
+        for line in lines:
+            is_header = len(line)>0 and not line.startswith(' ')
+            if is_header:
+                datestr = line.split(' ')[0]
+                while i<len(touched_datestrs) and touched_datestrs[i]>datestr:
+                    touched = touched_datestrs[i]
+                    yield from FileReport.section_lines(touched, xxxxcounts_touched[touched], top)
+                    i += 1
+                is_replaced = i<len(touched_datestrs) and touched_datestrs[i]==datestr
+                if is_replaced:
+                    yield from FileReport.section_lines(datestr, xxxxcounts_touched[datestr], top)
+                    i += 1
+            if datestr is None or is_replaced:
+                continue
+            yield line
+
+        for touched in touched_datestrs[i:]:
+            yield from FileReport.section_lines(touched, xxxxcounts_touched[touched], top)
+
+    def _daily(self):
+        outlines = self.lines_by_DescOrder_and_MostCounted(self._report.dailycounts)
+        self._dailycounts_by_lines = outlines
+
+    def _weekly(self):
+        outlines = self.lines_by_DescOrder_and_MostCounted(self._report.weeklycounts)
+        self._weeklycounts_by_lines = outlines
+
+    def _monthly(self):
+        outlines = self.lines_by_DescOrder_and_MostCounted(self._report.monthlycounts)
+        self._monthlycounts_by_lines = outlines
+
+    def _yearly(self):
+        outlines = self.lines_by_DescOrder_and_MostCounted(self._report.yearlycounts)
+        self._yearlycounts_by_lines = outlines
+
+    @property
+    def dailycounts_by_lines(self):
+        return self._dailycounts_by_lines
+
+    @property
+    def weeklycounts_by_lines(self):
+        return self._weeklycounts_by_lines
+
+    @property
+    def monthlycounts_by_lines(self):
+        return self._monthlycounts_by_lines
+
+    @property
+    def yearlycounts_by_lines(self):
+        return self._yearlycounts_by_lines
+
+def load_aggregate_cache(filepath, signature_expected):
+    '''
+    使えない(無い、壊れてる、データとずれてる)なら None。
+    作ったときのデータの signature(backend.signature())を filepath.signature に書いておき、
+    いまのデータのものと違えば、合計が同じでも(手で名前を直したなど)ずれているとみなす。
+    '''
+    if not is_aggregate_cache_fresh(filepath, signature_expected):
+        return None
+    try:
+        return Aggregate.from_jsonstring(file2str(filepath))
+    except (ValueError, KeyError):
+        return None
+
+def is_aggregate_cache_fresh(filepath, signature_expected):
+    ''' キャッシュ本体は読まずに signature だけ見る '''
+    signaturepath = f'{filepath}.signature'
+    if not os.path.exists(filepath) or not os.path.exists(signaturepath):
+        return False
+    return file2str(signaturepath)==dict2str(signature_expected)
+
+def save_aggregate_cache(filepath, aggregate, signature):
+    ''' 書いている途中で落ちても古い signature と組にならないよう、signature は消してから最後に書く '''
+    signaturepath = f'{filepath}.signature'
+    if os.path.exists(signaturepath):
+        os.remove(signaturepath)
+    str2file(filepath, aggregate.to_jsonstring())
+    str2file(signaturepath, dict2str(signature))
+
+REPORT_FILENAMES = {
+    'daily': 'counte_daily.scb',
+    'weekly': 'counte_weekly.scb',
+    'monthly': 'counte_monthly.scb',
+    'yearly': 'counte_yearly.scb',
+}
+LEADERBOARD_FILENAME = 'counte_leaderboard.scb'
+# レポートをどんなオプションで描いたか。変わったら incremental でも全部描き直す
+REPORT_OPTIONS_FILENAME = 'counte_report_options.json'
+
+# leaderboard に出す直近 N 日間
+LEADERBOARD_ROLLING_DAYS = [7, 30]
+
+def window_ordinal_range(upper_ordinal, period, size):
+    '''
+    直近 size 期間ぶんの日の範囲 (ordinal_from, ordinal_to)。
+    weekly は upper_ordinal が属する週の土曜日から遡って size 週ぶん。
+    '''
+    if period=='daily':
+        return (upper_ordinal-size+1, upper_ordinal)
+    if period=='weekly':
+        saturday = ordinal2saturday(upper_ordinal)
+        return (saturday-7*size+1, saturday)
+    raise RuntimeError(f'Window not supported: {period}')
+
+def windowed_aggregates_from_actionstore(actionstore, windows):
+    '''
+    @param windows {period: 期間数}
+    @return {period: 窓の中の history だけを集計した Aggregate}
+    '''
+    upper_ordinal = actionstore.upper_ordinal
+    aggregates = {}
+    if upper_ordinal is None:
+        return aggregates
+    for period in windows:
+        ordinal_from, ordinal_to = window_ordinal_range(upper_ordinal, period, windows[period])
+        aggregates[period] = Aggregate.from_actionstore(actionstore, ordinal_from, ordinal_to)
+    return aggregates
+
+def write_reports(report_directory, aggregate, incremental=False, windowed_aggregates=None, top=None):
+    '''
+    incremental なら、既存のレポートのうち aggregate で触ったセクションだけ描き直す。
+    そうでなければ全部描き直す。
+    ただし前回と top や窓で切った period が違うときは、触っていないセクションも
+    前回のままでは合わないので全部描き直す。
+
+    top を与えると、各セクションには回数の多い top 個の action だけを書く。
+
+    windowed_aggregates に {period: Aggregate} があれば、その period のレポートは
+    そちら(直近 N 期間だけを集計したもの)から丸ごと描く。
+
+    どれも1行ずつ一時ファイルに流し込み、中身が変わったレポートだけ差し替える。
+    @return 差し替えた period のリスト
+    '''
+    if windowed_aggregates is None:
+        windowed_aggregates = {}
+
+    options_fullpath = os.path.join(report_directory, REPORT_OPTIONS_FILENAME)
+    # 窓で切った period は窓の外のセクションが無いので、窓をやめたら全部描き直す
+    options = {'top': top, 'windowed': sorted(windowed_aggregates)}
+    if incremental and load_report_options(options_fullpath)!=options:
+        incremental = False
+
+    replaced_periods = []
+    for period in REPORT_FILENAMES:
+        fullpath = os.path.join(report_directory, REPORT_FILENAMES[period])
+
+        is_windowed = period in windowed_aggregates
+        is_full = not incremental or not os.path.exists(fullpath)
+        if is_windowed:
+            xxxxcounts = windowed_aggregates[period].xxxxcounts_by_period(period)
+            lines = FileReport.iter_lines_by_DescOrder_and_MostCounted(xxxxcounts, top)
+        elif is_full:
+            xxxxcounts = aggregate.xxxxcounts_by_period(period)
+            lines = FileReport.iter_lines_by_DescOrder_and_MostCounted(xxxxcounts, top)
+        else:
+            touched_keys = aggregate.touched_keys_by_period(period)
+            xxxxcounts_touched = aggregate.xxxxcounts_of_by_period(period, touched_keys)
+            lines = FileReport.iter_spliced_sections(file2iter(fullpath), xxxxcounts_touched, top)
+
+        is_replaced = iter2file_if_changed(fullpath, lines)
+        if is_replaced:
+            replaced_periods.append(period)
+
+    iter2file_if_changed(options_fullpath, [dict2str(options)])
+    return replaced_periods
+
+def load_report_options(filepath):
+    ''' 無い、壊れてるなら None '''
+    if not os.path.exists(filepath):
+        return None
+    try:
+        return str2dict(file2str(filepath))
+    except ValueError:
+        return None
+
+def leaderboard_lines(aggregate, top=None):
+    '''
+    all-time 123             <- 全期間
+     50 action1
+     ...
+
+    2023/05/28-2023/06/03 12 <- 直近 LEADERBOARD_ROLLING_DAYS 日間
+     ...
+
+    全期間の合計は aggregate が add() のたびに足しているものを使い、
+    直近 N 日間は daily の N 個の bucket だけを足す。history はなめなおさない。
+    '''
+    lines = FileReport.section_lines('all-time', aggregate.totalcounts, top)
+    upper_ordinal = aggregate.upper_ordinal
+    if upper_ordinal is None:
+        return lines
+    for days in LEADERBOARD_ROLLING_DAYS:
+        datestr_from = ordinal2datestr(upper_ordinal-days+1)
+        datestr_to = ordinal2datestr(upper_ordinal)
+        label = f'{datestr_from}-{datestr_to}'
+        lines.extend(FileReport.section_lines(label, aggregate.rollingcounts(days), top))
+    return lines
+
+def write_leaderboard(report_directory, aggregate, top=None):
+    ''' 小さいので毎回丸ごと描く。中身が変わったときだけ差し替える '''
+    fullpath = os.path.join(report_directory, LEADERBOARD_FILENAME)
+    return iter2file_if_changed(fullpath, leaderboard_lines(aggregate, top))
+
+class StageProfiler:
+    '''
+    --profile 用。stage ごとに、回数・経過時間・その間のメモリのピーク(tracemalloc)を記録する。
+    cprofile_stages に挙げた stage は cProfile でも測り、dump_cprofile() で書き出せる。
+
+    enabled=False なら何もしない(stage() は素通りする)。
+    '''
+    def __init__(self, enabled=False, cprofile_stages=()):
+        self._enabled = enabled
+        self._cprofile_stages = set(cprofile_stages)
+        self._stages = {}
+        self._cprofile = None
+
+    def stage(self, name):
+        return _ProfiledStage(self, name)
+
+    def _enter(self, name):
+        if not self._enabled:
+            return None
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # reset_peak は Python 3.9 から。無ければ開始時点からのピークになる
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        memory_at_start, _ = tracemalloc.get_traced_memory()
+
+        if name in self._cprofile_stages:
+            if self._cprofile is None:
+                import cProfile
+                self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return (time.perf_counter(), memory_at_start)
+
+    def _exit(self, name, started):
+        if not self._enabled:
+            return
+        start, memory_at_start = started
+        elapsed = time.perf_counter() - start
+        if name in self._cprofile_stages:
+            self._cprofile.disable()
+
+        import tracemalloc
+        _, peak = tracemalloc.get_traced_memory()
+
+        notfound = name not in self._stages
+        if notfound:
+            self._stages[name] = {'calls': 0, 'wall_seconds': 0.0, 'peak_memory_bytes': 0}
+        stat = self._stages[name]
+        stat['calls'] += 1
+        stat['wall_seconds'] += elapsed
+        stat['peak_memory_bytes'] = max(stat['peak_memory_bytes'], peak - memory_at_start)
+
+    def to_jsonstring(self):
+        d = {
+            'stages': self._stages,
+            'total_wall_seconds': sum(stat['wall_seconds'] for stat in self._stages.values()),
+        }
+        return dict2str(d, indent=2, ensure_ascii=False)
+
+    def dump_cprofile(self, filepath):
+        ''' cprofile_stages が一度も通っていなければ何もしない '''
+        if self._cprofile is None:
+            return
+        self._cprofile.dump_stats(filepath)
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def stages(self):
+        return self._stages
+
+class _ProfiledStage:
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._started = None
+
+    def __enter__(self):
+        self._started = self._profiler._enter(self._name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler._exit(self._name, self._started)
+
+class Session:
+    '''
+    workspace 1つ分の postend 検出 -> 永続化 -> レポート更新。
+
+    ActionStore と Aggregate は一度読んだら持ち続けるので、
+    同じ Session で何度も process() する(--watch)ときは2回目以降が軽い。
+
+    各段階は profiler の stage として測れる。
+      detect, load, record, aggregate, write_reports
+    '''
+    REPORT_STAGES = ['aggregate', 'write_reports']
+
+    def __init__(self, input_filename, datajson_filename, report_directory, storage='json', profiler=None, windows=None, top=None):
+        '''
+        @param windows {period: N} があれば、その period のレポートは直近 N 期間だけにする
+        @param top があれば、レポートの各セクションと leaderboard は回数の多い top 個の action だけにする
+        '''
+        self._input_filename = input_filename
+        self._datajson_filename = datajson_filename
+        self._report_directory = report_directory
+        self._storage = storage
+        self._backend = storage_backend_from_name(storage, datajson_filename)
+        self._aggregatecache_filename = f'{datajson_filename}.aggregate'
+        self._journal = PendingJournal(datajson_filename)
+        self._actionstore = None
+        self._aggregate = None
+        self._loaded_signature = None
+        self._workspace_signature = None
+        if profiler is None:
+            profiler = StageProfiler()
+        self._profiler = profiler
+        if windows is None:
+            windows = {}
+        self._windows = windows
+        self._top = top
+
+    def _validate(self):
+        if not os.path.exists(self._input_filename):
+            raise RuntimeError(f'input-scb invalid: {self._input_filename}')
+        self._validate_data()
+
+    def _validate_data(self):
+        if not os.path.exists(self._report_directory):
+            raise RuntimeError(f'report-directory invalid: {self._report_directory}')
+        if not os.path.exists(self._datajson_filename):
+            emptyfile = []
+            list2file(self._datajson_filename, emptyfile)
+        if self._backend.is_json_data():
+            raise RuntimeError(f'{self._datajson_filename} is still JSON data. Import it first with --compact --storage {self._storage}')
+
+    def process(self, record_only=False):
+        '''
+        @param record_only True なら記録だけしてレポートには触らない
+                           (集計のキャッシュは古くなり、次の通常実行で作り直される)
+        @return postend された actions
+
+        同時に何本動いても数え落とし・二重計上が無いように、
+          1: workspace をロックして、postend を PendingJournal に追記してから workspace を書き直す
+          2: データをロックして、PendingJournal に溜まった分(他の実行の分も)をまとめて書き込む
+        とする。2 で先にロックを取った実行が畳み込んでくれていれば、後の実行は何も書かない。
+        '''
+        self._validate()
+        profiler = self._profiler
+
+        with profiler.stage('detect'):
+            with FileLock(self._input_filename):
+                # workspace は1行ずつ読んで、1行ずつ一時ファイルに書く。どれだけ大きくてもメモリは一定
+                ws_reader = FileWorkspaceReader()
+                ws_writer = FileWorkspaceWriter(self._input_filename)
+                ws_reader.parse(self._input_filename)
+                try:
+                    detector = PostendDetector(ws_reader, ws_writer)
+                    postended_actions = detector.postended_actions()
+                except BaseException:
+                    ws_writer.discard()
+                    raise
+                # workspace を書き直せなかったら(エディタが掴んでいるなど)、mark は残るので journal からも取り消す
+                try:
+                    self._journal.append(postended_actions, lambda: ws_writer.save(self._input_filename))
+                except BaseException:
+                    ws_writer.discard()
+                    raise
+                # ロックを放した後の保存(エディタなど)と見分けられるよう、自分が書いた直後の状態を覚えておく
+                self._workspace_signature = file2signature(self._input_filename)
+
+        with FileLock(self._datajson_filename):
+            self._fold_pending(record_only)
+        return postended_actions
+
+    def record(self, actions):
+        '''
+        workspace を介さずに postend を記録し、レポートも更新する(serve で使う)。
+        process() の 2 と同じく、PendingJournal を通してデータのロックを取った中で書く。
+        '''
+        self._validate_data()
+        self._journal.append(actions)
+        with FileLock(self._datajson_filename):
+            self._fold_pending(record_only=False)
+
+    def load_aggregate(self):
+        '''
+        いまのデータの Aggregate。持っていて、データも他の実行に書き換えられていなければそれを返す。
+        (serve で使う。何度呼んでも signature を見るだけで軽い)
+        '''
+        is_fresh = self._aggregate is not None and self._loaded_signature==self._backend.signature()
+        if is_fresh:
+            return self._aggregate
+
+        self._validate_data()
+        with FileLock(self._datajson_filename):
+            self._forget_loaded()
+            self._loaded_signature = self._backend.signature()
+            if self._backend.HAS_QUERYABLE_HISTORY:
+                with self._backend.open_history() as history:
+                    self._aggregate = self._load_or_build_aggregate(history)
+            else:
+                self._actionstore = self._backend.load()
+                self._aggregate = self._load_or_build_aggregate(self._actionstore)
+        return self._aggregate
+
+    def _load_or_build_aggregate(self, actionstore):
+        aggregate = load_aggregate_cache(self._aggregatecache_filename, self._loaded_signature)
+        if aggregate is None:
+            aggregate = Report(actionstore).aggregate
+        return aggregate
+
+    def _fold_pending(self, record_only):
+        profiler = self._profiler
+
+        # journal は書けてから消す。読み込みや書き込みで落ちても postend は次の実行に残る
+        pending_actions, pending_line_count = self._journal.read()
+        nothing_pending = len(pending_actions)==0
+        if nothing_pending:
+            if not record_only:
+                self._update_reports_if_stale()
+            return
+
+        can_skip_load = record_only and not self._backend.RECORD_NEEDS_ACTIONSTORE
+        if can_skip_load:
+            with profiler.stage('record'):
+                self._backend.record(self._actionstore, pending_actions)
+                self._journal.discard(pending_line_count)
+            self._forget_loaded()
+            return
+
+        if self._backend.HAS_QUERYABLE_HISTORY:
+            self._fold_pending_into_queryable(pending_actions, pending_line_count)
+            return
+
+        with profiler.stage('load'):
+            # 他の実行が書いていたら、持っているものは古い
+            signature_before_postend = self._backend.signature()
+            is_stale = self._loaded_signature!=signature_before_postend
+            if is_stale:
+                self._forget_loaded()
+            if self._actionstore is None:
+                self._actionstore = self._backend.load()
+            out_actionstore = self._actionstore
+            for action in pending_actions:
+                for ordinal, count in action.ordinal_counts:
+                    out_actionstore.add_ordinal(action.name, ordinal, count)
+
+        with profiler.stage('record'):
+            try:
+                self._backend.record(out_actionstore, pending_actions)
+            except BaseException:
+                # pending_actions を足したまま持っていると、次に畳み込むときに二重に数える
+                self._forget_loaded()
+                raise
+            self._journal.discard(pending_line_count)
+            self._loaded_signature = self._backend.signature()
+
+        if record_only:
+            self._aggregate = None
+            return
+
+        self._update_reports(out_actionstore, signature_before_postend, pending_actions)
+
+    def _fold_pending_into_queryable(self, pending_actions, pending_line_count):
+        ''' データは読み込まずに記録し、集計は history から索引で引く '''
+        profiler = self._profiler
+
+        with profiler.stage('load'):
+            # 集計のキャッシュが使えるかは、記録する前のデータの signature で見る
+            signature_before_postend = self._backend.signature()
+            is_stale = self._loaded_signature!=signature_before_postend
+            if is_stale:
+                self._forget_loaded()
+
+        with profiler.stage('record'):
+            self._backend.record(None, pending_actions)
+            self._journal.discard(pending_line_count)
+            self._loaded_signature = self._backend.signature()
+
+        # history は開いた時点の action の並びなどを持っているので、記録してから開きなおす
+        with self._backend.open_history() as history:
+            self._update_reports(history, signature_before_postend, pending_actions)
+
+    def _update_reports_if_stale(self):
+        '''
+        postend が無くても、集計(のキャッシュ)がデータに追いついていなければレポートを作り直す。
+        (--record-only の後や、レポートを書いている途中で落ちた後)
+        '''
+        signature = self._backend.signature()
+        is_fresh = self._aggregate is not None and self._loaded_signature==signature
+        if is_fresh:
+            return
+        no_data = all(elm is None for elm in signature)
+        if no_data or is_aggregate_cache_fresh(self._aggregatecache_filename, signature):
+            return
+
+        self._forget_loaded()
+        if self._backend.HAS_QUERYABLE_HISTORY:
+            with self._profiler.stage('load'):
+                history = self._backend.open_history()
+            self._loaded_signature = signature
+            with history:
+                self._update_reports(history, signature, [])
+            return
+        with self._profiler.stage('load'):
+            self._actionstore = self._backend.load()
+        self._loaded_signature = signature
+        self._update_reports(self._actionstore, signature, [])
+
+    def _update_reports(self, actionstore, signature_before_postend, pending_actions):
+        '''
+        @param actionstore pending_actions を反映済みのもの(ActionStore と同じように引けるもの)
+        @param signature_before_postend 集計のキャッシュが pending_actions を足す前のデータのものか見るのに使う
+        '''
+        profiler = self._profiler
+
+        with profiler.stage('aggregate'):
+            aggregate = self._aggregate
+            # 足してレポートを書き終わるまでは持っておかない(途中で落ちたら、次は作り直させる)
+            self._aggregate = None
+            if aggregate is None:
+                aggregate = load_aggregate_cache(self._aggregatecache_filename, signature_before_postend)
+            if aggregate is None:
+                aggregate = Report(actionstore).aggregate
+                incremental = False
+            else:
+                aggregate.clear_touched()
+                for action in pending_actions:
+                    for ordinal, count in action.ordinal_counts:
+                        aggregate.add_ordinal(action.name, ordinal, count)
+                incremental = True
+            windowed_aggregates = windowed_aggregates_from_actionstore(actionstore, self._windows)
+
+        with profiler.stage('write_reports'):
+            write_reports(self._report_directory, aggregate, incremental, windowed_aggregates, self._top)
+            write_leaderboard(self._report_directory, aggregate, self._top)
+            # キャッシュはレポートを書けてから。書けずに落ちたら、次の実行はキャッシュが古いので作り直す
+            save_aggregate_cache(self._aggregatecache_filename, aggregate, self._loaded_signature)
+            self._aggregate = aggregate
+
+    def _forget_loaded(self):
+        ''' 読み込まずに記録した、あるいは他の実行が書いたので、持っているものは古くなった '''
+        self._actionstore = None
+        self._aggregate = None
+        self._loaded_signature = None
+
+    @property
+    def input_filename(self):
+        return self._input_filename
+
+    @property
+    def workspace_signature(self):
+        ''' 最後の process() が workspace を書き直した直後の (mtime, size)。まだなら None '''
+        return self._workspace_signature
+
+def windows_from_arguments(daily_window, weekly_window):
+    windows = {}
+    if daily_window is not None:
+        windows['daily'] = daily_window
+    if weekly_window is not None:
+        windows['weekly'] = weekly_window
+    return windows
+
+def run(input_filename, datajson_filename, report_directory, storage='json', record_only=False, profiler=None, windows=None, top=None):
+    ''' @return postend された actions '''
+    session = Session(input_filename, datajson_filename, report_directory, storage, profiler, windows, top)
+    return session.process(record_only)
+
+QUERY_PERIODS = ['day', 'week', 'month', 'year', 'total']
+
+def query_counts(history, action_name, datestr_from, datestr_to, by='total'):
+    '''
+    @return [(見出し, count), ...] 古い順。各期間は [datestr_from, datestr_to] の中だけを数える。
+    week は週次レポートと同じく土曜日基点で、見出しはその土曜日。
+    '''
+    ordinal_from = datestr2ordinal(datestr_from)
+    ordinal_to = datestr2ordinal(datestr_to)
+    if ordinal_to<ordinal_from:
+        raise RuntimeError(f'--from {datestr_from} is after --to {datestr_to}.')
+
+    if by=='total':
+        count = history.get_range_count_by_ordinal(action_name, ordinal_from, ordinal_to)
+        return [(f'{datestr_from}-{datestr_to}', count)]
+
+    periods = []
+    if by=='day':
+        for ordinal in range(ordinal_from, ordinal_to+1):
+            periods.append((ordinal2datestr(ordinal), ordinal, ordinal))
+    elif by=='week':
+        saturday = ordinal2saturday(ordinal_from)
+        while saturday-6<=ordinal_to:
+            periods.append((ordinal2datestr(saturday), saturday-6, saturday))
+            saturday += 7
+    elif by=='month':
+        for month in range(ordinal2month(ordinal_from), ordinal2month(ordinal_to)+1):
+            first, last = month2ordinal_range(month)
+            periods.append((month2datestr(month), first, last))
+    elif by=='year':
+        year_from = month2year(ordinal2month(ordinal_from))
+        year_to = month2year(ordinal2month(ordinal_to))
+        for year in range(year_from, year_to+1):
+            first, _ = month2ordinal_range(year*12)
+            _, last = month2ordinal_range(year*12+11)
+            periods.append((year2datestr(year), first, last))
+    else:
+        raise RuntimeError(f'--by "{by}" not supported.')
+
+    counts = []
+    for label, first, last in periods:
+        count = history.get_range_count_by_ordinal(action_name, max(first, ordinal_from), min(last, ordinal_to))
+        counts.append((label, count))
+    return counts
+
+def query(datajson_filename, storage, action_name, datestr_from, datestr_to, by='total'):
+    '''
+    PostendDetector も Report も通さず、QueryIndex(sqlite, sharded ならデータそのもの)から直接答える。
+    @return 出力する行
+    '''
+    if not os.path.exists(datajson_filename):
+        raise RuntimeError(f'data-json invalid: {datajson_filename}')
+    backend = storage_backend_from_name(storage, datajson_filename)
+    # 読み込まずに引ける backend(sqlite, sharded)なら、そのまま引く
+    if backend.HAS_QUERYABLE_HISTORY:
+        history = backend.open_history()
+    else:
+        history = QueryIndex(backend).open()
+    with history:
+        counts = query_counts(history, action_name, datestr_from, datestr_to, by)
+
+    lines = []
+    has_day = by in ['day', 'week']
+    for label, count in counts:
+        if has_day:
+            lines.append(f'{label} {datestr2dow_eng(label)} {count}')
+            continue
+        lines.append(f'{label} {count}')
+    return lines
+
+def write_profile(report_directory, profiler):
+    ''' counte_profile.json と(あれば) counte_report.prof をレポートの隣に書く '''
+    if not profiler.enabled:
+        return
+    profile_fullpath = os.path.join(report_directory, 'counte_profile.json')
+    str2file(profile_fullpath, profiler.to_jsonstring())
+    cprofile_fullpath = os.path.join(report_directory, 'counte_report.prof')
+    profiler.dump_cprofile(cprofile_fullpath)
+
+class WorkspaceWatcher:
+    '''
+    workspace の mtime/size を見て、変わっていたら Session.process() する。
+    process() 自身が workspace を書き直すので、その直後(workspace のロックを持っている間)の状態を覚え直しておく。
+    process() が終わってから測ると、その間に保存された分を見落とす。
+    '''
+    def __init__(self, session):
+        self._session = session
+        self._signature = None
+
+    def poll(self):
+        ''' @return 変わっていなければ None、変わっていれば postend された actions '''
+        signature = file2signature(self._session.input_filename)
+        unchanged = signature==self._signature
+        if unchanged:
+            return None
+        actions = self._session.process()
+        self._signature = self._session.workspace_signature
+        return actions
+
+def read_batch_entries(path):
+    '''
+    @return [(input_scb, data_json, report_directory), ...]
+
+    path がディレクトリなら、workspace.scb を持つサブディレクトリを1人分とみなす。
+      path/
+        alice/workspace.scb   -> alice/counte.json, レポートも alice/ に出す
+        bob/workspace.scb
+
+    path がファイルなら manifest(JSON)。相対パスは manifest からの相対。
+      [
+        {"input-scb": "alice.scb", "data-json": "alice.json", "report-directory": "alice"},
+        ...
+      ]
+    '''
+    entries = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            directory = os.path.join(path, name)
+            input_filename = os.path.join(directory, 'workspace.scb')
+            if not os.path.isfile(input_filename):
+                continue
+            datajson_filename = os.path.join(directory, 'counte.json')
+            entries.append((input_filename, datajson_filename, directory))
+        return entries
+
+    basedir = os.path.dirname(os.path.abspath(path))
+    for d in str2dict(file2str(path)):
+        entry = tuple(
+            os.path.join(basedir, d[k]) for k in ['input-scb', 'data-json', 'report-directory']
+        )
+        entries.append(entry)
+    return entries
+
+def _run_batch_entry(entry, storage, record_only, windows, top, profile, profile_cprofile):
+    ''' 1人分の失敗が他に波及しないよう、例外はここで結果に畳む '''
+    input_filename, datajson_filename, report_directory = entry
+    result = {
+        'input-scb': input_filename,
+        'postended': 0,
+        'error': None,
+    }
+    start = time.perf_counter()
+    try:
+        cprofile_stages = Session.REPORT_STAGES if profile_cprofile else []
+        profiler = StageProfiler(profile or profile_cprofile, cprofile_stages)
+        actions = run(input_filename, datajson_filename, report_directory, storage, record_only, profiler, windows, top)
+        result['postended'] = sum(action.count for action in actions)
+        write_profile(report_directory, profiler)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+def run_batch(entries, storage='json', jobs=None, record_only=False, windows=None, top=None, profile=False, profile_cprofile=False):
+    '''
+    jobs==1 ならプロセスプールを使わずにこのプロセスで順に回す。
+    record_only 以降は1人ずつの run() にそのまま渡す(profile ならそれぞれのレポートの隣に書く)
+    '''
+    options = (storage, record_only, windows, top, profile, profile_cprofile)
+    if jobs==1:
+        return [_run_batch_entry(entry, *options) for entry in entries]
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_run_batch_entry, entry, *options) for entry in entries]
+        return [future.result() for future in futures]
+
+def batch_summary_lines(results, elapsed):
+    outlines = []
+    errorcount = 0
+    for result in results:
+        status = 'ok'
+        note = f'{result["postended"]} postended'
+        if result['error'] is not None:
+            status = 'error'
+            note = result['error']
+            errorcount += 1
+        outlines.append(f'{status:5} {result["elapsed"]:.3f}s {result["input-scb"]} {note}')
+    outlines.append(f'total {elapsed:.3f}s {len(results)} workspaces, {errorcount} errors')
+    return outlines
+
+class ReportCache:
+    '''
+    ある period のレポートを、描いた状態でセクション(見出しの日付)ごとに持っておく。
+    新しい postend があったら、触ったセクションだけを描き直して本文と ETag を作り直す。
+    本文はファイルのレポート(counte_xxxx.scb)と同じ。
+    '''
+    def __init__(self, period):
+        self._period = period
+        self._sections = {}
+        self._body = b''
+        self._etag = None
+
+    def rebuild(self, aggregate):
+        xxxxcounts = aggregate.xxxxcounts_by_period(self._period)
+        self._sections = {}
+        for key in xxxxcounts:
+            self._sections[key] = FileReport.section_lines(key, xxxxcounts[key])
+        self._join()
+
+    def update(self, aggregate, keys):
+        xxxxcounts = aggregate.xxxxcounts_of_by_period(self._period, keys)
+        for key in keys:
+            # 触ったけれど出さない key(実在しない土曜日の週など)もある
+            is_shown = key in xxxxcounts
+            if is_shown:
+                self._sections[key] = FileReport.section_lines(key, xxxxcounts[key])
+                continue
+            self._sections.pop(key, None)
+        self._join()
+
+    def _join(self):
+        import hashlib
+        lines = []
+        for key in sorted(self._sections, reverse=True):
+            lines.extend(self._sections[key])
+        self._body = ''.join([f'{line}\n' for line in lines]).encode('utf8')
+        self._etag = f'"{hashlib.sha1(self._body).hexdigest()}"'
+
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def etag(self):
+        return self._etag
+
+class CounteServer:
+    '''
+    serve モード。localhost で HTTP を受ける。
+
+      GET  /daily, /weekly, /monthly, /yearly
+           レポート(text/plain)。ETag を付けるので、If-None-Match が合えば 304 を返す
+      POST /postend  {"action": "筋トレ", "marks": "x30"}
+           marks は workspace と同じ(x=今日, y=昨日, x12=今日12回。省略時は "x")
+
+    Session を持ち続けるので、データと Aggregate は読み込んだままになる。
+    postend は Session.record() で記録し(ファイルのレポートも更新される)、
+    period ごとの ReportCache は触ったセクションだけ描き直す。
+    他の実行がデータを書いたら、次のリクエストで読み直して描き直す。
+    '''
+    def __init__(self, datajson_filename, report_directory, storage='json', host='127.0.0.1', port=0):
+        from http.server import HTTPServer
+
+        self._session = Session(None, datajson_filename, report_directory, storage)
+        self._caches = {period: ReportCache(period) for period in REPORT_FILENAMES}
+        self._aggregate = None
+        self._httpserver = HTTPServer((host, port), self._handler_class())
+
+    def _handler_class(self):
+        from http.server import BaseHTTPRequestHandler
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._do_get(self)
+
+            def do_POST(self):
+                server._do_post(self)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def _refresh(self):
+        ''' Session の Aggregate が入れ替わっていたら(読み直したら)全部描き直す '''
+        aggregate = self._session.load_aggregate()
+        is_replaced = aggregate is not self._aggregate
+        if is_replaced:
+            for cache in self._caches.values():
+                cache.rebuild(aggregate)
+            self._aggregate = aggregate
+
+    def report(self, period):
+        ''' @return ReportCache '''
+        self._refresh()
+        return self._caches[period]
+
+    def postend(self, action_name, marks='x'):
+        ''' @return 記録した Action '''
+        detector = PostendDetector(WorkspaceReader(), WorkspaceWriter())
+        is_postended, action = detector.detect_postend(f'{marks} {action_name}')
+        invalid_marks = len(marks.strip('xy0123456789'))>0
+        # レポートは1行1 action で、インデントの無い行はセクションの見出しになる。そう読まれてしまう名前は断る
+        invalid_name = len(action_name.strip())==0 or action_name[0].isspace() or '\n' in action_name or '\r' in action_name
+        if not is_postended or invalid_marks or action.count==0 or invalid_name:
+            raise ValueError(f'invalid postend: "{marks} {action_name}"')
+
+        self._refresh()
+        self._session.record([action])
+        aggregate = self._session.load_aggregate()
+        is_incremental = aggregate is self._aggregate
+        if is_incremental:
+            for period in self._caches:
+                self._caches[period].update(aggregate, aggregate.touched_keys_by_period(period))
+        self._refresh()
+        return action
+
+    def _respond(self, request, status, body=b'', headers=None):
+        if headers is None:
+            headers = {}
+        request.send_response(status)
+        for name in headers:
+            request.send_header(name, headers[name])
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _do_get(self, request):
+        period = request.path.split('?')[0].strip('/')
+        notfound = period not in self._caches
+        if notfound:
+            self._respond(request, 404)
+            return
+        try:
+            cache = self.report(period)
+        except RuntimeError as e:
+            self._respond(request, 500, str(e).encode('utf8'))
+            return
+
+        headers = {'ETag': cache.etag}
+        is_not_modified = request.headers.get('If-None-Match')==cache.etag
+        if is_not_modified:
+            self._respond(request, 304, headers=headers)
+            return
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        self._respond(request, 200, cache.body, headers)
+
+    def _do_post(self, request):
+        path = request.path.split('?')[0].strip('/')
+        if path!='postend':
+            self._respond(request, 404)
+            return
+        try:
+            length = int(request.headers.get('Content-Length', 0))
+            d = str2dict(request.rfile.read(length).decode('utf8'))
+            action = self.postend(d['action'], d.get('marks', 'x'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._respond(request, 400, str(e).encode('utf8'))
+            return
+        except RuntimeError as e:
+            self._respond(request, 500, str(e).encode('utf8'))
+            return
+
+        body = dict2str({'action': action.name, 'counts': action.datestr_counts}, ensure_ascii=False)
+        self._respond(request, 200, body.encode('utf8'), {'Content-Type': 'application/json; charset=utf-8'})
+
+    def serve_forever(self):
+        self._httpserver.serve_forever()
+
+    def shutdown(self):
+        ''' serve_forever() を止める(別のスレッドから呼ぶ) '''
+        self._httpserver.shutdown()
+
+    def close(self):
+        self._httpserver.server_close()
+
+    @property
+    def server_address(self):
+        return self._httpserver.server_address
+
+if __name__ == "__main__":
+    is_query = len(sys.argv)>1 and sys.argv[1]=='query'
+    if is_query:
+        args = parse_query_arguments(sys.argv[2:])
+        try:
+            lines = query(args.data_json, args.storage, args.action, args.datestr_from, args.datestr_to, args.by)
+        except (RuntimeError, ValueError) as e:
+            abort(e)
+        for line in lines:
+            print(line)
+        sys.exit(0)
+
+    is_serve = len(sys.argv)>1 and sys.argv[1]=='serve'
+    if is_serve:
+        args = parse_serve_arguments(sys.argv[2:])
+        try:
+            server = CounteServer(args.data_json, args.report_directory, args.storage, args.host, args.port)
+        except (RuntimeError, OSError) as e:
+            abort(e)
+        host, port = server.server_address[:2]
+        print(f'serving on http://{host}:{port}/ ... (Ctrl+C to quit)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.close()
+            sys.exit(0)
+
+    args = parse_arguments()
+
+    windows = windows_from_arguments(args.daily_window, args.weekly_window)
+
+    if args.batch:
+        start = time.perf_counter()
+        entries = read_batch_entries(args.batch)
+        results = run_batch(entries, args.storage, args.jobs,
+            args.record_only, windows, args.top, args.profile, args.profile_cprofile)
+        for line in batch_summary_lines(results, time.perf_counter() - start):
+            print(line)
+        has_error = any(result['error'] is not None for result in results)
+        sys.exit(1 if has_error else 0)
+
+    input_filename = args.input_scb
+    datajson_filename = args.data_json
+    report_directory = args.report_directory
 
-    jsonstr = file2str(datajson_filename)
-    actionstorage = ActionStorage.from_jsonstring(jsonstr)
-    out_actionstore = actionstorage.to_actionstore()
+    if args.compact:
+        backend = storage_backend_from_name(args.storage, datajson_filename)
+        try:
+            with FileLock(datajson_filename):
+                # JSON のままの counte.json は、先にこの backend の形式へ移し替える
+                backend.import_json_data()
+                backend.compact()
+        except RuntimeError as e:
+            abort(e)
+        sys.exit(0)
+
+    cprofile_stages = Session.REPORT_STAGES if args.profile_cprofile else []
+    profiler = StageProfiler(args.profile or args.profile_cprofile, cprofile_stages)
+
+    if args.watch:
+        session = Session(input_filename, datajson_filename, report_directory, args.storage, profiler, windows, args.top)
+        watcher = WorkspaceWatcher(session)
+        print(f'watching {input_filename} ... (Ctrl+C to quit)')
+        try:
+            while True:
+                try:
+                    postended_actions = watcher.poll()
+                except (RuntimeError, OSError) as e:
+                    print(f'Error! {e}')
+                    postended_actions = None
+                for action in postended_actions or []:
+                    print(f'{action.name}: {action.datestr_counts}')
+                if postended_actions is not None:
+                    write_profile(report_directory, profiler)
+                time.sleep(args.watch_interval)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    try:
+        postended_actions = run(input_filename, datajson_filename, report_directory, args.storage, args.record_only, profiler, windows, args.top)
+    except RuntimeError as e:
+        abort(e)
     for action in postended_actions:
-        print(f'{action.name}: {action.history}')
-        for datestr in action.history:
-            out_actionstore.add(action.name, datestr)
-    out_actionstorage = ActionStorage.from_actionstore(out_actionstore)
-
-    ws_writer.save(input_filename)
-    out_jsonstr = out_actionstorage.to_jsonstring_pretty(indent=2)
-    str2file(datajson_filename, out_jsonstr)
-
-    report = Report(out_actionstore)
-    filereport = FileReport(report)
-    dailyfile_fullpath = os.path.join(report_directory, 'counte_daily.scb')
-    list2file(dailyfile_fullpath, filereport.dailycounts_by_lines)
-    weeklyfile_fullpath = os.path.join(report_directory, 'counte_weekly.scb')
-    list2file(weeklyfile_fullpath, filereport.weeklycounts_by_lines)
+        print(f'{action.name}: {action.datestr_counts}')
+    write_profile(report_directory, profiler)
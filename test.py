@@ -1,10 +1,59 @@
 # coding: utf-8
 
 import unittest
+import unittest.mock
 import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
 
+import bench
 import counte
 
+class TestStartup(unittest.TestCase):
+    '''
+    counte は1日に何十回も起動するので import 時間に予算を決めておく。
+    pyc を作ってから(2回目の) python -X importtime の値を見る。
+    '''
+    IMPORT_BUDGET_US = 15000
+    HEAVY_MODULES = ['json', 'datetime', 'argparse', 'mmap', 'concurrent.futures']
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._env = dict(os.environ)
+        self._env.pop('PYTHONDONTWRITEBYTECODE', None)
+        self._env['PYTHONPATH'] = os.path.dirname(os.path.abspath(counte.__file__))
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _python(self, *args):
+        commandline = [sys.executable, '-X', f'pycache_prefix={self._tempdir.name}', *args]
+        completed = subprocess.run(commandline, env=self._env, capture_output=True, text=True,
+            cwd=self._tempdir.name, check=True)
+        return completed
+
+    def _import_time_us(self):
+        completed = self._python('-X', 'importtime', '-c', 'import counte')
+        for line in completed.stderr.splitlines():
+            _, cumulative, name = line.split('|')
+            if name.strip()=='counte':
+                return int(cumulative)
+        raise RuntimeError('counte not found in importtime output.')
+
+    def test_import_time(self):
+        self._import_time_us()
+        best = min(self._import_time_us() for _ in range(3))
+        self.assertLess(best, self.IMPORT_BUDGET_US)
+
+    def test_no_heavy_import(self):
+        code = 'import sys, counte; print(" ".join(sorted(sys.modules)))'
+        loaded = self._python('-c', code).stdout.split()
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, loaded)
+
 class TestTimerstamp(unittest.TestCase):
     def setUp(self):
         pass
@@ -39,6 +88,22 @@ class TestTimerstamp(unittest.TestCase):
         ]
         self.assertListEqual(a, e)
 
+    def testOrdinal(self):
+        ordinal = counte.datestr2ordinal('2023/02/12')
+        self.assertEqual(ordinal, datetime.date(2023, 2, 12).toordinal())
+        self.assertEqual(counte.ordinal2datestr(ordinal), '2023/02/12')
+        self.assertEqual(counte.ordinal2weekday(ordinal), datetime.date(2023, 2, 12).weekday())
+        self.assertEqual(counte.ordinal2datestr(counte.ordinal2saturday(ordinal)), '2023/02/18')
+        self.assertEqual(counte.ordinal2saturday(ordinal+6), ordinal+6)
+        self.assertEqual(counte.datestr2dow_eng('2023/02/12'), 'Sun')
+
+        month = counte.ordinal2month(ordinal)
+        self.assertEqual(month, counte.datestr2month('2023/02'))
+        self.assertEqual(counte.month2datestr(month), '2023/02')
+        ordinal_from, ordinal_to = counte.month2ordinal_range(counte.datestr2month('2023/12'))
+        self.assertEqual(counte.ordinal2datestr(ordinal_from), '2023/12/01')
+        self.assertEqual(counte.ordinal2datestr(ordinal_to), '2023/12/31')
+
     def testDatestrRemove(self):
         a = counte.Timestamp.remove_day_from_datestr('2023/02/01')
         e = '2023/02'
@@ -116,6 +181,26 @@ class TestActionStore(unittest.TestCase):
         self.assertEqual(acst.get_monthly_count('action1', '2023/03'), 1)
         self.assertEqual(acst.get_monthly_count('action1', '2023/04'), 0)
 
+    def test_range(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/11')
+        acst.add('action1', '2023/02/01')
+        acst.add('action1', '2023/02/11')
+        acst.add('action1', '2023/03/01')
+
+        with self.assertRaises(RuntimeError):
+            acst.get_range_count('not found', '2023/01/01', '2023/12/31')
+
+        self.assertEqual(acst.get_range_count('action1', '2023/01/01', '2023/12/31'), 4)
+        self.assertEqual(acst.get_range_count('action1', '2023/02/01', '2023/02/11'), 3)
+        self.assertEqual(acst.get_range_count('action1', '2023/02/02', '2023/02/10'), 0)
+        self.assertEqual(acst.get_range_count('action1', '2023/03/01', '2023/02/01'), 0)
+
+        # add した後も索引が追従する
+        acst.add('action1', '2023/02/05')
+        self.assertEqual(acst.get_range_count('action1', '2023/02/02', '2023/02/10'), 1)
+        self.assertEqual(acst.get_count('action1'), 5)
+
 class MockWorkspaceReader(counte.WorkspaceReader):
     def __init__(self):
         super().__init__()
@@ -191,6 +276,35 @@ yxxy action2-y2
         self.assertEqual(writee_lines[4], ' action1-y1')
         self.assertEqual(writee_lines[5], ' action2-y2')
 
+    def test_count(self):
+        testdata = '''
+x12 action1
+x3y2 action2
+y10x action3
+xx2 action4
+x0 action5
+x4294967295 action6
+'''
+        T = counte.Timestamp.get_today_ordinal()
+        Y = T - 1
+
+        ws_reader = MockWorkspaceReader()
+        ws_writer = MockWorkspaceWriter()
+        ws_reader.parse(testdata)
+        actions = counte.PostendDetector(ws_reader, ws_writer).postended_actions()
+
+        self.assertListEqual(actions[0].ordinal_counts, [(T, 12)])
+        self.assertEqual(actions[0].count, 12)
+        self.assertListEqual(actions[1].ordinal_counts, [(T, 3), (Y, 2)])
+        self.assertListEqual(actions[2].ordinal_counts, [(Y, 10), (T, 1)])
+        self.assertListEqual(actions[3].ordinal_counts, [(T, 3)])
+        self.assertListEqual(actions[3].ordinals, [T, T, T])
+        self.assertEqual(actions[4].count, 0)
+        # 大きな回数も展開せずに持つ
+        self.assertListEqual(actions[5].ordinal_counts, [(T, 4294967295)])
+        self.assertListEqual(actions[5].datestr_counts, [[counte.ordinal2datestr(T), 4294967295]])
+        self.assertListEqual(ws_writer.lines, [' action1', ' action2', ' action3', ' action4', ' action5', ' action6'])
+
 class TestActionStorage(unittest.TestCase):
     def setUp(self):
         pass
@@ -232,35 +346,847 @@ class TestActionStorage(unittest.TestCase):
         # expect は内部的には json.dumps の仕様に従うしかない。
         # たとえば key 名の次の : との間にはスペースが無い、とか。
         expect = '''{
-  "action0": [
-    "2023/06/01"
-  ],
-  "action1": [
-    "2023/05/28",
-    "2023/06/01"
-  ],
+  "action0": {
+    "2023/06/01": 1
+  },
+  "action1": {
+    "2023/05/28": 1,
+    "2023/06/01": 1
+  },
+  "action2": {
+    "2023/05/27": 1,
+    "2023/05/28": 2
+  },
+  "action3": {
+    "2023/05/27": 1,
+    "2023/05/28": 3
+  },
+  "action4": {
+    "2023/06/01": 1,
+    "2023/06/02": 1
+  }
+}'''
+        self.assertEqual(expect, actual)
+
+    def test_v2(self):
+        testdata = '''{
+  "action1": {
+    "2023/05/28": 30
+  },
   "action2": [
     "2023/05/28",
     "2023/05/27",
     "2023/05/28"
-  ],
-  "action3": [
-    "2023/05/28",
-    "2023/05/28",
-    "2023/05/28",
-    "2023/05/27"
-  ],
-  "action4": [
-    "2023/06/01",
-    "2023/06/02"
   ]
 }'''
+        actionstorage = counte.ActionStorage.from_jsonstring(testdata)
+        actionstore = actionstorage.to_actionstore()
+        self.assertEqual(actionstore.get_count('action1'), 30)
+        self.assertEqual(actionstore.get_daily_count('action2', '2023/05/28'), 2)
+
+        # v1 の action も v2 で書き出される
+        actual = counte.ActionStorage.from_actionstore(actionstore).to_jsonstring_pretty(indent=None)
+        expect = '{"action1": {"2023/05/28": 30}, "action2": {"2023/05/27": 1, "2023/05/28": 2}}'
         self.assertEqual(expect, actual)
 
     def test_from_empty(self):
         emptystring = ''
         counte.ActionStorage.from_jsonstring(emptystring)
 
+class TestBinaryHistory(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _actionstore(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/01')
+        acst.add('action1', '2023/02/02', 2)
+        acst.add('action1', '2023/02/11', 2)
+        acst.add('action1', '2023/02/12')
+        acst.add('action1', '2023/03/01')
+        acst.add('アクション2', '2022/12/31')
+        acst.add('アクション2', '2023/02/12')
+        return acst
+
+    def test(self):
+        acst = self._actionstore()
+        b = counte.ActionStorage.from_actionstore(acst).to_binarybytes()
+        history = counte.BinaryHistory(b)
+
+        self.assertListEqual(history.action_names, ['action1', 'アクション2'])
+        self.assertEqual(history.get_count('action1'), 7)
+        self.assertEqual(history.get_count('not found'), 0)
+        self.assertEqual(history.count_total, 9)
+        with self.assertRaises(RuntimeError):
+            history.get_daily_count('not found', '2023/02/01')
+
+        self.assertEqual(history.get_daily_count('action1', '2023/02/02'), 2)
+        self.assertEqual(history.upper_ordinal, counte.datestr2ordinal('2023/03/01'))
+        f, t = counte.datestr2ordinal('2023/02/02'), counte.datestr2ordinal('2023/02/12')
+        self.assertDictEqual(history.get_daycounts_between_by_ordinal('action1', f, t),
+            acst.get_daycounts_between_by_ordinal('action1', f, t))
+        self.assertEqual(history.get_daily_count('action1', '2023/02/03'), 0)
+        self.assertEqual(history.get_weekly_count('action1', '2023/02/12'), 3)
+        self.assertEqual(history.get_monthly_count('action1', '2023/02'), 6)
+        self.assertEqual(history.get_monthly_count('アクション2', '2022/12'), 1)
+        self.assertEqual(history.get_range_count('action1', '2023/02/02', '2023/02/11'), 4)
+        self.assertDictEqual(history.get_daycounts('action1'), acst.get_daycounts('action1'))
+
+        self.assertDictEqual(counte.Report(history).dailycounts, counte.Report(acst).dailycounts)
+
+    def test_large_count(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/01', 2**32)
+        acst.add('action1', '2023/02/02', 2**32)
+        history = counte.BinaryHistory(counte.ActionStorage.from_actionstore(acst).to_binarybytes())
+        self.assertEqual(history.get_count('action1'), 2**33)
+        self.assertEqual(history.get_daily_count('action1', '2023/02/02'), 2**32)
+
+        # 前の形式(cumulative が u32)も読める
+        import array
+        import struct
+        old = b''.join([
+            struct.pack(counte.BinaryHistory.HEADER_FORMAT, b'CNTE', counte.BinaryHistory.BYTEORDER_MARK, 1, 2),
+            array.array('I', [0, 2]).tobytes(),
+            array.array('I', [counte.datestr2ordinal('2023/02/01'), counte.datestr2ordinal('2023/02/02')]).tobytes(),
+            array.array('I', [1, 3]).tobytes(),
+            b'["action1"]',
+        ])
+        history = counte.BinaryHistory(old)
+        self.assertEqual(history.get_daily_count('action1', '2023/02/02'), 2)
+        self.assertEqual(history.get_count('action1'), 3)
+
+    def test_file(self):
+        filepath = os.path.join(self._tempdir.name, 'counte.bin')
+        backend = counte.BinaryStorageBackend(filepath)
+        self.assertEqual(backend.load().count_total, 0)
+
+        # record() は postend 分だけを、今のファイルに足して書き直す
+        acst = self._actionstore()
+        actions = []
+        for name in acst.action_names:
+            action = counte.Action(name)
+            daycounts = acst.get_daycounts_by_ordinal(name)
+            for ordinal in sorted(daycounts):
+                action.add_ordinal(ordinal, daycounts[ordinal])
+            actions.append(action)
+        backend.record(None, actions[:1])
+        backend.record(None, actions)
+        with backend.open_history() as history:
+            self.assertListEqual(history.action_names, ['action1', 'アクション2'])
+            self.assertEqual(history.get_count('action1'), 14)
+            self.assertEqual(history.get_count('アクション2'), 2)
+        self.assertEqual(backend.load().get_daily_count('action1', '2023/02/11'), 4)
+
+        counte.list2file(filepath, [])
+        self.assertEqual(backend.load().count_total, 0)
+
+class TestStorageBackend(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._datajson = os.path.join(self._tempdir.name, 'counte.json')
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _postend(self, backend, pairs):
+        actionstore = backend.load()
+        actions = []
+        for action_name, datestr in pairs:
+            action = counte.Action(action_name)
+            action.add_datestr(datestr)
+            actions.append(action)
+            actionstore.add(action_name, datestr)
+        backend.record(actionstore, actions)
+
+    def test_log(self):
+        backend = counte.LogStorageBackend(self._datajson)
+        self.assertEqual(backend.load().count_total, 0)
+
+        self._postend(backend, [('action1', '2023/05/28'), ('action2', '2023/05/28')])
+        self._postend(backend, [('action1', '2023/05/29')])
+        # スナップショットには触らず log に追記するだけ
+        self.assertFalse(os.path.exists(self._datajson))
+        self.assertEqual(len(counte.file2list(backend.logpath)), 3)
+
+        actionstore = backend.load()
+        self.assertEqual(actionstore.get_count('action1'), 2)
+        self.assertEqual(actionstore.get_count('action2'), 1)
+
+        backend.compact()
+        self.assertEqual(len(counte.file2list(backend.logpath)), 0)
+        snapshot = counte.JsonStorageBackend(self._datajson).load()
+        self.assertEqual(snapshot.get_count('action1'), 2)
+        self.assertEqual(backend.load().count_total, 3)
+
+        self._postend(backend, [('action2', '2023/05/30')])
+        self.assertEqual(backend.load().get_count('action2'), 2)
+
+        # x12 は1行で記録する
+        action = counte.Action('action2')
+        action.add_datestr('2023/05/31', 12)
+        backend.record(None, [action])
+        self.assertEqual(counte.file2list(backend.logpath)[-1], '["2023/05/31", "action2", 12]')
+        self.assertEqual(backend.load().get_daily_count('action2', '2023/05/31'), 12)
+
+    def test_log_compact_crash(self):
+        ''' compact() のどこで落ちても、load() も次の compact() も数が合う '''
+        # (どれを, 何回目の呼び出しで落とすか)
+        crashes = [
+            (counte.JsonStorageBackend, 'record', 0),  # next を書く前
+            (counte.os, 'remove', 0),                  # next を書いた後、compacting を消す前
+            (counte.os, 'replace', 3),                 # スナップショットを差し替える前(log を移す、空の log、next の後)
+        ]
+        for target, name, passes in crashes:
+            for path in [self._datajson, f'{self._datajson}.log']:
+                if os.path.exists(path):
+                    os.remove(path)
+            backend = counte.LogStorageBackend(self._datajson)
+            self._postend(backend, [('action1', '2023/05/28'), ('action2', '2023/05/28')])
+            backend.compact()
+            self._postend(backend, [('action1', '2023/05/29')])
+
+            original = getattr(target, name)
+            calls = []
+            def crash(*args, **kwargs):
+                calls.append(args)
+                if len(calls)<=passes:
+                    return original(*args, **kwargs)
+                raise OSError('crash')
+            with unittest.mock.patch.object(target, name, crash):
+                with self.assertRaises(OSError):
+                    backend.compact()
+            self.assertEqual(backend.load().count_total, 3)
+            self._postend(backend, [('action2', '2023/05/29')])
+            self.assertEqual(backend.load().count_total, 4)
+
+            backend.compact()
+            self.assertEqual(counte.JsonStorageBackend(self._datajson).load().count_total, 4)
+            self.assertEqual(backend.load().count_total, 4)
+            self.assertFalse(os.path.exists(f'{self._datajson}.log.compacting'))
+            self.assertFalse(os.path.exists(f'{self._datajson}.next'))
+
+    def test_sqlite(self):
+        backend = counte.SqliteStorageBackend(self._datajson)
+        self.assertEqual(backend.load().count_total, 0)
+
+        self._postend(backend, [('action1', '2023/05/28'), ('action2', '2023/05/28')])
+        self._postend(backend, [('action1', '2023/05/29'), ('action1', '2023/05/29')])
+
+        with backend.open_history() as history:
+            self.assertListEqual(history.action_names, ['action1', 'action2'])
+            self.assertEqual(history.count_total, 4)
+            self.assertEqual(history.get_count('action1'), 3)
+            self.assertEqual(history.get_count('not found'), 0)
+            self.assertEqual(history.get_daily_count('action1', '2023/05/29'), 2)
+            self.assertEqual(history.get_weekly_count('action1', '2023/06/03'), 3)
+            self.assertEqual(history.get_monthly_count('action2', '2023/05'), 1)
+            self.assertEqual(history.upper_ordinal, counte.datestr2ordinal('2023/05/29'))
+            with self.assertRaises(RuntimeError):
+                history.get_daily_count('not found', '2023/05/29')
+            report = counte.Report(history)
+        expect = counte.Report(backend.load())
+        self.assertDictEqual(report.dailycounts, expect.dailycounts)
+        self.assertDictEqual(report.weeklycounts, expect.weeklycounts)
+
+        backend.compact()
+        actionstore = backend.load()
+        self.assertEqual(actionstore.get_daily_count('action1', '2023/05/29'), 2)
+        self.assertEqual(actionstore.count_total, 4)
+
+    def _run_and_check_reports(self, storage):
+        ''' 実行するたびに、レポートがデータから作り直したものと同じになっているか '''
+        root = self._tempdir.name
+        workspace = os.path.join(root, 'workspace.scb')
+        backend = counte.storage_backend_from_name(storage, self._datajson)
+        dailyreport = os.path.join(root, counte.REPORT_FILENAMES['daily'])
+        leaderboard = os.path.join(root, counte.LEADERBOARD_FILENAME)
+        # 1回目、action の増えない2回目、action の増える3回目
+        for workspace_lines in [['xx action1', 'x action2'], ['x action1'], ['x3 action3', 'x action1']]:
+            counte.list2file(workspace, workspace_lines)
+            counte.run(workspace, self._datajson, root, storage)
+            aggregate = counte.Aggregate.from_actionstore(backend.load())
+            expect = counte.FileReport.lines_by_DescOrder_and_MostCounted(aggregate.dailycounts)
+            self.assertListEqual(counte.file2list(dailyreport), expect)
+            self.assertListEqual(counte.file2list(leaderboard), counte.leaderboard_lines(aggregate))
+        self.assertEqual(backend.load().get_count('action1'), 4)
+
+    def test_sqlite_run(self):
+        self._run_and_check_reports('sqlite')
+
+    def _postend_to(self, backend, pairs):
+        ''' load() しない backend 向け '''
+        actions = []
+        for action_name, datestr in pairs:
+            action = counte.Action(action_name)
+            action.add_datestr(datestr)
+            actions.append(action)
+        backend.record(None, actions)
+
+    def test_sharded(self):
+        backend = counte.ShardedStorageBackend(self._datajson)
+        self.assertEqual(backend.load().count_total, 0)
+
+        self._postend_to(backend, [('action1', '2021/12/31'), ('action2', '2022/01/01')])
+        self._postend_to(backend, [('action1', '2023/05/28'), ('action1', '2023/05/29')])
+        for year in ['2021', '2022', '2023']:
+            self.assertTrue(os.path.exists(f'{self._datajson}.{year}'))
+
+        # 今年の分だけ書くなら、古い shard には触らない
+        old_shard = backend.shard_filepath(2021)
+        mtime = os.stat(old_shard).st_mtime_ns
+        self._postend_to(backend, [('action2', '2023/05/29')])
+        self.assertEqual(os.stat(old_shard).st_mtime_ns, mtime)
+
+        with backend.open_history() as history:
+            self.assertListEqual(history.action_names, ['action1', 'action2'])
+            self.assertEqual(history.count_total, 5)
+            self.assertEqual(history.get_count('action1'), 3)
+            self.assertEqual(history.upper_ordinal, counte.datestr2ordinal('2023/05/29'))
+            self.assertListEqual(history.loaded_years, [])
+
+            windowed = counte.windowed_aggregates_from_actionstore(history, {'daily': 7})
+            self.assertEqual(windowed['daily'].count_total, 3)
+            self.assertListEqual(history.loaded_years, [2023])
+
+            self.assertEqual(history.get_weekly_count('action1', '2022/01/01'), 1)
+            self.assertListEqual(history.loaded_years, [2021, 2023])
+            report = counte.Report(history)
+        expect = counte.Report(backend.load())
+        self.assertDictEqual(report.dailycounts, expect.dailycounts)
+        self.assertDictEqual(report.yearlycounts, expect.yearlycounts)
+
+    def test_sharded_run(self):
+        self._run_and_check_reports('sharded')
+
+    def test_binary_run(self):
+        self._run_and_check_reports('binary')
+
+    def test_import_json(self):
+        root = self._tempdir.name
+        workspace = os.path.join(root, 'workspace.scb')
+        for storage in ['sqlite', 'binary', 'sharded']:
+            counte.list2file(workspace, ['xx action1', 'x action2'])
+            counte.run(workspace, self._datajson, root)
+            expect = counte.JsonStorageBackend(self._datajson).load()
+
+            # JSON のままでは動かさない。postend は workspace に残る
+            counte.list2file(workspace, ['x action1'])
+            with self.assertRaises(RuntimeError):
+                counte.run(workspace, self._datajson, root, storage)
+            self.assertListEqual(counte.file2list(workspace), ['x action1'])
+
+            backend = counte.storage_backend_from_name(storage, self._datajson)
+            self.assertTrue(backend.import_json_data())
+            self.assertFalse(backend.import_json_data())
+            self.assertTrue(os.path.exists(f'{self._datajson}.json.bak'))
+            actionstore = backend.load()
+            for name in expect.action_names:
+                self.assertDictEqual(actionstore.get_daycounts(name), expect.get_daycounts(name))
+
+            counte.run(workspace, self._datajson, root, storage)
+            self.assertEqual(backend.load().get_count('action1'), 3)
+
+            self._tempdir.cleanup()
+            self._tempdir = tempfile.TemporaryDirectory()
+            root = self._tempdir.name
+            workspace = os.path.join(root, 'workspace.scb')
+            self._datajson = os.path.join(root, 'counte.json')
+
+    def test_sqlite_not_database(self):
+        counte.str2file(self._datajson, 'not a database, just some text' * 10)
+        backend = counte.SqliteStorageBackend(self._datajson)
+        with self.assertRaises(RuntimeError):
+            backend.load()
+
+class TestWorkspaceWatcher(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        root = self._tempdir.name
+        self._workspace = os.path.join(root, 'workspace.scb')
+        self._datajson = os.path.join(root, 'counte.json')
+        counte.list2file(self._workspace, ['x action1', ' action2'])
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test(self):
+        session = counte.Session(self._workspace, self._datajson, self._tempdir.name)
+        watcher = counte.WorkspaceWatcher(session)
+
+        actions = watcher.poll()
+        self.assertEqual(len(actions), 1)
+        self.assertIsNone(watcher.poll())
+
+        counte.list2file(self._workspace, [' action1', 'xx action2', 'x action3'])
+        actions = watcher.poll()
+        self.assertListEqual([action.name for action in actions], ['action2', 'action3'])
+        self.assertIsNone(watcher.poll())
+
+        actionstore = counte.JsonStorageBackend(self._datajson).load()
+        self.assertEqual(actionstore.count_total, 4)
+        T = counte.Timestamp.get_today_datestr()
+        dailylines = counte.file2list(os.path.join(self._tempdir.name, 'counte_daily.scb'))
+        self.assertTrue(dailylines[0].startswith(T))
+        self.assertTrue(dailylines[0].endswith(' 4'))
+
+    def test_save_during_process(self):
+        session = counte.Session(self._workspace, self._datajson, self._tempdir.name)
+        watcher = counte.WorkspaceWatcher(session)
+
+        # workspace のロックを放した後、データに書いている間に保存される
+        fold_pending = session._fold_pending
+        def fold_pending_while_saved(record_only):
+            counte.list2file(self._workspace, [' action1', 'xxx action2'])
+            fold_pending(record_only)
+        with unittest.mock.patch.object(session, '_fold_pending', fold_pending_while_saved):
+            actions = watcher.poll()
+        self.assertListEqual([action.name for action in actions], ['action1'])
+
+        actions = watcher.poll()
+        self.assertListEqual([action.name for action in actions], ['action2'])
+        self.assertEqual(counte.JsonStorageBackend(self._datajson).load().count_total, 4)
+
+class TestRecordOnly(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        root = self._tempdir.name
+        self._workspace = os.path.join(root, 'workspace.scb')
+        self._datajson = os.path.join(root, 'counte.json')
+        self._dailyreport = os.path.join(root, 'counte_daily.scb')
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_log(self):
+        root = self._tempdir.name
+        counte.list2file(self._workspace, ['x action1'])
+        counte.run(self._workspace, self._datajson, root, 'log')
+        counte.list2file(self._workspace, ['xx action1'])
+        counte.run(self._workspace, self._datajson, root, 'log', record_only=True)
+
+        self.assertListEqual(counte.file2list(self._workspace), [' action1'])
+        self.assertEqual(counte.LogStorageBackend(self._datajson).load().count_total, 3)
+        # レポートは触らない
+        self.assertTrue(counte.file2list(self._dailyreport)[0].endswith(' 1'))
+
+        # 次の通常実行でキャッシュが古いと気付いて作り直す
+        counte.list2file(self._workspace, ['x action2'])
+        counte.run(self._workspace, self._datajson, root, 'log')
+        self.assertTrue(counte.file2list(self._dailyreport)[0].endswith(' 4'))
+
+    def test_no_mark_after_record_only(self):
+        ''' --record-only の後は、mark が無い通常実行でもレポートを作り直す '''
+        root = self._tempdir.name
+        for storage in ['json', 'sqlite']:
+            datajson = f'{self._datajson}.{storage}'
+            counte.list2file(self._workspace, ['x action1'])
+            counte.run(self._workspace, datajson, root, storage)
+            counte.list2file(self._workspace, ['x action2'])
+            counte.run(self._workspace, datajson, root, storage, record_only=True)
+            counte.list2file(self._workspace, [' action1', ' action2'])
+            counte.run(self._workspace, datajson, root, storage)
+            lines = counte.file2list(self._dailyreport)
+            self.assertTrue(lines[0].endswith(' 2'))
+            self.assertListEqual(lines[1:3], [' 1 action2', ' 1 action1'])
+
+    def test_large_workspace(self):
+        ''' workspace は1行ずつ処理するので、大きくても detect のメモリはほぼ増えない '''
+        root = self._tempdir.name
+        lines = [f' action{i:06d}' for i in range(50000)]
+        lines[10] = 'x action000010'
+        lines[-1] = 'yx action049999'
+        counte.list2file(self._workspace, lines)
+        profiler = counte.StageProfiler(enabled=True)
+        actions = counte.run(self._workspace, self._datajson, root, profiler=profiler)
+
+        self.assertListEqual([action.name for action in actions], ['action000010', 'action049999'])
+        self.assertListEqual(counte.file2list(self._workspace), [f' action{i:06d}' for i in range(50000)])
+        self.assertListEqual([name for name in os.listdir(root) if name.endswith('.tmp')], [])
+        workspace_size = os.path.getsize(self._workspace)
+        self.assertLess(profiler.stages['detect']['peak_memory_bytes'], workspace_size/5)
+
+class TestStageProfiler(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_disabled(self):
+        profiler = counte.StageProfiler()
+        with profiler.stage('detect'):
+            pass
+        self.assertDictEqual(profiler.stages, {})
+
+    def test_run(self):
+        root = self._tempdir.name
+        workspace = os.path.join(root, 'workspace.scb')
+        datajson = os.path.join(root, 'counte.json')
+        counte.list2file(workspace, ['x action1'])
+
+        profiler = counte.StageProfiler(True, counte.Session.REPORT_STAGES)
+        counte.run(workspace, datajson, root, profiler=profiler)
+        counte.write_profile(root, profiler)
+
+        stages = profiler.stages
+        self.assertListEqual(list(stages), ['detect', 'load', 'record', 'aggregate', 'write_reports'])
+        for stage in stages.values():
+            self.assertEqual(stage['calls'], 1)
+            self.assertGreaterEqual(stage['wall_seconds'], 0)
+            self.assertGreaterEqual(stage['peak_memory_bytes'], 0)
+
+        d = counte.str2dict(counte.file2str(os.path.join(root, 'counte_profile.json')))
+        self.assertIn('total_wall_seconds', d)
+        self.assertTrue(os.path.exists(os.path.join(root, 'counte_report.prof')))
+
+def _run_for_concurrency_test(args):
+    workspace, datajson, report_directory = args
+    return len(counte.run(workspace, datajson, report_directory))
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._datajson = os.path.join(self._tempdir.name, 'counte.json')
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_filelock(self):
+        lock = counte.FileLock(self._datajson, timeout=0.05)
+        with lock:
+            with self.assertRaises(RuntimeError):
+                counte.FileLock(self._datajson, timeout=0.05).acquire()
+        with counte.FileLock(self._datajson, timeout=0.05):
+            pass
+
+        # 落ちたプロセスの残骸は古ければ消して取り直す
+        lockpath = f'{self._datajson}.lock'
+        finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+        finished.wait()
+        counte.list2file(lockpath, [str(finished.pid)])
+        stale = counte.FileLock(self._datajson, timeout=1.0, stale_seconds=-1)
+        with stale:
+            pass
+
+        # 古くても、持っているプロセスが動いていれば消さない
+        counte.list2file(lockpath, [str(os.getpid())])
+        with self.assertRaises(RuntimeError):
+            counte.FileLock(self._datajson, timeout=0.05, stale_seconds=-1).acquire()
+        os.remove(lockpath)
+
+        # 他に取り直されたロックは release() で消さない
+        lock = counte.FileLock(self._datajson, timeout=0.05)
+        lock.acquire()
+        counte.list2file(lockpath, ['other'])
+        lock.release()
+        self.assertTrue(os.path.exists(lockpath))
+
+    def test_pending_journal(self):
+        journal = counte.PendingJournal(self._datajson)
+        self.assertTupleEqual(journal.read(), ([], 0))
+
+        action = counte.Action('action1')
+        action.add_datestr('2023/05/28')
+        action.add_datestr('2023/05/29')
+        journal.append([action])
+        action = counte.Action('action2')
+        action.add_datestr('2023/05/28')
+        journal.append([action])
+
+        action = counte.Action('action1')
+        action.add_datestr('2023/05/29', 12)
+        journal.append([action])
+
+        actions, line_count = journal.read()
+        self.assertListEqual([action.name for action in actions], ['action1', 'action2'])
+        self.assertListEqual(actions[0].ordinal_counts,
+            [(counte.datestr2ordinal('2023/05/28'), 1), (counte.datestr2ordinal('2023/05/29'), 13)])
+
+        # 読んだ後に追記された分は discard() しても残る
+        action = counte.Action('action3')
+        action.add_datestr('2023/05/30')
+        journal.append([action])
+        journal.discard(line_count)
+        actions, line_count = journal.read()
+        self.assertListEqual([action.name for action in actions], ['action3'])
+        journal.discard(line_count)
+        self.assertFalse(os.path.exists(journal.filepath))
+
+    def test_pending_survives_failure(self):
+        ''' データに書けなかった postend は workspace から消えても pending に残り、次の実行で書かれる '''
+        root = self._tempdir.name
+        workspace = os.path.join(root, 'workspace.scb')
+        counte.str2file(self._datajson, '{broken')
+        counte.list2file(workspace, ['x3 action1'])
+        with self.assertRaises(ValueError):
+            counte.run(workspace, self._datajson, root)
+        self.assertListEqual(counte.file2list(workspace), [' action1'])
+        self.assertTrue(os.path.exists(counte.PendingJournal(self._datajson).filepath))
+
+        os.remove(self._datajson)
+        counte.run(workspace, self._datajson, root)
+        self.assertEqual(counte.JsonStorageBackend(self._datajson).load().get_count('action1'), 3)
+        self.assertFalse(os.path.exists(counte.PendingJournal(self._datajson).filepath))
+
+    def test_workspace_save_failure(self):
+        ''' workspace を書き直せなかったら mark は残るので、journal にも残さない(次の実行で二重に数えない) '''
+        root = self._tempdir.name
+        workspace = os.path.join(root, 'workspace.scb')
+        counte.list2file(workspace, ['x action1'])
+        replace = os.replace
+        def replace_but_workspace(src, dst):
+            if dst==workspace:
+                raise PermissionError(dst)
+            replace(src, dst)
+        with unittest.mock.patch('os.replace', replace_but_workspace):
+            with self.assertRaises(PermissionError):
+                counte.run(workspace, self._datajson, root)
+        self.assertListEqual(counte.file2list(workspace), ['x action1'])
+        self.assertFalse(os.path.exists(counte.PendingJournal(self._datajson).filepath))
+        self.assertListEqual([name for name in os.listdir(root) if name.endswith('.tmp')], [])
+
+        counte.run(workspace, self._datajson, root)
+        self.assertEqual(counte.JsonStorageBackend(self._datajson).load().get_count('action1'), 1)
+
+    def test_coalesce(self):
+        ''' 別の実行が溜めた pending もまとめて畳み込む '''
+        root = self._tempdir.name
+        action = counte.Action('other')
+        action.add_datestr('2023/05/28')
+        counte.PendingJournal(self._datajson).append([action])
+
+        workspace = os.path.join(root, 'workspace.scb')
+        counte.list2file(workspace, ['x action1'])
+        counte.run(workspace, self._datajson, root)
+
+        actionstore = counte.JsonStorageBackend(self._datajson).load()
+        self.assertEqual(actionstore.get_count('other'), 1)
+        self.assertEqual(actionstore.get_count('action1'), 1)
+        self.assertTrue(counte.file2list(os.path.join(root, 'counte_yearly.scb'))[-3].startswith('2023 1'))
+
+    def test_processes(self):
+        ''' 同じ data-json と workspace を何本も同時に動かしても数え落とし・二重計上しない '''
+        import concurrent.futures
+        root = self._tempdir.name
+        WORKSPACES = 4
+        RUNS_PER_WORKSPACE = 3
+        tasks = []
+        for i in range(WORKSPACES):
+            workspace = os.path.join(root, f'workspace{i}.scb')
+            counte.list2file(workspace, [f'xx action{i}', ' other'])
+            tasks.extend([(workspace, self._datajson, root)]*RUNS_PER_WORKSPACE)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+            postended_counts = list(executor.map(_run_for_concurrency_test, tasks))
+        self.assertEqual(sum(postended_counts), WORKSPACES)
+
+        actionstore = counte.JsonStorageBackend(self._datajson).load()
+        for i in range(WORKSPACES):
+            self.assertEqual(actionstore.get_count(f'action{i}'), 2)
+        T = counte.Timestamp.get_today_datestr()
+        dailylines = counte.file2list(os.path.join(root, 'counte_daily.scb'))
+        self.assertEqual(dailylines[0], f'{T} {counte.datestr2dow_eng(T)} {WORKSPACES*2}')
+        leftovers = [name for name in os.listdir(root) if name.endswith('.lock') or name.endswith('.tmp')]
+        self.assertListEqual(leftovers, [])
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self._datajson = os.path.join(self._tempdir.name, 'counte.json')
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/05/27')
+        acst.add('action1', '2023/05/28', 2)
+        acst.add('action1', '2023/06/03')
+        acst.add('action1', '2023/07/01')
+        acst.add('action2', '2023/05/28')
+        counte.JsonStorageBackend(self._datajson).record(acst, [])
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test(self):
+        lines = counte.query(self._datajson, 'json', 'action1', '2023/05/28', '2023/06/30', 'week')
+        self.assertListEqual(lines, ['2023/06/03 Sat 3', '2023/06/10 Sat 0', '2023/06/17 Sat 0',
+            '2023/06/24 Sat 0', '2023/07/01 Sat 0'])
+        lines = counte.query(self._datajson, 'json', 'action1', '2023/05/01', '2023/07/31', 'month')
+        self.assertListEqual(lines, ['2023/05 3', '2023/06 1', '2023/07 1'])
+        lines = counte.query(self._datajson, 'json', 'action1', '2023/05/27', '2023/05/28', 'day')
+        self.assertListEqual(lines, ['2023/05/27 Sat 1', '2023/05/28 Sun 2'])
+        lines = counte.query(self._datajson, 'json', 'action1', '2023/01/01', '2023/12/31')
+        self.assertListEqual(lines, ['2023/01/01-2023/12/31 5'])
+        with self.assertRaises(RuntimeError):
+            counte.query(self._datajson, 'json', 'not found', '2023/01/01', '2023/12/31')
+
+    def test_stale(self):
+        backend = counte.JsonStorageBackend(self._datajson)
+        index = counte.QueryIndex(backend)
+        self.assertTrue(index.is_stale())
+        index.open().close()
+        self.assertFalse(index.is_stale())
+
+        acst = backend.load()
+        acst.add('action2', '2023/05/29')
+        backend.record(acst, [])
+        self.assertTrue(index.is_stale())
+        lines = counte.query(self._datajson, 'json', 'action2', '2023/05/01', '2023/05/31')
+        self.assertListEqual(lines, ['2023/05/01-2023/05/31 2'])
+
+    def test_fast(self):
+        with counte.QueryIndex(counte.JsonStorageBackend(self._datajson)).open() as history:
+            start = time.perf_counter()
+            for _ in range(1000):
+                counte.query_counts(history, 'action1', '2023/05/01', '2023/05/31', 'total')
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed/1000, 0.001)
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        root = self._tempdir.name
+        self._datajson = os.path.join(root, 'counte.json')
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/05/28')
+        acst.add('action2', '2023/05/27')
+        counte.JsonStorageBackend(self._datajson).record(acst, [])
+
+        import threading
+        self._server = counte.CounteServer(self._datajson, root)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.close()
+        self._tempdir.cleanup()
+
+    def _request(self, method, path, body=None, headers=None):
+        import http.client
+        host, port = self._server.server_address[:2]
+        connection = http.client.HTTPConnection(host, port)
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        result = (response.status, response.getheader('ETag'), response.read().decode('utf8'))
+        connection.close()
+        return result
+
+    def _expected_body(self, period):
+        report = counte.Report(counte.JsonStorageBackend(self._datajson).load())
+        lines = counte.FileReport.lines_by_DescOrder_and_MostCounted(report.aggregate.xxxxcounts_by_period(period))
+        return ''.join([f'{line}\n' for line in lines])
+
+    def test(self):
+        status, etag, body = self._request('GET', '/daily')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self._expected_body('daily'))
+        status, _, body = self._request('GET', '/daily', headers={'If-None-Match': etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, '')
+        _, yearly_etag, _ = self._request('GET', '/yearly')
+
+        status, _, body = self._request('POST', '/postend', counte.dict2str({'action': 'action1', 'marks': 'xy'}))
+        self.assertEqual(status, 200)
+        T = counte.Timestamp.get_today_datestr()
+        Y = counte.Timestamp.get_yesterday_datestr()
+        self.assertDictEqual(counte.str2dict(body), {'action': 'action1', 'counts': [[T, 1], [Y, 1]]})
+
+        for period in counte.REPORT_FILENAMES:
+            status, _, body = self._request('GET', f'/{period}')
+            self.assertEqual(body, self._expected_body(period))
+        status, new_etag, _ = self._request('GET', '/daily', headers={'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+        status, _, _ = self._request('GET', '/yearly', headers={'If-None-Match': yearly_etag})
+        self.assertEqual(status, 200)
+
+        status, _, _ = self._request('POST', '/postend', counte.dict2str({'action': 'action1', 'marks': 'z'}))
+        self.assertEqual(status, 400)
+        for name in ['action1\nbogus', 'action1\r', ' action1']:
+            status, _, _ = self._request('POST', '/postend', counte.dict2str({'action': name, 'marks': 'x'}))
+            self.assertEqual(status, 400)
+        status, _, _ = self._request('GET', '/hourly')
+        self.assertEqual(status, 404)
+
+    def test_other_writer(self):
+        ''' 他の実行がデータを書いたら読み直す '''
+        _, etag, _ = self._request('GET', '/daily')
+        backend = counte.JsonStorageBackend(self._datajson)
+        acst = backend.load()
+        acst.add('action3', '2023/05/29')
+        backend.record(acst, [])
+        status, _, body = self._request('GET', '/daily', headers={'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self._expected_body('daily'))
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        root = self._tempdir.name
+        for name, lines in [('alice', ['x action1', ' action2']), ('bob', ['xx action3'])]:
+            directory = os.path.join(root, name)
+            os.mkdir(directory)
+            counte.list2file(os.path.join(directory, 'workspace.scb'), lines)
+        os.mkdir(os.path.join(root, 'not-a-workspace'))
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_directory(self):
+        root = self._tempdir.name
+        entries = counte.read_batch_entries(root)
+        self.assertEqual(len(entries), 2)
+
+        results = counte.run_batch(entries, jobs=2)
+        self.assertListEqual([result['error'] for result in results], [None, None])
+        self.assertListEqual([result['postended'] for result in results], [1, 2])
+
+        actionstore = counte.JsonStorageBackend(os.path.join(root, 'bob', 'counte.json')).load()
+        self.assertEqual(actionstore.get_count('action3'), 2)
+        self.assertTrue(os.path.exists(os.path.join(root, 'bob', 'counte_daily.scb')))
+        self.assertListEqual(counte.file2list(os.path.join(root, 'alice', 'workspace.scb')),
+            [' action1', ' action2'])
+
+    def test_manifest(self):
+        root = self._tempdir.name
+        manifest = os.path.join(root, 'manifest.json')
+        counte.str2file(manifest, '''[
+  {"input-scb": "alice/workspace.scb", "data-json": "alice/counte.json", "report-directory": "alice"},
+  {"input-scb": "bob/workspace.scb", "data-json": "bob/counte.json", "report-directory": "not-found"}
+]''')
+        entries = counte.read_batch_entries(manifest)
+        results = counte.run_batch(entries, jobs=1)
+
+        # bob が失敗しても alice は処理される
+        self.assertIsNone(results[0]['error'])
+        self.assertEqual(results[0]['postended'], 1)
+        self.assertIn('report-directory invalid', results[1]['error'])
+
+        lines = counte.batch_summary_lines(results, 0.5)
+        self.assertEqual(lines[-1], 'total 0.500s 2 workspaces, 1 errors')
+
+    def test_options(self):
+        root = self._tempdir.name
+        entries = counte.read_batch_entries(root)
+        results = counte.run_batch(entries, jobs=1, record_only=True, profile=True)
+        self.assertListEqual([result['error'] for result in results], [None, None])
+        bob = os.path.join(root, 'bob')
+        self.assertEqual(counte.JsonStorageBackend(os.path.join(bob, 'counte.json')).load().get_count('action3'), 2)
+        self.assertFalse(os.path.exists(os.path.join(bob, 'counte_daily.scb')))
+        self.assertTrue(os.path.exists(os.path.join(bob, 'counte_profile.json')))
+
+        counte.list2file(os.path.join(bob, 'workspace.scb'), ['x action3', 'x action4'])
+        results = counte.run_batch(entries, jobs=1, windows={'daily': 1}, top=1)
+        self.assertListEqual([result['error'] for result in results], [None, None])
+        dailylines = counte.file2list(os.path.join(bob, 'counte_daily.scb'))
+        # 直近1日の1セクションだけで、action は回数の多い1個だけ
+        self.assertEqual(len(dailylines), 3)
+        self.assertTrue(dailylines[0].endswith(' 4'))
+        self.assertListEqual(dailylines[1:], [' 3 action3', ''])
+
 class TestReport(unittest.TestCase):
     def setUp(self):
         pass
@@ -333,5 +1259,396 @@ class TestReport(unittest.TestCase):
         report.weeklycounts
         report.monthlycounts
 
+    def test_counts(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06')
+        acst.add('action1', '2023/02/11')
+        acst.add('action1', '2023/02/11')
+        acst.add('action1', '2023/02/12')
+        acst.add('action2', '2023/02/11')
+        acst.add('action2', '2023/02/13')
+        acst.add('action2', '2023/03/01')
+
+        report = counte.Report(acst)
+
+        self.assertDictEqual(report.dailycounts, {
+            '2023/02/06': [['action1', 1]],
+            '2023/02/11': [['action1', 2], ['action2', 1]],
+            '2023/02/12': [['action1', 1]],
+            '2023/02/13': [['action2', 1]],
+            '2023/03/01': [['action2', 1]],
+        })
+        # 基点の土曜日は history にある日付だけ
+        self.assertDictEqual(report.weeklycounts, {
+            '2023/02/11': [['action1', 3], ['action2', 1]],
+        })
+        self.assertDictEqual(report.monthlycounts, {
+            '2023/02': [['action1', 4], ['action2', 2]],
+            '2023/03': [['action2', 1]],
+        })
+        self.assertDictEqual(report.yearlycounts, {
+            '2023': [['action1', 4], ['action2', 3]],
+        })
+
+        filereport = counte.FileReport(report)
+        self.assertListEqual(filereport.monthlycounts_by_lines, [
+            '2023/03 1',
+            ' 1 action2',
+            '',
+            '2023/02 6',
+            ' 4 action1',
+            ' 2 action2',
+            '',
+        ])
+        self.assertListEqual(filereport.yearlycounts_by_lines, [
+            '2023 7',
+            ' 4 action1',
+            ' 3 action2',
+            '',
+        ])
+
+class TestMatrixReport(unittest.TestCase):
+    def setUp(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06')
+        acst.add('action1', '2023/02/07', 3)
+        acst.add('action1', '2023/02/08')
+        acst.add('action1', '2023/02/11', 2)
+        acst.add('action1', '2023/02/12')
+        acst.add('action2', '2023/02/11')
+        acst.add('action2', '2023/02/13')
+        acst.add('action2', '2023/03/01')
+        acst.add('action2', '2024/01/01')
+        self._actionstore = acst
+
+    def tearDown(self):
+        pass
+
+    def _assert_matrixreport(self, matrixreport):
+        report = counte.Report(self._actionstore)
+        self.assertDictEqual(matrixreport.dailycounts, report.dailycounts)
+        self.assertDictEqual(matrixreport.weeklycounts, report.weeklycounts)
+        self.assertDictEqual(matrixreport.monthlycounts, report.monthlycounts)
+        self.assertDictEqual(matrixreport.yearlycounts, report.yearlycounts)
+        self.assertEqual(matrixreport.lower_datestr, report.lower_datestr)
+        self.assertEqual(matrixreport.upper_datestr, report.upper_datestr)
+        self.assertEqual(matrixreport.count_total, report.count_total)
+        self.assertListEqual(counte.FileReport(matrixreport).weeklycounts_by_lines,
+            counte.FileReport(report).weeklycounts_by_lines)
+
+        rolling = matrixreport.rolling_counts(7)
+        self.assertListEqual(rolling['2023/02/12'], [['action1', 8], ['action2', 1]])
+        self.assertListEqual(rolling['2023/02/13'], [['action1', 7], ['action2', 2]])
+        self.assertNotIn('2023/02/25', rolling)
+        rolling = matrixreport.rolling_counts(30)
+        self.assertListEqual(rolling['2023/03/01'], [['action1', 8], ['action2', 3]])
+
+        self.assertDictEqual(matrixreport.streaks, {
+            'action1': [3, 0],
+            'action2': [1, 1],
+        })
+
+    def test_python(self):
+        matrixreport = counte.MatrixReport(self._actionstore, use_numpy=False)
+        self.assertFalse(matrixreport.uses_numpy)
+        self._assert_matrixreport(matrixreport)
+
+    @unittest.skipUnless(counte._import_numpy(), 'numpy is not installed')
+    def test_numpy(self):
+        matrixreport = counte.MatrixReport(self._actionstore)
+        self.assertTrue(matrixreport.uses_numpy)
+        self._assert_matrixreport(matrixreport)
+
+    def test_empty(self):
+        for use_numpy in [False, True]:
+            matrixreport = counte.MatrixReport(counte.ActionStore(), use_numpy)
+            self.assertDictEqual(matrixreport.dailycounts, {})
+            self.assertIsNone(matrixreport.lower_datestr)
+            self.assertEqual(matrixreport.count_total, 0)
+
+class TestAggregate(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_incremental(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06')
+        acst.add('action1', '2023/02/11')
+        acst.add('action2', '2023/02/11')
+
+        aggregate = counte.Aggregate.from_actionstore(acst)
+        jsonstr = aggregate.to_jsonstring()
+        aggregate = counte.Aggregate.from_jsonstring(jsonstr)
+        self.assertSetEqual(aggregate.touched_dailykeys, set())
+
+        aggregate.add('action2', '2023/02/12')
+        aggregate.add('action1', '2023/02/12')
+        acst.add('action2', '2023/02/12')
+        acst.add('action1', '2023/02/12')
+
+        report = counte.Report(acst)
+        self.assertDictEqual(aggregate.dailycounts, report.dailycounts)
+        self.assertDictEqual(aggregate.weeklycounts, report.weeklycounts)
+        self.assertDictEqual(aggregate.monthlycounts, report.monthlycounts)
+        self.assertDictEqual(aggregate.yearlycounts, report.yearlycounts)
+        self.assertEqual(aggregate.count_total, 5)
+        self.assertEqual(aggregate.upper_datestr, '2023/02/12')
+
+        self.assertSetEqual(aggregate.touched_dailykeys, {'2023/02/12'})
+        self.assertSetEqual(aggregate.touched_weeklykeys, {'2023/02/18'})
+        self.assertSetEqual(aggregate.touched_monthlykeys, {'2023/02'})
+        self.assertSetEqual(aggregate.touched_yearlykeys, {'2023'})
+
+    def test_large_count(self):
+        ''' 足して 32 ビットを超えても、他の action に溢れない '''
+        aggregate = counte.Aggregate()
+        aggregate.add('action1', '2023/01/01', 2**31)
+        aggregate.add('action1', '2023/01/02', 2**31)
+        aggregate.add('action2', '2023/01/03', 1)
+        aggregate.add('action1', '2023/01/04', 3*10**9)
+        expect = {'2023/01': [['action1', 2**32+3*10**9], ['action2', 1]]}
+        self.assertDictEqual(aggregate.monthlycounts, expect)
+        reloaded = counte.Aggregate.from_jsonstring(aggregate.to_jsonstring())
+        self.assertDictEqual(reloaded.monthlycounts, expect)
+        self.assertDictEqual(reloaded.yearlycounts, {'2023': expect['2023/01']})
+
+    def test_jsonstring(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/11', 3)
+        acst.add('アクション2', '2023/02/11')
+        jsonstr = counte.Aggregate.from_actionstore(acst).to_jsonstring()
+        d = counte.str2dict(jsonstr)
+        self.assertListEqual(d['actions'], ['action1', 'アクション2'])
+        self.assertListEqual(d['daily']['2023/02/11'], [0, 3, 1, 1])
+
+        # 書式の古いキャッシュや、データの signature が違うキャッシュは読まずに作り直させる
+        with tempfile.TemporaryDirectory() as tempdir:
+            cachepath = os.path.join(tempdir, 'counte.json.aggregate')
+            signature = ((1, 2),)
+            counte.save_aggregate_cache(cachepath, counte.Aggregate.from_jsonstring(jsonstr), signature)
+            self.assertIsNotNone(counte.load_aggregate_cache(cachepath, signature))
+            self.assertIsNone(counte.load_aggregate_cache(cachepath, ((1, 3),)))
+            del d['version']
+            counte.str2file(cachepath, counte.dict2str(d))
+            self.assertIsNone(counte.load_aggregate_cache(cachepath, signature))
+
+    def test_cache_signature(self):
+        ''' 合計の変わらない手直し(名前の変更)でも、キャッシュは使わずに作り直す '''
+        with tempfile.TemporaryDirectory() as root:
+            workspace = os.path.join(root, 'workspace.scb')
+            datajson = os.path.join(root, 'counte.json')
+            counte.list2file(workspace, ['x pushups'])
+            counte.run(workspace, datajson, root)
+
+            backend = counte.JsonStorageBackend(datajson)
+            d = counte.str2dict(counte.file2str(datajson))
+            d['push-ups'] = d.pop('pushups')
+            counte.str2file(datajson, counte.dict2str(d))
+
+            counte.list2file(workspace, ['x situps'])
+            counte.run(workspace, datajson, root)
+            aggregate = counte.Aggregate.from_actionstore(backend.load())
+            dailyreport = os.path.join(root, counte.REPORT_FILENAMES['daily'])
+            expect = counte.FileReport.lines_by_DescOrder_and_MostCounted(aggregate.dailycounts)
+            self.assertListEqual(counte.file2list(dailyreport), expect)
+            self.assertIn(' 1 push-ups', expect)
+
+class TestFileReport(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_splice(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06')
+        acst.add('action1', '2023/02/11')
+        acst.add('action2', '2023/02/11')
+        aggregate = counte.Aggregate.from_actionstore(acst)
+        lines = counte.FileReport(aggregate).dailycounts_by_lines
+
+        aggregate.add('action2', '2023/02/11')
+        aggregate.add('action1', '2023/02/09')
+        acst.add('action2', '2023/02/11')
+        acst.add('action1', '2023/02/09')
+
+        touched = aggregate.dailycounts_of(aggregate.touched_dailykeys)
+        actual = counte.FileReport.splice_sections(lines, touched)
+        expect = counte.FileReport(counte.Report(acst)).dailycounts_by_lines
+        self.assertListEqual(actual, expect)
+        self.assertEqual(actual[0], '2023/02/11 Sat 3')
+
+    def test_tie_order(self):
+        ''' 同じ回数の並びは、集計の action の順(キャッシュか作り直しか)によらない '''
+        cached = counte.ActionStore()
+        cached.add('action2', '2023/02/11')
+        cached.add('action1', '2023/02/11')
+        cached.add('action3', '2023/02/11')
+        rebuilt = counte.ActionStore()
+        for name in ['action1', 'action2', 'action3']:
+            rebuilt.add(name, '2023/02/11')
+        expect = ['2023/02/11 Sat 3', ' 1 action3', ' 1 action2', ' 1 action1', '']
+        for acst in [cached, rebuilt]:
+            lines = counte.FileReport(counte.Report(acst)).dailycounts_by_lines
+            self.assertListEqual(lines, expect)
+        pairs = [['action2', 1], ['action1', 1], ['action3', 1]]
+        self.assertListEqual(counte.FileReport.top_most_counted(pairs, 2), [['action3', 1], ['action2', 1]])
+
+    def test_write_if_changed(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06')
+        acst.add('action2', '2023/02/11')
+        with tempfile.TemporaryDirectory() as tempdir:
+            aggregate = counte.Aggregate.from_actionstore(acst)
+            replaced = counte.write_reports(tempdir, aggregate)
+            self.assertListEqual(replaced, ['daily', 'weekly', 'monthly', 'yearly'])
+            replaced = counte.write_reports(tempdir, aggregate)
+            self.assertListEqual(replaced, [])
+
+            aggregate.clear_touched()
+            aggregate.add('action1', '2022/12/31')
+            acst.add('action1', '2022/12/31')
+            replaced = counte.write_reports(tempdir, aggregate, incremental=True)
+            self.assertListEqual(replaced, ['daily', 'weekly', 'monthly', 'yearly'])
+            fullpath = os.path.join(tempdir, counte.REPORT_FILENAMES['daily'])
+            expect = counte.FileReport(counte.Report(acst)).dailycounts_by_lines
+            self.assertListEqual(counte.file2list(fullpath), expect)
+            # 一時ファイルは残らない(レポートと、描いたときのオプションだけ)
+            self.assertEqual(len(os.listdir(tempdir)), len(counte.REPORT_FILENAMES)+1)
+
+    def test_top(self):
+        pairs = [['a', 3], ['b', 1], ['c', 3], ['d', 2], ['e', 1], ['f', 3]]
+        for top in range(len(pairs)+2):
+            expect = counte.FileReport.sort_to_most_counted(pairs)[:top]
+            self.assertListEqual(counte.FileReport.top_most_counted(pairs, top), expect)
+        lines = counte.FileReport.section_lines('2023/02', pairs, 2)
+        self.assertListEqual(lines, ['2023/02 13', ' 3 f', ' 3 c', ''])
+
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/02/06', 2)
+        acst.add('action2', '2023/02/06')
+        acst.add('action2', '2023/02/11')
+        with tempfile.TemporaryDirectory() as tempdir:
+            aggregate = counte.Aggregate.from_actionstore(acst)
+            counte.write_reports(tempdir, aggregate)
+            # top が変わったら、触っていないセクション(2023/02/06)も描き直す
+            aggregate.clear_touched()
+            aggregate.add('action1', '2023/02/11')
+            replaced = counte.write_reports(tempdir, aggregate, incremental=True, top=1)
+            self.assertListEqual(replaced, ['daily', 'weekly', 'monthly', 'yearly'])
+            fullpath = os.path.join(tempdir, counte.REPORT_FILENAMES['daily'])
+            expect = [
+                '2023/02/11 Sat 2',
+                ' 1 action2',
+                '',
+                '2023/02/06 Mon 3',
+                ' 2 action1',
+                '',
+            ]
+            self.assertListEqual(counte.file2list(fullpath), expect)
+
+    def test_leaderboard(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/01/01', 5)
+        acst.add('action2', '2023/02/06')
+        acst.add('action3', '2023/02/10', 2)
+        aggregate = counte.Aggregate.from_actionstore(acst)
+        aggregate.add('action2', '2023/02/11', 3)
+        acst.add('action2', '2023/02/11', 3)
+
+        # add() で足していった合計は、作り直したものと同じ
+        self.assertListEqual(aggregate.totalcounts, counte.Aggregate.from_actionstore(acst).totalcounts)
+        reloaded = counte.Aggregate.from_jsonstring(aggregate.to_jsonstring())
+        self.assertListEqual(reloaded.totalcounts, aggregate.totalcounts)
+
+        expect = [
+            'all-time 11',
+            ' 5 action1',
+            ' 4 action2',
+            '',
+            '2023/02/05-2023/02/11 6',
+            ' 4 action2',
+            ' 2 action3',
+            '',
+            '2023/01/13-2023/02/11 6',
+            ' 4 action2',
+            ' 2 action3',
+            '',
+        ]
+        self.assertListEqual(counte.leaderboard_lines(aggregate, 2), expect)
+        self.assertListEqual(counte.leaderboard_lines(counte.Aggregate()), ['all-time 0', ''])
+
+    def test_window(self):
+        acst = counte.ActionStore()
+        acst.add('action1', '2023/01/28')
+        acst.add('action1', '2023/02/04')
+        acst.add('action2', '2023/02/06')
+        acst.add('action1', '2023/02/10')
+        acst.add('action2', '2023/02/11')
+        acst.add('action1', '2023/02/11')
+        full = counte.Report(acst).aggregate
+
+        windowed = counte.windowed_aggregates_from_actionstore(acst, {'daily': 2, 'weekly': 2})
+        expect = {k: v for (k, v) in full.dailycounts.items() if k>='2023/02/10'}
+        self.assertDictEqual(windowed['daily'].dailycounts, expect)
+        expect = {k: v for (k, v) in full.weeklycounts.items() if k>='2023/02/04'}
+        self.assertDictEqual(windowed['weekly'].weeklycounts, expect)
+        self.assertEqual(len(windowed['weekly'].weeklycounts), 2)
+
+        # 窓をやめたら、窓の外の日も描き戻す
+        with tempfile.TemporaryDirectory() as tempdir:
+            counte.write_reports(tempdir, full, windowed_aggregates=windowed)
+            full.clear_touched()
+            full.add('action2', '2023/02/11')
+            acst.add('action2', '2023/02/11')
+            counte.write_reports(tempdir, full, incremental=True)
+            fullpath = os.path.join(tempdir, counte.REPORT_FILENAMES['daily'])
+            expect = counte.FileReport(counte.Report(acst)).dailycounts_by_lines
+            self.assertListEqual(counte.file2list(fullpath), expect)
+
+    def test_top_arguments(self):
+        self.assertEqual(counte.parse_arguments(['--top', '3']).top, 3)
+        for value in ['0', '-1']:
+            with unittest.mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+                counte.parse_arguments(['--top', value])
+
+    def test_window_arguments(self):
+        args = counte.parse_arguments(['--daily-window', '1', '--weekly-window', '4'])
+        self.assertDictEqual(counte.windows_from_arguments(args.daily_window, args.weekly_window),
+            {'daily': 1, 'weekly': 4})
+        for option in ['--daily-window', '--weekly-window']:
+            for value in ['0', '-1', 'one']:
+                with unittest.mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+                    counte.parse_arguments([option, value])
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_generate(self):
+        names = bench.generate_action_names(5)
+        a = bench.generate_datadict(names, 1, 3, seed=1)
+        b = bench.generate_datadict(names, 1, 3, seed=1)
+        self.assertDictEqual(a, b)
+        total = sum(sum(daycounts.values()) for daycounts in a.values())
+        self.assertEqual(total, 365*3)
+
+    def test_run_stages(self):
+        timings = bench.run_stages(actions=5, years=1, events_per_day=2, repeat=1)
+        self.assertListEqual(list(timings), bench.STAGES)
+
+    def test_check_scaling(self):
+        small = {'linear': 0.010, 'quadratic': 0.010, 'tiny': 0.00001}
+        large = {'linear': 0.021, 'quadratic': 0.040, 'tiny': 0.0001}
+        regressions = bench.check_scaling(small, large, factor=2, threshold=3.0)
+        self.assertListEqual([r['stage'] for r in regressions], ['quadratic'])
+
 if __name__ == '__main__':
     unittest.main()